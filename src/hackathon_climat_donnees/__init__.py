@@ -1,4 +1,50 @@
+import importlib
 import os
 
-INPUT = os.path.realpath("./../../input")
-OUTPUT = os.path.realpath("./../../output")
+# répertoires de données, à la racine du dépôt (indépendamment du répertoire
+# courant) ; surchargeables par les variables d'environnement
+# HACKATHON_INPUT / HACKATHON_OUTPUT
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", ".."))
+INPUT = os.path.realpath(
+    os.environ.get("HACKATHON_INPUT", os.path.join(ROOT, "input"))
+)
+OUTPUT = os.path.realpath(
+    os.environ.get("HACKATHON_OUTPUT", os.path.join(ROOT, "output"))
+)
+
+# modules chargés à la première utilisation (hackathon_climat_donnees.<nom>),
+# pour que l'import du paquet reste immédiat : les dépendances lourdes
+# (xarray, scipy, geopandas...) ne sont importées que par les modules qui
+# les utilisent
+SUBMODULES = [
+    "catalog",
+    "cli",
+    "cluster",
+    "constants",
+    "diagnostics",
+    "ensemble",
+    "instrumentation",
+    "join_netcdf",
+    "maxima_store",
+    "netcdf_processing",
+    "nonstationary",
+    "outputs",
+    "pipeline",
+    "prep_datasets",
+    "regional",
+    "regrid",
+    "sensitivity",
+    "service",
+    "site_series",
+    "web_export",
+]
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + SUBMODULES)
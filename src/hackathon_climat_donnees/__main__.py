@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+python -m hackathon_climat_donnees (cf. cli)
+"""
+
+import sys
+
+from hackathon_climat_donnees.cli import main
+
+sys.exit(main())
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Catalogue des fichiers d'entrée DRIAS
+
+Les chemins des fichiers suivent la convention DRIAS / EURO-CORDEX :
+
+    mfdata/SocleM-Climat-2025/RCM/EURO-CORDEX/EUR-12/<GCM>/<membre>/<RCM>/
+        <expérience>/<fréquence>/<variable>/<version>/<fichier>.nc
+
+    <variable>_<domaine>_<GCM>_<expérience>_<membre>_<institut>_<RCM>_
+        <version RCM>_<correction de biais>_<fréquence>_<début>-<fin>.nc
+
+Le catalogue est une table (une ligne par fichier) construite à partir de ces
+conventions, sans ouvrir les fichiers. La coordonnée temporelle et
+l'empreinte de la grille de chaque fichier sont lues une seule fois puis
+conservées en cache (invalidé si la taille ou la date de modification du
+fichier change) : les découpages temporels sont ensuite planifiés sans
+ouvrir les fichiers.
+
+Ex.:
+    >>> catalog = build_catalog()
+    >>> select(catalog, gcm="CNRM-ESM2-1", experiment="ssp370")
+    >>> time_slice(path, 1985, 2014)
+    slice(12784, 23741, None)
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from hackathon_climat_donnees import INPUT, OUTPUT
+
+
+logger = logging.getLogger(__name__)
+
+LISTS = ["liste_hist_tasmax.txt", "liste_ssp370_tasmax.txt"]
+
+# scénarios DRIAS et leur étiquette dans les noms des fichiers de sortie
+SCENARIOS = {
+    "ssp126": "ssp1",
+    "ssp245": "ssp2",
+    "ssp370": "ssp3",
+    "ssp585": "ssp5",
+}
+
+CACHE_DIR = os.path.join(OUTPUT, "catalog")
+
+PATH_FIELDS = [
+    "gcm",
+    "member",
+    "rcm",
+    "experiment",
+    "frequency",
+    "variable",
+    "version",
+]
+
+FILENAME_FIELDS = [
+    "variable",
+    "domain",
+    "gcm",
+    "experiment",
+    "member",
+    "institute",
+    "rcm",
+    "rcm_version",
+    "bias_adjustment",
+    "frequency",
+    "period",
+]
+
+# colonnes identifiant un membre d'ensemble (simulation GCM/RCM)
+MEMBER_KEYS = ["gcm", "member", "rcm"]
+
+
+def parse_path(path: str) -> dict:
+    """
+    Décompose le chemin d'un fichier DRIAS en métadonnées.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier, tel que listé dans liste_*_tasmax.txt.
+
+    Raises
+    ------
+    ValueError
+        Si le nom de fichier ne suit pas la convention DRIAS.
+
+    Returns
+    -------
+    dict
+        Métadonnées (gcm, member, rcm, experiment, variable, domain,
+        institute, rcm_version, bias_adjustment, frequency, start, end,
+        version, path).
+
+    """
+    parts = path.strip().replace("\\", "/").split("/")
+    filename = parts[-1]
+    fields = os.path.splitext(filename)[0].split("_")
+    if len(fields) != len(FILENAME_FIELDS):
+        raise ValueError(f"nom de fichier non conforme : {filename}")
+
+    meta = dict(zip(FILENAME_FIELDS, fields))
+    start, end = meta.pop("period").split("-")
+    meta["start"] = pd.Timestamp(start)
+    meta["end"] = pd.Timestamp(end)
+
+    # le répertoire porte la version des données ; les autres champs du
+    # répertoire doivent être cohérents avec le nom de fichier
+    dirs = dict(zip(PATH_FIELDS, parts[-len(PATH_FIELDS) - 1 : -1]))
+    meta["version"] = dirs.get("version")
+    for key in ["gcm", "member", "rcm", "experiment"]:
+        if key in dirs and dirs[key] != meta[key]:
+            logger.warning(
+                "%s incohérent entre répertoire et fichier : %s", key, path
+            )
+    meta["path"] = path.strip()
+    return meta
+
+
+def _cache_path(path: str, cache_dir: str) -> str:
+    digest = hashlib.sha1(path.encode("utf8")).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.json")
+
+
+def file_metadata(
+    path: str, root: str = INPUT, cache_dir: str = CACHE_DIR
+) -> dict:
+    """
+    Coordonnée temporelle et empreinte de grille d'un fichier, lues une
+    seule fois puis mises en cache.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier, relatif à `root`.
+    root : str, optional
+        Répertoire racine des fichiers. INPUT par défaut.
+    cache_dir : str, optional
+        Répertoire du cache. CACHE_DIR par défaut.
+
+    Returns
+    -------
+    dict
+        size, mtime, time (valeurs brutes), time_units, calendar, years
+        (années présentes), offsets (indice du premier pas de temps de
+        chaque année, plus la longueur totale), grid (empreinte), shape.
+
+    """
+    full_path = os.path.join(root, path)
+    stat = os.stat(full_path)
+    cache = _cache_path(path, cache_dir)
+    if os.path.exists(cache):
+        with open(cache, encoding="utf8") as f:
+            meta = json.load(f)
+        if meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime:
+            return meta
+
+    import cftime
+    import xarray as xr
+
+    logger.info("Lecture des métadonnées de %s", path)
+    with xr.open_dataset(full_path, decode_times=False) as ds:
+        time = ds["time"]
+        units = time.attrs["units"]
+        calendar = time.attrs.get("calendar", "standard")
+        values = time.values
+
+        grid = hashlib.sha1()
+        for dim in ["y", "x"]:
+            grid.update(np.ascontiguousarray(ds[dim].values).tobytes())
+        shape = [int(ds.sizes["y"]), int(ds.sizes["x"])]
+
+    dates = cftime.num2date(values, units, calendar)
+    years_all = np.array([d.year for d in dates])
+    years, offsets = np.unique(years_all, return_index=True)
+
+    meta = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "time": values.tolist(),
+        "time_units": units,
+        "calendar": calendar,
+        "years": years.tolist(),
+        "offsets": offsets.tolist() + [len(values)],
+        "grid": grid.hexdigest(),
+        "shape": shape,
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache, "w", encoding="utf8") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def build_catalog(
+    lists: list[str] = None,
+    root: str = INPUT,
+    scan: bool = False,
+    cache_dir: str = CACHE_DIR,
+) -> pd.DataFrame:
+    """
+    Construit le catalogue des fichiers listés dans les fichiers de
+    `lists`.
+
+    Parameters
+    ----------
+    lists : list[str], optional
+        Fichiers de listes (relatifs à `root`). Par défaut, LISTS.
+    root : str, optional
+        Répertoire racine. INPUT par défaut.
+    scan : bool, optional
+        Si True, lit (ou relit depuis le cache) la couverture temporelle et
+        l'empreinte de grille de chaque fichier présent. False par défaut.
+    cache_dir : str, optional
+        Répertoire du cache des métadonnées. CACHE_DIR par défaut.
+
+    Returns
+    -------
+    catalog : pd.DataFrame
+        Une ligne par fichier : gcm, member, rcm, experiment, variable,
+        domain, institute, rcm_version, bias_adjustment, frequency, start,
+        end, version, path, size, mtime (+ first_year, last_year, n_time,
+        calendar, grid si scan).
+
+    """
+    if lists is None:
+        lists = LISTS
+
+    records = []
+    for name in lists:
+        with open(os.path.join(root, name)) as f:
+            paths = [line.strip() for line in f if line.strip()]
+        for path in paths:
+            meta = parse_path(path)
+            full_path = os.path.join(root, path)
+            if os.path.exists(full_path):
+                stat = os.stat(full_path)
+                meta["size"] = stat.st_size
+                meta["mtime"] = pd.Timestamp(stat.st_mtime, unit="s")
+                if scan:
+                    fmeta = file_metadata(path, root, cache_dir)
+                    meta["first_year"] = fmeta["years"][0]
+                    meta["last_year"] = fmeta["years"][-1]
+                    meta["n_time"] = fmeta["offsets"][-1]
+                    meta["calendar"] = fmeta["calendar"]
+                    meta["grid"] = fmeta["grid"]
+            records.append(meta)
+
+    catalog = pd.DataFrame(records).drop_duplicates("path")
+    for col in ["gcm", "member", "rcm", "experiment", "variable"]:
+        catalog[col] = catalog[col].astype("category")
+    return catalog.reset_index(drop=True)
+
+
+def scenario_lists(
+    experiments: list[str], variable: str = "tasmax"
+) -> list[str]:
+    """
+    Fichiers de listes de la période historique et des scénarios.
+
+    Ex.:
+        >>> scenario_lists(["ssp126", "ssp370"])
+        ['liste_hist_tasmax.txt', 'liste_ssp126_tasmax.txt',
+         'liste_ssp370_tasmax.txt']
+
+    """
+    return [f"liste_hist_{variable}.txt"] + [
+        f"liste_{experiment}_{variable}.txt" for experiment in experiments
+    ]
+
+
+def select(catalog: pd.DataFrame, **criteria) -> pd.DataFrame:
+    """
+    Sélection dans le catalogue par n'importe quelle colonne.
+
+    Parameters
+    ----------
+    catalog : pd.DataFrame
+        Catalogue (cf. build_catalog).
+    **criteria
+        Valeur (ou liste de valeurs) attendue par colonne, ex.
+        gcm="CNRM-ESM2-1", member=["r14i1p1f2", "r15i1p1f2"].
+
+    Returns
+    -------
+    pd.DataFrame
+        Lignes correspondantes.
+
+    """
+    mask = pd.Series(True, index=catalog.index)
+    for key, value in criteria.items():
+        if isinstance(value, (list, tuple, set)):
+            mask &= catalog[key].isin(value)
+        else:
+            mask &= catalog[key] == value
+    return catalog[mask]
+
+
+def parse_pivots(pivots: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ajoute le membre d'ensemble (et l'expérience) au tableau des années
+    pivots, à partir de la colonne "modele" de TRACC_pivot.csv
+    (<GCM>_<expérience>_<membre>_<RCM>_<correction de biais>).
+
+    Parameters
+    ----------
+    pivots : pd.DataFrame
+        Contenu de TRACC_pivot.csv.
+
+    Returns
+    -------
+    pd.DataFrame
+        Tableau augmenté d'une colonne "member".
+
+    """
+    parts = pivots["modele"].str.split("_", expand=True)
+    pivots = pivots.copy()
+    pivots["member"] = parts[2]
+    return pivots
+
+
+def match_pivots(
+    catalog: pd.DataFrame,
+    pivots: pd.DataFrame,
+    experiment: str = "ssp370",
+    variable: str = None,
+) -> pd.DataFrame:
+    """
+    Associe à chaque ligne du tableau des années pivots les fichiers
+    historique et scénario du même membre (GCM, membre, RCM). Seules les
+    années pivots du scénario `experiment` sont retenues (colonne
+    "scenario" de TRACC_pivot.csv).
+
+    Parameters
+    ----------
+    catalog : pd.DataFrame
+        Catalogue (cf. build_catalog).
+    pivots : pd.DataFrame
+        Contenu de TRACC_pivot.csv.
+    experiment : str, optional
+        Expérience du scénario. "ssp370" par défaut.
+    variable : str, optional
+        Variable à sélectionner. Par défaut, toutes.
+
+    Returns
+    -------
+    pd.DataFrame
+        Tableau des pivots augmenté des colonnes "member", "hist_path" et
+        "ssp_path" (NaN si le fichier est absent du catalogue).
+
+    """
+    if variable is not None:
+        catalog = select(catalog, variable=variable)
+    if "scenario" in pivots:
+        pivots = pivots[pivots["scenario"] == experiment]
+    pivots = parse_pivots(pivots)
+
+    paths = {}
+    for label, exp in [("hist_path", "historical"), ("ssp_path", experiment)]:
+        files = select(catalog, experiment=exp)[MEMBER_KEYS + ["path"]]
+        files = files.astype({k: str for k in MEMBER_KEYS})
+        duplicated = files.duplicated(MEMBER_KEYS, keep=False)
+        if duplicated.any():
+            logger.warning(
+                "Plusieurs fichiers par membre (%s) : %s",
+                exp,
+                files[duplicated].path.tolist(),
+            )
+        paths[label] = files.drop_duplicates(MEMBER_KEYS).rename(
+            columns={"path": label}
+        )
+
+    # TRACC_pivot.csv nomme les colonnes GCM et RCM en majuscules
+    on = ["GCM", "member", "RCM"]
+    for label, files in paths.items():
+        files = files.rename(columns={"gcm": "GCM", "rcm": "RCM"})
+        pivots = pivots.merge(files, on=on, how="left")
+    return pivots
+
+
+def member_key(row) -> str:
+    """
+    Identifiant d'un membre d'ensemble, utilisé dans les noms des fichiers
+    de sortie : <GCM>__<membre>__<RCM>.
+    """
+    return f"{row['GCM']}__{row['member']}__{row['RCM']}"
+
+
+def time_slice(
+    path: str,
+    start_year: int,
+    end_year: int,
+    root: str = INPUT,
+    cache_dir: str = CACHE_DIR,
+) -> slice:
+    """
+    Indices (pour Dataset.isel) des pas de temps compris entre le début de
+    `start_year` et la fin de `end_year`, calculés depuis le cache.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier, relatif à `root`.
+    start_year : int
+        Première année (incluse).
+    end_year : int
+        Dernière année (incluse).
+    root : str, optional
+        Répertoire racine. INPUT par défaut.
+    cache_dir : str, optional
+        Répertoire du cache. CACHE_DIR par défaut.
+
+    Returns
+    -------
+    slice
+        Découpage positionnel de la dimension "time".
+
+    """
+    meta = file_metadata(path, root, cache_dir)
+    years = np.array(meta["years"])
+    offsets = meta["offsets"]
+    i0 = int(np.searchsorted(years, start_year, side="left"))
+    i1 = int(np.searchsorted(years, end_year, side="right"))
+    return slice(offsets[i0], offsets[i1])
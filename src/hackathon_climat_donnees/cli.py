@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ligne de commande : python -m hackathon_climat_donnees
+
+    run [étapes] : reconstruit les étapes périmées de la chaîne (cf.
+                   pipeline), ex. run join --workers 2
+    stages       : liste les étapes, leurs dépendances et leur état
+    startup      : mesure le temps d'import des modules du paquet (cf.
+                   instrumentation.startup_times) ; code de retour 1 si un
+                   point d'entrée dépasse le budget de démarrage
+
+Seuls argparse, pipeline et instrumentation sont importés au lancement
+(cf. instrumentation.LIGHT_MODULES) : les dépendances lourdes des étapes
+(xarray, scipy, geopandas...) ne sont chargées qu'à leur exécution, ce qui
+garde `--help` et la planification des tâches immédiats.
+"""
+
+import argparse
+import logging
+
+from hackathon_climat_donnees import pipeline
+from hackathon_climat_donnees.instrumentation import (
+    LIGHT_MODULES,
+    STARTUP_BUDGET,
+    check_startup,
+    startup_times,
+)
+
+
+def _default_stages(args) -> dict:
+    "Etapes de la chaîne paramétrées par les options de la ligne de commande"
+    netcdf_params, join_params, icpe_params = {}, {}, {}
+    if args.scenarios:
+        netcdf_params["scenarios"] = args.scenarios
+    if args.nonstationary:
+        netcdf_params["nonstationary"] = True
+    if args.n_workers:
+        netcdf_params["n_workers"] = args.n_workers
+    if args.statistic:
+        join_params["statistic"] = args.statistic
+    if args.incremental:
+        icpe_params["incremental"] = True
+
+    extra = {}
+    if args.icpe_max_age is not None:
+        extra["icpe_max_age"] = args.icpe_max_age * 86400
+    return pipeline.default_stages(
+        netcdf_params=netcdf_params,
+        join_params=join_params or None,
+        icpe_params=icpe_params,
+        **extra,
+    )
+
+
+def _run(args) -> int:
+    stages = _default_stages(args)
+    force = True if args.force == [] else (args.force or False)
+    print(
+        pipeline.run(
+            args.targets or None,
+            stages,
+            force=force,
+            max_workers=args.workers,
+        )
+    )
+    return 0
+
+
+def _stages(args) -> int:
+    # mêmes paramètres que run : l'état affiché est celui que run
+    # constaterait avec les mêmes options
+    stages = _default_stages(args)
+    status = pipeline.status(stages)
+    for name, stage in stages.items():
+        deps = ", ".join(stage.deps) or "-"
+        print(f"{name:<8} {stage.artifact:<13} {deps:<14} {status[name]}")
+    return 0
+
+
+def _startup(args) -> int:
+    records = startup_times(args.modules or None, repeat=args.repeat)
+    for rec in records:
+        light = "*" if rec["module"] in LIGHT_MODULES else " "
+        heavy = ", ".join(rec["heavy"])
+        module = rec["module"]
+        print(f"{light} {module:<45} {rec['import_s']:7.3f} s  {heavy}")
+    problems = check_startup(records, args.budget)
+    for problem in problems:
+        print(f"budget dépassé : {problem}")
+    return 1 if problems else 0
+
+
+def _add_stage_arguments(command: argparse.ArgumentParser) -> None:
+    "Options de paramétrage des étapes, communes à run et stages"
+    command.add_argument(
+        "--scenarios",
+        nargs="+",
+        help="scénarios à traiter (ex. ssp126 ssp370), ssp370 par défaut",
+    )
+    command.add_argument(
+        "--nonstationary",
+        action="store_true",
+        help="ajustement GEV non-stationnaire",
+    )
+    command.add_argument(
+        "--n-workers",
+        type=int,
+        help="processus d'ajustement (stockage intermédiaire des maxima)",
+    )
+    command.add_argument(
+        "--statistic",
+        choices=["median", "sup", "inf"],
+        help="statistique d'ensemble jointe aux ICPE (median par défaut)",
+    )
+    command.add_argument(
+        "--incremental",
+        action="store_true",
+        help="mise à jour incrémentale du dataset ICPE",
+    )
+    command.add_argument(
+        "--icpe-max-age",
+        type=float,
+        help=(
+            "durée de validité (jours) de l'étape icpe, au-delà de laquelle"
+            " l'inventaire est téléchargé de nouveau (10 par défaut)"
+        ),
+    )
+
+
+def parser() -> argparse.ArgumentParser:
+    "Analyseur des arguments de la ligne de commande"
+    main_parser = argparse.ArgumentParser(
+        prog="python -m hackathon_climat_donnees",
+        description="Chaîne de traitement des niveaux de retour aux ICPE.",
+    )
+    commands = main_parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser(
+        "run", help="reconstruit les étapes périmées de la chaîne"
+    )
+    run.add_argument(
+        "targets",
+        nargs="*",
+        help=(
+            f"étapes à produire ({', '.join(pipeline.default_stages())}),"
+            " toutes par défaut"
+        ),
+    )
+    run.add_argument(
+        "--force",
+        nargs="*",
+        default=None,
+        help="étapes à relancer (toutes si aucune n'est précisée)",
+    )
+    run.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="étapes exécutées simultanément (2 par défaut)",
+    )
+    _add_stage_arguments(run)
+    run.set_defaults(func=_run)
+
+    stages = commands.add_parser(
+        "stages", help="liste les étapes et leur état"
+    )
+    _add_stage_arguments(stages)
+    stages.set_defaults(func=_stages)
+
+    startup = commands.add_parser(
+        "startup", help="mesure le temps d'import des modules"
+    )
+    startup.add_argument(
+        "modules", nargs="*", help="modules à mesurer (tous par défaut)"
+    )
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.add_argument(
+        "--budget",
+        type=float,
+        default=STARTUP_BUDGET,
+        help=f"temps d'import maximal des points d'entrée ({STARTUP_BUDGET})",
+    )
+    startup.set_defaults(func=_startup)
+    return main_parser
+
+
+def main(argv: list[str] = None) -> int:
+    """
+    Point d'entrée de la ligne de commande.
+
+    Parameters
+    ----------
+    argv : list[str], optional
+        Arguments. Par défaut, ceux de la ligne de commande.
+
+    Returns
+    -------
+    int
+        Code de retour.
+
+    """
+    logging.basicConfig(level=logging.INFO)
+    args = parser().parse_args(argv)
+    return args.func(args)
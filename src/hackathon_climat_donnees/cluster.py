@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exécution découpée en blocs (dask) sur un cluster local ou distant
+
+En mode découpé, les fichiers d'entrée sont ouverts par blocs spatiaux (la
+dimension "time" restant entière pour l'ajustement), et les étapes maxima
+annuels -> ajustement GEV -> écriture d'un modèle forment un seul graphe de
+tâches, exécuté par le scheduler dask courant.
+
+Ex.:
+    >>> from hackathon_climat_donnees.cluster import start_client
+    >>> client = start_client(n_workers=4, threads_per_worker=1,
+    ...                       memory_limit="4GB")
+    >>> process_netcdf_bunch(chunks={"y": 64, "x": 64})
+
+    ou, sur un cluster multi-noeuds déjà démarré :
+    >>> client = start_client(address="tcp://scheduler:8786")
+"""
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNKS = {"y": 64, "x": 64}
+
+
+def input_chunks(chunks: dict = None) -> dict:
+    """
+    Découpage à utiliser à l'ouverture des fichiers d'entrée : blocs
+    spatiaux, série temporelle entière.
+
+    Parameters
+    ----------
+    chunks : dict, optional
+        Taille des blocs spatiaux, ex. {"y": 64, "x": 64}. Par défaut,
+        DEFAULT_CHUNKS.
+
+    Returns
+    -------
+    dict
+        Découpage à passer à xr.open_dataset.
+
+    """
+    chunks = dict(DEFAULT_CHUNKS if chunks is None else chunks)
+    chunks["time"] = -1
+    return chunks
+
+
+def start_client(
+    address: str = None,
+    n_workers: int = None,
+    threads_per_worker: int = None,
+    processes: bool = True,
+    memory_limit: str = "auto",
+    **kwargs,
+):
+    """
+    Démarre (ou rejoint) un cluster dask et en fait le scheduler par défaut.
+
+    Parameters
+    ----------
+    address : str, optional
+        Adresse d'un scheduler existant (cluster multi-noeuds), ex.
+        "tcp://scheduler:8786". Si None, un cluster local est démarré.
+    n_workers : int, optional
+        Nombre de workers du cluster local. Par défaut, choisi par dask.
+    threads_per_worker : int, optional
+        Nombre de threads par worker. Par défaut, choisi par dask.
+    processes : bool, optional
+        Si True, les workers sont des processus (recommandé pour
+        l'ajustement GEV, peu compatible avec le GIL). True par défaut.
+    memory_limit : str, optional
+        Limite mémoire par worker, ex. "4GB". "auto" par défaut.
+    **kwargs
+        Arguments supplémentaires transmis à distributed.LocalCluster.
+
+    Returns
+    -------
+    client : distributed.Client
+        Client connecté au cluster.
+
+    """
+    from distributed import Client, LocalCluster
+
+    if address is not None:
+        client = Client(address)
+    else:
+        cluster = LocalCluster(
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            processes=processes,
+            memory_limit=memory_limit,
+            **kwargs,
+        )
+        client = Client(cluster)
+    logger.info("Cluster dask : %s", client.dashboard_link)
+    return client
@@ -3,6 +3,7 @@
 """
 Constantes
 """
+
 # Seuils GEREP :
 # https://www.legifrance.gouv.fr/loda/article_lc/LEGIARTI000041615540
 # nota : certaines substances n'ont pas été retrouvées pour l'eau dans IREP,
@@ -167,3 +168,20 @@ GEREP_THRESHOLDS = {
         "Zinc et composés (exprimés en tant que Zn)": 100,
     },
 }
+
+# Durée de conservation des réponses HTTP (Géorisques) en cache, en secondes.
+# C'est aussi la durée de validité de l'étape icpe de la chaîne (cf.
+# pipeline) : la relancer plus tôt relirait les mêmes réponses
+CACHE_DURATION_SECONDS = 60 * 60 * 24 * 10
+
+# Points d'ancrage historiques {année: niveau de réchauffement en °C} utilisés
+# pour construire la covariable des ajustements GEV non-stationnaires, en
+# complément des années pivots TRACC de chaque modèle. Les niveaux TRACC
+# (+2 / +2,7 / +4 °C) sont des niveaux de réchauffement de la France
+# métropolitaine, et non du globe : les ancrages sont donc exprimés sur la
+# même échelle, réchauffement observé en France par rapport à 1900-1930
+# (période de référence pré-industrielle de la TRACC) :
+#   1900-1930 : 0 (définition), attribué à l'année centrale 1915
+#   2020 : 1,66 °C (Ribes et al. 2022, Earth Syst. Dynam. 13, 1397-1415,
+#          estimation retenue par Météo-France pour la TRACC)
+RWL_HIST_ANCHORS = {1915: 0.0, 2020: 1.66}
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Diagnostics de qualité des ajustements GEV, pour toutes les mailles
+
+A partir des maxima annuels et des paramètres ajustés (convention scipy :
+c, loc, scale, avec xi = -c), les statistiques suivantes sont calculées
+pour toutes les mailles à la fois, par opérations sur tableaux (séries
+triées, effectifs variables gérés par masque) :
+
+* n_years : nombre de maxima annuels utilisés
+* ks_stat : statistique de Kolmogorov-Smirnov
+* ad_stat : statistique d'Anderson-Darling (A²)
+* ppcc : corrélation du diagramme de probabilité (positions de Gringorten)
+* shape_ok : paramètre de forme dans XI_BOUNDS
+* valid_fit : paramètres finis, échelle positive, effectif suffisant et
+  toutes les observations dans le support de la loi ajustée (validité du
+  résultat, et non convergence de l'optimiseur, que scipy ne renvoie pas
+  pour genextreme.fit ; cf. "converged" des ajustements non-stationnaires)
+* fit_ok : synthèse des indicateurs précédents
+
+Les diagnostics sont écrits avec les niveaux de retour de chaque modèle et
+peuvent servir à exclure les mailles mal ajustées des statistiques
+d'ensemble (process_netcdf_bunch(mask_poor_fits=True)).
+"""
+
+import logging
+
+import numpy as np
+import xarray as xr
+from scipy.stats import genextreme as gev
+
+from hackathon_climat_donnees.nonstationary import XI_BOUNDS
+
+logger = logging.getLogger(__name__)
+
+DIAGNOSTICS = [
+    "n_years",
+    "ks_stat",
+    "ad_stat",
+    "ppcc",
+    "shape_ok",
+    "valid_fit",
+    "fit_ok",
+]
+
+# effectif minimal (cf. RP_calcul_vectorized)
+MIN_YEARS = 5
+
+# seuil de corrélation du diagramme de probabilité
+PPCC_MIN = 0.95
+
+# valeur critique de Kolmogorov-Smirnov à 5 % : KS_COEF / sqrt(n)
+KS_COEF = 1.36
+
+# seuil sur A² (5 %, paramètres estimés, ordre de grandeur GEV)
+AD_MAX = 0.757
+
+_EPS = 1e-12
+
+
+def gev_diagnostics_array(
+    extremes: np.ndarray, params: np.ndarray
+) -> np.ndarray:
+    """
+    Diagnostics d'ajustement sur des tableaux numpy.
+
+    Parameters
+    ----------
+    extremes : np.ndarray
+        Maxima annuels, de forme (..., time) ; les NaN sont ignorés.
+    params : np.ndarray
+        Paramètres GEV (c, loc, scale), de forme (..., 3).
+
+    Returns
+    -------
+    np.ndarray
+        Diagnostics de forme (..., len(DIAGNOSTICS)), dans l'ordre de
+        DIAGNOSTICS (les indicateurs booléens valent 0 ou 1).
+
+    """
+    extremes = np.asarray(extremes, dtype="float64")
+    params = np.asarray(params, dtype="float64")
+    shape = extremes.shape[:-1]
+    x = extremes.reshape(-1, extremes.shape[-1])
+    c, loc, scale = (p[:, None] for p in params.reshape(-1, 3).T)
+
+    # séries triées, NaN en fin de série
+    x = np.sort(x, axis=-1)
+    n = np.isfinite(x).sum(axis=-1)
+    i = np.arange(1, x.shape[-1] + 1)[None, :]
+    valid = i <= n[:, None]
+    nn = np.maximum(n, 1)[:, None]
+
+    finite = np.isfinite(c) & np.isfinite(loc) & np.isfinite(scale)
+    finite &= np.where(np.isfinite(scale), scale, 0) > 0
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        F = gev.cdf(x, c, loc, np.where(finite, scale, 1))
+        in_support = np.where(valid, (F > 0) & (F < 1), True).all(axis=-1)
+        F = np.clip(F, _EPS, 1 - _EPS)
+
+        # Kolmogorov-Smirnov
+        d = np.maximum(i / nn - F, F - (i - 1) / nn)
+        ks = np.where(valid, d, -np.inf).max(axis=-1)
+
+        # Anderson-Darling : F_(n+1-i) par indexation inversée
+        rev = np.clip(n[:, None] - i, 0, x.shape[-1] - 1)
+        F_rev = np.take_along_axis(F, rev, axis=-1)
+        terms = (2 * i - 1) * (np.log(F) + np.log1p(-F_rev))
+        ad = -n - np.where(valid, terms, 0).sum(axis=-1) / nn[:, 0]
+
+        # corrélation du diagramme de probabilité
+        p = (i - 0.44) / (nn + 0.12)
+        q = gev.ppf(p, c, loc, np.where(finite, scale, 1))
+        w = valid.astype("float64")
+        xm = (np.where(valid, x, 0) * w).sum(axis=-1, keepdims=True) / nn
+        qm = (np.where(valid, q, 0) * w).sum(axis=-1, keepdims=True) / nn
+        dx = np.where(valid, x - xm, 0)
+        dq = np.where(valid, q - qm, 0)
+        ppcc = (dx * dq).sum(axis=-1) / np.sqrt(
+            (dx**2).sum(axis=-1) * (dq**2).sum(axis=-1)
+        )
+
+    xi = -c[:, 0]
+    shape_ok = (xi >= XI_BOUNDS[0]) & (xi <= XI_BOUNDS[1])
+    valid_fit = finite[:, 0] & (n >= MIN_YEARS) & in_support
+    fit_ok = (
+        valid_fit
+        & shape_ok
+        & (ppcc >= PPCC_MIN)
+        & (ks <= KS_COEF / np.sqrt(np.maximum(n, 1)))
+        & (ad <= AD_MAX)
+    )
+
+    ks, ad, ppcc = (np.where(valid_fit, v, np.nan) for v in (ks, ad, ppcc))
+    result = np.stack(
+        [n, ks, ad, ppcc, shape_ok, valid_fit, fit_ok], axis=-1
+    ).astype("float64")
+    return result.reshape(shape + (len(DIAGNOSTICS),))
+
+
+def gev_diagnostics(
+    maximums: xr.DataArray, params: xr.DataArray
+) -> xr.Dataset:
+    """
+    Diagnostics d'ajustement GEV de toutes les mailles.
+
+    Parameters
+    ----------
+    maximums : xr.DataArray
+        Maxima annuels de dimensions (time, y, x), éventuellement découpés
+        (dask).
+    params : xr.DataArray
+        Paramètres ajustés, de dimensions (y, x, gev_params).
+
+    Returns
+    -------
+    xr.Dataset
+        Une variable (y, x) par diagnostic (cf. DIAGNOSTICS).
+
+    """
+    if maximums.chunks:
+        maximums = maximums.chunk({"time": -1})
+        params = params.chunk({"gev_params": -1})
+    diag = xr.apply_ufunc(
+        gev_diagnostics_array,
+        maximums,
+        params,
+        input_core_dims=[["time"], ["gev_params"]],
+        output_core_dims=[["diagnostic"]],
+        dask="parallelized",
+        output_dtypes=[float],
+        dask_gufunc_kwargs={"output_sizes": {"diagnostic": len(DIAGNOSTICS)}},
+    )
+    ds = diag.assign_coords(diagnostic=DIAGNOSTICS).to_dataset("diagnostic")
+    for name in ["shape_ok", "valid_fit", "fit_ok"]:
+        ds[name] = ds[name].astype(bool)
+    ds["n_years"] = ds["n_years"].astype("int16")
+    return ds
+
+
+def mask_cells(ds: xr.Dataset, flag: str = "fit_ok") -> xr.Dataset:
+    """
+    Remplace par NaN les niveaux de retour des mailles mal ajustées.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Résultats d'un modèle (return_levels et diagnostics).
+    flag : str, optional
+        Indicateur à utiliser. "fit_ok" par défaut ; à défaut, "converged"
+        (ajustements non-stationnaires).
+
+    Returns
+    -------
+    xr.Dataset
+        Dataset dont les niveaux de retour sont masqués.
+
+    """
+    if flag not in ds:
+        flag = "converged"
+    if flag not in ds:
+        return ds
+    ok = ds[flag].astype(bool)
+    logger.info("%s mailles exclues sur %s", int((~ok).sum()), int(ok.size))
+    return ds.assign(return_levels=ds["return_levels"].where(ok))
@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Statistiques d'ensemble à la demande (sous-ensembles de modèles, poids)
+
+Les niveaux de retour par modèle produits par netcdf_processing
+(<var>_RP_hist_<modèle>.nc, <var>_RP_<ssp>_<modèle>_+<RWL>.nc,
+<var>_RP_ns_<ssp>_<modèle>.nc) sont empilés une seule fois dans un tableau
+
+    (scénario, modèle, maille, période)   float32
+
+conservé sur disque (<OUTPUT>/ensemble/<var>.f32 + en-tête JSON, relu par
+np.memmap) et reconstruit seulement si les fichiers par modèle changent.
+L'indicateur de qualité d'ajustement de chaque maille ("fit_ok", ou
+"converged" en non-stationnaire, cf. diagnostics.mask_cells) est empilé de
+la même façon (<var>.ok, (scénario, modèle, maille)) pour pouvoir exclure
+les mauvais ajustements comme process_netcdf_bunch(mask_poor_fits=True).
+Médiane et quantiles multi-modèles sont ensuite recalculés en mémoire pour
+n'importe quel sous-ensemble de modèles, avec ou sans poids, sur toute la
+grille ou sur quelques mailles.
+
+Ex.:
+    >>> stack = EnsembleStack.load()
+    >>> models = stack.select(exclude={"rcm": ["RACMO23E"]})
+    >>> ds = stack.statistics(models=models, mask_poor_fits=True)
+    >>> weights = {"EC-Earth3__r1i1p1f1__RACMO23E": 2}
+    >>> df = stack.site_statistics(gdf, weights=weights)
+"""
+
+import json
+import logging
+import os
+import re
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from hackathon_climat_donnees import OUTPUT
+
+logger = logging.getLogger(__name__)
+
+STACK_DIR = os.path.join(OUTPUT, "ensemble")
+
+# statistiques de compute_final_statistics : médiane, 95 % (sup), 5 % (inf)
+QUANTILES = {"median": 0.5, "sup": 0.95, "inf": 0.05}
+
+MODEL_PATTERN = re.compile(
+    r"^(?P<var>[^_]+)_RP_(?:"
+    r"hist_(?P<hist>[^_]+__[^_]+__[^_]+)"
+    r"|(?P<label>ssp\d)_(?P<ssp>[^_]+__[^_]+__[^_]+)_\+(?P<rwl>[^_]+)"
+    r"|ns_(?:(?P<ns_label>ssp\d)_)?(?P<ns>[^_]+__[^_]+__[^_]+)"
+    r")\.nc$"
+)
+
+
+def parse_model_output(path: str) -> tuple[str, str]:
+    """
+    Scénario et modèle d'un fichier de résultats par modèle.
+
+    Ex. : "tasmaxAdjust_RP_ssp3_EC-Earth3__r1i1p1f1__RACMO23E_+2C.nc"
+        -> ("ssp3_+2C", "EC-Earth3__r1i1p1f1__RACMO23E")
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier.
+
+    Returns
+    -------
+    tuple[str, str]
+        Scénario (nommé comme les fichiers d'ensemble : "hist_ref",
+        "ssp3_+2C", "ns_ssp3"...) et clé du modèle ; None si le fichier n'est pas
+        un fichier par modèle.
+
+    """
+    match = MODEL_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return None
+    if match["hist"]:
+        return "hist_ref", match["hist"]
+    if match["ssp"]:
+        return f"{match['label']}_+{match['rwl']}", match["ssp"]
+    if match["ns_label"]:
+        return f"ns_{match['ns_label']}", match["ns"]
+    return "ns", match["ns"]
+
+
+def _fingerprint(paths: list[str]) -> list:
+    return [
+        [os.path.basename(p), os.path.getsize(p), os.path.getmtime(p)]
+        for p in paths
+    ]
+
+
+def nan_quantiles(
+    values: np.ndarray, qs: list[float], axis: int = 0
+) -> np.ndarray:
+    """
+    Quantiles le long d'un axe en ignorant les NaN, avec les conventions
+    de np.nanquantile (interpolation linéaire) mais sans boucle par
+    série : le tableau est trié une seule fois pour tous les quantiles.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Valeurs.
+    qs : list[float]
+        Quantiles, entre 0 et 1.
+    axis : int, optional
+        Axe de calcul. 0 par défaut.
+
+    Returns
+    -------
+    np.ndarray
+        Quantiles, de forme (len(qs), ...) ; NaN là où toutes les valeurs
+        sont NaN.
+
+    """
+    v = np.sort(np.moveaxis(values, axis, -1), axis=-1)  # NaN en fin
+    n = np.isfinite(v).sum(axis=-1, keepdims=True)
+    out = []
+    for q in qs:
+        index = q * np.maximum(n - 1, 0)
+        lo = np.floor(index).astype(int)
+        hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+        v_lo = np.take_along_axis(v, lo, axis=-1)
+        v_hi = np.take_along_axis(v, hi, axis=-1)
+        result = v_lo + (index - lo) * (v_hi - v_lo)
+        out.append(np.where(n > 0, result, np.nan)[..., 0])
+    return np.stack(out)
+
+
+def weighted_quantiles(
+    values: np.ndarray, weights: np.ndarray, qs: list[float], axis: int = 0
+) -> np.ndarray:
+    """
+    Quantiles pondérés le long d'un axe, en ignorant les NaN.
+
+    Chaque valeur triée est placée à la position (poids cumulé - poids) /
+    (poids total - poids de la plus grande valeur), puis les quantiles sont
+    interpolés linéairement entre ces positions : à poids égaux, les
+    positions sont (i - 1) / (n - 1), comme pour nan_quantiles et
+    np.nanquantile (interpolation linéaire).
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Valeurs.
+    weights : np.ndarray
+        Poids (positifs), de la taille de `values` le long de `axis`.
+    qs : list[float]
+        Quantiles, entre 0 et 1.
+    axis : int, optional
+        Axe de calcul. 0 par défaut.
+
+    Returns
+    -------
+    np.ndarray
+        Quantiles, de forme (len(qs), ...) ; NaN là où toutes les valeurs
+        sont NaN.
+
+    """
+    values = np.moveaxis(np.asarray(values, dtype="float64"), axis, -1)
+    w = np.broadcast_to(np.asarray(weights, dtype="float64"), values.shape)
+    w = np.where(np.isnan(values), 0, w)
+
+    # tri des valeurs, celles de poids nul (ou NaN) en fin de série
+    order = np.argsort(np.where(w > 0, values, np.inf), axis=-1)
+    v = np.take_along_axis(values, order, axis=-1)
+    w = np.take_along_axis(w, order, axis=-1)
+    n = (w > 0).sum(axis=-1, keepdims=True)
+    cum = np.cumsum(w, axis=-1)
+    w_last = np.take_along_axis(w, np.maximum(n - 1, 0), axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pos = np.where(w > 0, (cum - w) / (cum[..., -1:] - w_last), np.inf)
+
+    out = []
+    for q in qs:
+        # encadrement de q par deux positions consécutives
+        hi = (pos < q).sum(axis=-1, keepdims=True)
+        hi = np.clip(hi, 1, np.maximum(n - 1, 1))
+        hi = np.minimum(hi, v.shape[-1] - 1)
+        lo = np.maximum(hi - 1, 0)
+        p_lo = np.take_along_axis(pos, lo, axis=-1)
+        p_hi = np.take_along_axis(pos, hi, axis=-1)
+        v_lo = np.take_along_axis(v, lo, axis=-1)
+        v_hi = np.take_along_axis(v, hi, axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.clip((q - p_lo) / (p_hi - p_lo), 0, 1)
+        result = np.where(n > 1, v_lo + t * (v_hi - v_lo), v_lo)
+        out.append(np.where(n > 0, result, np.nan)[..., 0])
+    return np.stack(out)
+
+
+class EnsembleStack:
+    """
+    Niveaux de retour de tous les modèles, empilés.
+
+    Attributes
+    ----------
+    values : np.ndarray
+        Tableau (scénario, modèle, maille, période), éventuellement
+        np.memmap ; NaN pour les couples (scénario, modèle) absents.
+    fit_ok : np.ndarray
+        Tableau booléen (scénario, modèle, maille) : qualité d'ajustement
+        (cf. diagnostics.mask_cells) ; None si inconnue.
+    scenarios, models : list[str]
+        Libellés des deux premiers axes.
+    periods, x, y : np.ndarray
+        Périodes de retour et coordonnées de la grille (EPSG:27572).
+    coords_2d : dict
+        Coordonnées 2D (lat, lon) de la grille.
+
+    """
+
+    def __init__(
+        self, values, scenarios, models, periods, x, y, coords_2d, fit_ok=None
+    ):
+        self.values = values
+        self.fit_ok = fit_ok
+        self.scenarios = list(scenarios)
+        self.models = list(models)
+        self.periods = np.asarray(periods)
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.coords_2d = coords_2d
+        self._tree = None
+
+    @classmethod
+    def from_files(cls, paths: list[str]) -> "EnsembleStack":
+        """
+        Empile des fichiers de résultats par modèle (même grille).
+
+        Parameters
+        ----------
+        paths : list[str]
+            Fichiers par modèle.
+
+        Returns
+        -------
+        EnsembleStack
+
+        """
+        entries = {}
+        flags = {}
+        for path in paths:
+            with xr.open_dataset(path) as ds:
+                rl = ds["return_levels"]
+                scenario, model = parse_model_output(path)
+                extra = [d for d in rl.dims if d not in ("y", "x", "periods")]
+                rl = rl.transpose(*extra, "y", "x", "periods")
+                # même indicateur que diagnostics.mask_cells
+                flag = "fit_ok" if "fit_ok" in ds else "converged"
+                ok = (
+                    ds[flag].astype(bool)
+                    if flag in ds
+                    else xr.ones_like(rl.isel(periods=0), dtype=bool)
+                )
+                ok = ok.broadcast_like(rl.isel(periods=0)).transpose(
+                    *extra, "y", "x"
+                )
+                if extra:
+                    # non-stationnaire : un scénario par niveau de
+                    # réchauffement
+                    for label, block, block_ok in zip(
+                        rl[extra[0]].values, rl.values, ok.values
+                    ):
+                        key = (f"{scenario}_+{label:g}C", model)
+                        entries[key] = block
+                        flags[key] = block_ok
+                else:
+                    entries[(scenario, model)] = rl.values
+                    flags[(scenario, model)] = ok.values
+                if path == paths[0]:
+                    grid = {
+                        name: ds[name].values
+                        for name in ["periods", "x", "y", "lat", "lon"]
+                        if name in ds.coords
+                    }
+
+        scenarios = sorted({s for s, _ in entries})
+        models = sorted({m for _, m in entries})
+        ny, nx, nperiods = next(iter(entries.values())).shape
+        values = np.full(
+            (len(scenarios), len(models), ny * nx, nperiods),
+            np.nan,
+            dtype=np.float32,
+        )
+        fit_ok = np.zeros(values.shape[:3], dtype=bool)
+        for (scenario, model), block in entries.items():
+            i, j = scenarios.index(scenario), models.index(model)
+            values[i, j] = block.reshape(ny * nx, nperiods)
+            fit_ok[i, j] = flags[(scenario, model)].ravel()
+        coords_2d = {k: grid[k] for k in ["lat", "lon"] if k in grid}
+        return cls(
+            values,
+            scenarios,
+            models,
+            grid["periods"],
+            grid["x"],
+            grid["y"],
+            coords_2d,
+            fit_ok,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        output_dir: str = OUTPUT,
+        var: str = "tasmaxAdjust",
+        stack_dir: str = STACK_DIR,
+    ) -> "EnsembleStack":
+        """
+        Charge l'empilement depuis le cache disque (np.memmap), en le
+        reconstruisant si les fichiers par modèle ont changé.
+
+        Parameters
+        ----------
+        output_dir : str, optional
+            Répertoire des fichiers par modèle. OUTPUT par défaut.
+        var : str, optional
+            Variable. "tasmaxAdjust" par défaut.
+        stack_dir : str, optional
+            Répertoire du cache. STACK_DIR par défaut.
+
+        Returns
+        -------
+        EnsembleStack
+
+        """
+        paths = sorted(
+            p
+            for p in glob(os.path.join(output_dir, f"{var}_RP_*.nc"))
+            if parse_model_output(p) is not None
+        )
+        if not paths:
+            raise ValueError(f"aucun fichier par modèle dans {output_dir}")
+        fingerprint = _fingerprint(paths)
+
+        base = os.path.join(stack_dir, var)
+        if all(os.path.exists(base + ext) for ext in [".json", ".f32", ".ok"]):
+            with open(base + ".json", encoding="utf8") as f:
+                header = json.load(f)
+            if header["fingerprint"] == fingerprint:
+                values = np.memmap(
+                    base + ".f32",
+                    dtype="float32",
+                    mode="r",
+                    shape=tuple(header["shape"]),
+                )
+                fit_ok = np.memmap(
+                    base + ".ok",
+                    dtype="bool",
+                    mode="r",
+                    shape=tuple(header["shape"][:3]),
+                )
+                coords_2d = {}
+                if os.path.exists(base + ".npz"):
+                    with np.load(base + ".npz") as npz:
+                        coords_2d = {k: npz[k] for k in npz.files}
+                return cls(
+                    values,
+                    header["scenarios"],
+                    header["models"],
+                    header["periods"],
+                    header["x"],
+                    header["y"],
+                    coords_2d,
+                    fit_ok,
+                )
+
+        logger.info("Empilement de %s fichiers par modèle", len(paths))
+        stack = cls.from_files(paths)
+        os.makedirs(stack_dir, exist_ok=True)
+        # écriture dans un fichier temporaire puis renommage (cf.
+        # maxima_store)
+        stack.values.tofile(base + ".f32.tmp")
+        os.replace(base + ".f32.tmp", base + ".f32")
+        stack.fit_ok.tofile(base + ".ok.tmp")
+        os.replace(base + ".ok.tmp", base + ".ok")
+        if stack.coords_2d:
+            np.savez(base + ".npz", **stack.coords_2d)
+        header = {
+            "shape": list(stack.values.shape),
+            "scenarios": stack.scenarios,
+            "models": stack.models,
+            "periods": stack.periods.tolist(),
+            "x": stack.x.tolist(),
+            "y": stack.y.tolist(),
+            "fingerprint": fingerprint,
+        }
+        with open(base + ".json", "w", encoding="utf8") as f:
+            json.dump(header, f)
+        return stack
+
+    def model_table(self) -> pd.DataFrame:
+        "Table des modèles (GCM, membre, RCM), indexée par clé de modèle"
+        return pd.DataFrame(
+            [m.split("__") for m in self.models],
+            index=pd.Index(self.models, name="model"),
+            columns=["gcm", "member", "rcm"],
+        )
+
+    def select(self, include: dict = None, exclude: dict = None) -> list[str]:
+        """
+        Sous-ensemble de modèles.
+
+        Parameters
+        ----------
+        include : dict, optional
+            Critères à satisfaire, ex. {"gcm": ["CNRM-ESM2-1"]}. Tous les
+            modèles par défaut.
+        exclude : dict, optional
+            Critères d'exclusion, ex. {"rcm": ["RACMO23E"]}.
+
+        Returns
+        -------
+        list[str]
+            Clés des modèles retenus.
+
+        """
+        table = self.model_table()
+        keep = np.ones(len(table), dtype=bool)
+        for column, values in (include or {}).items():
+            keep &= table[column].isin(np.atleast_1d(values)).to_numpy()
+        for column, values in (exclude or {}).items():
+            keep &= ~table[column].isin(np.atleast_1d(values)).to_numpy()
+        return table.index[keep].tolist()
+
+    def _reduce(
+        self, values, models, weights, quantiles, fit_ok=None
+    ) -> np.ndarray:
+        "Statistiques le long de l'axe modèle (axe 1) d'un sous-tableau"
+        idx = [self.models.index(m) for m in models]
+        values = np.asarray(values[:, idx], dtype="float64")
+        if fit_ok is not None:
+            # mailles mal ajustées exclues, comme diagnostics.mask_cells
+            values[~np.asarray(fit_ok[:, idx], dtype=bool)] = np.nan
+        qs = list(quantiles.values())
+        w = np.array([(weights or {}).get(m, 1.0) for m in models])
+        if np.all(w == w[0]):
+            # poids uniformes : mêmes conventions que
+            # compute_final_statistics (xarray : NaN ignorés, interpolation
+            # linéaire)
+            return nan_quantiles(values, qs, axis=1)
+        return weighted_quantiles(values, w, qs, axis=1)
+
+    def statistics(
+        self,
+        models: list[str] = None,
+        weights: dict = None,
+        scenarios: list[str] = None,
+        quantiles: dict = None,
+        mask_poor_fits: bool = False,
+    ) -> xr.Dataset:
+        """
+        Médiane et quantiles multi-modèles sur toute la grille.
+
+        Parameters
+        ----------
+        models : list[str], optional
+            Modèles retenus (cf. select). Tous par défaut.
+        weights : dict, optional
+            Poids par modèle ({clé: poids}, 1 par défaut pour les modèles
+            non cités). Sans poids ou à poids égaux, les statistiques sont
+            identiques à celles de compute_final_statistics avec la même
+            valeur de mask_poor_fits.
+        scenarios : list[str], optional
+            Scénarios retenus. Tous par défaut.
+        quantiles : dict, optional
+            Statistiques à calculer, {nom: quantile}. QUANTILES par défaut.
+        mask_poor_fits : bool, optional
+            Si True, exclut les mailles mal ajustées (fit_ok) de chaque
+            modèle, comme process_netcdf_bunch(mask_poor_fits=True). False
+            par défaut.
+
+        Returns
+        -------
+        xr.Dataset
+            "return_levels" de dimensions (statistic, scenario, y, x,
+            periods).
+
+        """
+        models = self.models if models is None else list(models)
+        scenarios = self.scenarios if scenarios is None else list(scenarios)
+        quantiles = QUANTILES if quantiles is None else quantiles
+        s_idx = [self.scenarios.index(s) for s in scenarios]
+        fit_ok = self._fit_ok(mask_poor_fits)
+
+        result = self._reduce(
+            self.values[s_idx],
+            models,
+            weights,
+            quantiles,
+            None if fit_ok is None else fit_ok[s_idx],
+        ).reshape(
+            len(quantiles),
+            len(scenarios),
+            len(self.y),
+            len(self.x),
+            len(self.periods),
+        )
+        coords = {
+            "statistic": list(quantiles),
+            "scenario": scenarios,
+            "y": self.y,
+            "x": self.x,
+            "periods": self.periods,
+        }
+        for name, value in self.coords_2d.items():
+            coords[name] = (("y", "x"), value)
+        return xr.Dataset(
+            {
+                "return_levels": (
+                    ("statistic", "scenario", "y", "x", "periods"),
+                    result,
+                )
+            },
+            coords=coords,
+        )
+
+    def _fit_ok(self, mask_poor_fits: bool) -> np.ndarray:
+        "Indicateur de qualité d'ajustement à appliquer, None sinon"
+        if not mask_poor_fits:
+            return None
+        if self.fit_ok is None:
+            raise ValueError("qualité d'ajustement inconnue (fit_ok)")
+        return self.fit_ok
+
+    def nearest_cells(self, gdf) -> np.ndarray:
+        """
+        Maille la plus proche (indice aplati y, x) de chaque site, parmi les
+        mailles renseignées.
+
+        Parameters
+        ----------
+        gdf : gpd.GeoDataFrame
+            Sites.
+
+        Returns
+        -------
+        np.ndarray
+            Indices des mailles.
+
+        """
+        if self._tree is None:
+            # index des centres de mailles (Lambert 93), construit une fois
+            from pyproj import Transformer
+            from scipy.spatial import cKDTree
+
+            xx, yy = np.meshgrid(self.x, self.y)
+            valid = np.isfinite(self.values).any(axis=(0, 1, 3))
+            self._valid = np.flatnonzero(valid)
+            to_2154 = Transformer.from_crs(27572, 2154, always_xy=True)
+            cx, cy = to_2154.transform(
+                xx.ravel()[self._valid], yy.ravel()[self._valid]
+            )
+            self._tree = cKDTree(np.column_stack([cx, cy]))
+
+        geoms = gdf.geometry.to_crs(2154)
+        _, nearest = self._tree.query(np.column_stack([geoms.x, geoms.y]))
+        return self._valid[nearest]
+
+    def site_statistics(
+        self,
+        gdf,
+        models: list[str] = None,
+        weights: dict = None,
+        scenarios: list[str] = None,
+        quantiles: dict = None,
+        id_col: str = "code_aiot",
+        mask_poor_fits: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Médiane et quantiles multi-modèles pour un ensemble de sites (seules
+        les mailles des sites sont lues).
+
+        Parameters
+        ----------
+        gdf : gpd.GeoDataFrame
+            Sites.
+        models, weights, scenarios, quantiles
+            Cf. statistics.
+        id_col : str, optional
+            Colonne identifiant les sites. "code_aiot" par défaut.
+        mask_poor_fits : bool, optional
+            Cf. statistics. False par défaut.
+
+        Returns
+        -------
+        pd.DataFrame
+            Index (id_col, scenario, statistic), une colonne par période de
+            retour.
+
+        """
+        models = self.models if models is None else list(models)
+        scenarios = self.scenarios if scenarios is None else list(scenarios)
+        quantiles = QUANTILES if quantiles is None else quantiles
+        s_idx = [self.scenarios.index(s) for s in scenarios]
+        cells = self.nearest_cells(gdf)
+        fit_ok = self._fit_ok(mask_poor_fits)
+
+        values = self.values[s_idx][:, :, cells]
+        result = self._reduce(
+            values,
+            models,
+            weights,
+            quantiles,
+            None if fit_ok is None else fit_ok[s_idx][:, :, cells],
+        )
+        # (statistique, scénario, site, période) -> (site, scénario, stat.)
+        result = result.transpose(2, 1, 0, 3).reshape(-1, len(self.periods))
+        index = pd.MultiIndex.from_product(
+            [gdf[id_col].to_numpy(), scenarios, list(quantiles)],
+            names=[id_col, "scenario", "statistic"],
+        )
+        return pd.DataFrame(
+            result, index=index, columns=[str(p) for p in self.periods]
+        )
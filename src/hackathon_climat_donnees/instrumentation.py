@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation légère du pipeline : temps, mémoire et débit par étape
+
+Chaque étape (ouverture, conversion, maxima annuels, ajustement, écriture,
+statistiques d'ensemble, jointure, téléchargement, risques...) est encadrée
+par le gestionnaire de contexte `stage`, qui enregistre :
+
+* le temps écoulé (wall) et le temps CPU
+* la variation de mémoire résidente (RSS) pendant l'étape, l'augmentation
+  du pic de RSS du processus due à l'étape (nulle si un pic antérieur
+  n'est pas dépassé) et ce pic lui-même
+* le volume lu sur disque (psutil ou /proc/self/io, ou renseigné par
+  l'appelant) ; None si aucune de ces sources n'est disponible (psutil
+  absent hors Linux, par exemple)
+* le nombre de mailles traitées par seconde (si renseigné)
+
+Les mesures sont émises en lignes JSON (un fichier, optionnel) et peuvent
+être résumées sous forme de tableau, par étape ou par étape et par modèle.
+
+Le temps d'import des modules du paquet est mesuré à part (startup_times,
+ou python -m hackathon_climat_donnees startup) : les points d'entrée
+(LIGHT_MODULES) ne doivent charger aucune dépendance lourde.
+
+Ex.:
+    >>> from hackathon_climat_donnees import instrumentation
+    >>> instrumentation.configure(path="metrics.jsonl", profile_model="...")
+    >>> with instrumentation.stage("fit", model="...", cells=8981):
+    ...     ...
+    >>> print(instrumentation.summary())
+"""
+
+import cProfile
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from typing import TYPE_CHECKING
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = [
+    "open",
+    "convert",
+    "annual_max",
+    "fit",
+    "diagnostics",
+    "extract",
+    "write",
+    "ensemble",
+    "join",
+    "download",
+    "read",
+    "hazards",
+    "export",
+]
+
+# dépendances dont le chargement coûte de quelques dixièmes de seconde à
+# plusieurs secondes
+HEAVY_MODULES = [
+    "numpy",
+    "pandas",
+    "xarray",
+    "scipy",
+    "geopandas",
+    "pyogrio",
+    "polars",
+    "dask",
+    "requests_cache",
+]
+
+# modules chargés au lancement de la ligne de commande ou des workers, qui
+# ne doivent importer aucun de HEAVY_MODULES
+LIGHT_MODULES = [
+    "hackathon_climat_donnees",
+    "hackathon_climat_donnees.cli",
+    "hackathon_climat_donnees.pipeline",
+    "hackathon_climat_donnees.instrumentation",
+    "hackathon_climat_donnees.cluster",
+]
+
+# temps d'import maximal (s) des LIGHT_MODULES
+STARTUP_BUDGET = 0.2
+
+
+class Recorder:
+    """
+    Collecteur des mesures d'exécution.
+
+    Parameters
+    ----------
+    path : str, optional
+        Fichier JSON lines dans lequel ajouter chaque mesure. Si None, les
+        mesures sont seulement conservées en mémoire.
+    profile_model : str, optional
+        Modèle (clé "GCM__RCM") pour lequel activer cProfile. Le profil est
+        écrit à côté de `path` (ou dans le répertoire courant).
+
+    """
+
+    def __init__(self, path: str = None, profile_model: str = None):
+        self.path = path
+        self.profile_model = profile_model
+        self.records = []
+
+    def emit(self, record: dict) -> None:
+        self.records.append(record)
+        logger.debug("metrics %s", record)
+        if self.path:
+            with open(self.path, "a", encoding="utf8") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+RECORDER = Recorder()
+
+
+def configure(path: str = None, profile_model: str = None) -> Recorder:
+    """
+    (Ré)initialise le collecteur global.
+
+    Parameters
+    ----------
+    path : str, optional
+        Fichier JSON lines de sortie. None par défaut (mémoire seulement).
+    profile_model : str, optional
+        Modèle à profiler avec cProfile. None par défaut.
+
+    Returns
+    -------
+    Recorder
+        Le nouveau collecteur global.
+
+    """
+    global RECORDER
+    RECORDER = Recorder(path, profile_model)
+    return RECORDER
+
+
+def _rss_mb() -> float:
+    "Mémoire résidente actuelle du processus, en Mo"
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024**2
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return float("nan")
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+def _peak_rss_mb() -> float:
+    "Pic de mémoire résidente du processus depuis son lancement, en Mo"
+    if resource is not None:
+        # ko sous linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1024**2
+    return float("nan")
+
+
+def _read_bytes() -> int:
+    "Volume lu sur disque par le processus (None si indisponible)"
+    if psutil is not None:
+        try:
+            return psutil.Process().io_counters().read_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("read_bytes:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+@contextmanager
+def stage(name: str, model: str = None, cells: int = None, **extra):
+    """
+    Mesure une étape du pipeline.
+
+    Le dictionnaire renvoyé peut être complété dans le bloc (par exemple
+    `rec["cells"] = ...` ou `rec["bytes_read"] = ...`) ; ses valeurs
+    sont émises avec la mesure.
+
+    Parameters
+    ----------
+    name : str
+        Nom de l'étape (cf. STAGES).
+    model : str, optional
+        Modèle concerné. None par défaut.
+    cells : int, optional
+        Nombre de mailles traitées, pour le calcul du débit. None par défaut.
+    **extra
+        Attributs supplémentaires émis avec la mesure.
+
+    """
+    rec = {"stage": name, "model": model, "cells": cells, **extra}
+    io_start = _read_bytes()
+    rss_start = _rss_mb()
+    peak_start = _peak_rss_mb()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield rec
+    finally:
+        rec["wall_s"] = time.perf_counter() - wall
+        rec["cpu_s"] = time.process_time() - cpu
+        # ru_maxrss est le pic de toute la vie du processus : seule son
+        # augmentation pendant le bloc est imputable à l'étape
+        peak_end = _peak_rss_mb()
+        rec["rss_delta_mb"] = _rss_mb() - rss_start
+        rec["peak_rss_delta_mb"] = peak_end - peak_start
+        rec["process_peak_rss_mb"] = peak_end
+        if "bytes_read" not in rec:
+            io_end = _read_bytes()
+            rec["bytes_read"] = (
+                io_end - io_start if io_start is not None else None
+            )
+        if rec.get("cells"):
+            rec["cells_per_s"] = rec["cells"] / max(rec["wall_s"], 1e-9)
+        RECORDER.emit(rec)
+
+
+def profile(model: str):
+    """
+    Renvoie un profileur cProfile actif si `model` est le modèle choisi
+    dans `configure`, un contexte vide sinon.
+
+    Le profil est écrit dans "profile_<model>.prof" (lisible avec pstats
+    ou snakeviz).
+
+    Parameters
+    ----------
+    model : str
+        Modèle en cours de traitement.
+
+    """
+    if RECORDER.profile_model is None or model != RECORDER.profile_model:
+        return nullcontext()
+
+    @contextmanager
+    def _profile():
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            directory = os.path.dirname(RECORDER.path or "") or "."
+            path = os.path.join(directory, f"profile_{model}.prof")
+            profiler.dump_stats(path)
+            logger.info("Profil de %s écrit dans %s", model, path)
+
+    return _profile()
+
+
+def summary(
+    records: list[dict] = None, by: tuple[str] = ("stage",)
+) -> "pd.DataFrame":
+    """
+    Tableau récapitulatif des mesures, agrégées par étape.
+
+    Parameters
+    ----------
+    records : list[dict], optional
+        Mesures à résumer. Par défaut, celles du collecteur global.
+    by : tuple[str], optional
+        Champs de regroupement. ("stage",) par défaut ; ("stage", "model")
+        donne le débit (mailles ajustées par seconde...) de chaque modèle.
+
+    Returns
+    -------
+    pd.DataFrame
+        Nombre d'appels, temps (wall, CPU), variations maximales de la RSS
+        et de son pic, pic RSS du processus, volume lu (NaN si indisponible)
+        et débit moyen par groupe, triés par temps total décroissant.
+
+    """
+    import pandas as pd
+
+    if records is None:
+        records = RECORDER.records
+    by = list(by)
+    columns = [
+        "stage",
+        "model",
+        "wall_s",
+        "cpu_s",
+        "rss_delta_mb",
+        "peak_rss_delta_mb",
+        "process_peak_rss_mb",
+        "bytes_read",
+    ]
+    df = pd.DataFrame(records, columns=columns + ["cells"])
+    df["cells"] = pd.to_numeric(df["cells"])
+    df["bytes_read"] = pd.to_numeric(df["bytes_read"])
+    df = df.groupby(by, dropna=False).agg(
+        calls=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        cpu_s=("cpu_s", "sum"),
+        rss_delta_mb=("rss_delta_mb", "max"),
+        peak_rss_delta_mb=("peak_rss_delta_mb", "max"),
+        process_peak_rss_mb=("process_peak_rss_mb", "max"),
+        bytes_read=("bytes_read", lambda s: s.sum(min_count=1)),
+        cells=("cells", "sum"),
+    )
+    df["cells_per_s"] = (df["cells"] / df["wall_s"]).where(df["cells"] > 0)
+    return df.sort_values("wall_s", ascending=False)
+
+
+def read_metrics(path: str) -> list[dict]:
+    """
+    Relit un fichier de mesures JSON lines (par exemple celui d'un run
+    nocturne) pour le passer à `summary`.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier.
+
+    Returns
+    -------
+    list[dict]
+        Mesures.
+
+    """
+    with open(path, encoding="utf8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def startup_times(modules: list[str] = None, repeat: int = 3) -> list[dict]:
+    """
+    Temps d'import de modules, chacun dans un nouvel interpréteur
+    (python -X importtime).
+
+    Parameters
+    ----------
+    modules : list[str], optional
+        Modules à importer. Par défaut, le paquet et tous ses modules.
+    repeat : int, optional
+        Nombre de mesures par module (la plus courte est retenue). 3 par
+        défaut.
+
+    Returns
+    -------
+    list[dict]
+        Par module : module, import_s (temps d'import cumulé) et heavy
+        (modules de HEAVY_MODULES chargés).
+
+    """
+    if modules is None:
+        import pkgutil
+
+        package = os.path.dirname(__file__)
+        modules = ["hackathon_climat_donnees"] + [
+            f"hackathon_climat_donnees.{info.name}"
+            for info in pkgutil.iter_modules([package])
+            if not info.name.startswith("_")
+        ]
+
+    records = []
+    for module in modules:
+        code = (
+            f"import sys, json, {module}; "
+            f"print(json.dumps([m for m in {HEAVY_MODULES!r} "
+            "if m in sys.modules]))"
+        )
+        times, heavy = [], []
+        for _ in range(repeat):
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", code],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            # dernière ligne du module : "import time: self | cumulé | nom"
+            cumulative = [
+                int(line.split("|")[1])
+                for line in result.stderr.splitlines()
+                if line.startswith("import time:")
+                and line.split("|")[-1].strip() == module
+            ]
+            times.append(cumulative[-1] / 1e6 if cumulative else 0.0)
+            heavy = json.loads(result.stdout.strip().splitlines()[-1])
+        records.append(
+            {"module": module, "import_s": min(times), "heavy": heavy}
+        )
+    return records
+
+
+def check_startup(
+    records: list[dict], budget: float = STARTUP_BUDGET
+) -> list[str]:
+    """
+    Ecarts des LIGHT_MODULES au budget de démarrage.
+
+    Parameters
+    ----------
+    records : list[dict]
+        Mesures de startup_times.
+    budget : float, optional
+        Temps d'import maximal (s). STARTUP_BUDGET par défaut.
+
+    Returns
+    -------
+    list[str]
+        Ecarts constatés (vide si le budget est respecté).
+
+    """
+    problems = []
+    for rec in records:
+        if rec["module"] not in LIGHT_MODULES:
+            continue
+        if rec["heavy"]:
+            problems.append(
+                f"{rec['module']} importe {', '.join(rec['heavy'])}"
+            )
+        if rec["import_s"] > budget:
+            problems.append(
+                f"{rec['module']} : {rec['import_s']:.3f} s > {budget} s"
+            )
+    return problems
@@ -2,82 +2,208 @@
 # -*- coding: utf-8 -*-
 """
 Jointure des fichiers netcdf et icpe
+
+join_outputs lit en une passe les niveaux de retour de tous les fichiers
+(scénarios, statistiques et périodes) à la maille la plus proche de chaque
+site, dans un seul tableau préalloué de forme (sites, sorties, périodes) :
+l'appariement site -> maille n'est calculé qu'une fois par grille, et seules
+les valeurs des mailles des sites sont conservées. scenarii_table en tire une
+table longue typée (une ligne par site et par sortie, colonnes catégorielles
+code_aiot, scenario et statistic), convertible en table Arrow.
+
+Ex.:
+    >>> from hackathon_climat_donnees.join_netcdf import scenarii_table
+    >>> df = scenarii_table(gdf, list_outputs())
+    >>> df[(df.statistic == "median") & (df.scenario == "ssp3_+2C")]
 """
+
 import os
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import xarray as xr
 
+from hackathon_climat_donnees.instrumentation import stage
+from hackathon_climat_donnees.outputs import output_labels
+
 
-def parse_netcdf_to_dataframe(path: str) -> gpd.GeoDataFrame:
+def _nearest_cells(
+    x: np.ndarray, y: np.ndarray, valid: np.ndarray, site_xy: np.ndarray
+) -> np.ndarray:
     """
-    Convertit un fichier netcdf issu du module netcdfprocessing en GeoDataFrame
+    Maille valide la plus proche de chaque site (indices dans la grille
+    aplatie), en Lambert 93 ; -1 pour les sites sans coordonnées ou les
+    grilles sans maille valide.
+    """
+    from pyproj import Transformer
+    from scipy.spatial import cKDTree
+
+    nearest = np.full(len(site_xy), -1)
+    cells = np.flatnonzero(valid)
+    ok = np.isfinite(site_xy).all(axis=1)
+    if not cells.size or not ok.any():
+        return nearest
+    xx, yy = np.meshgrid(x, y)
+    to_2154 = Transformer.from_crs(27572, 2154, always_xy=True)
+    cx, cy = to_2154.transform(xx.ravel()[cells], yy.ravel()[cells])
+    _, index = cKDTree(np.column_stack([cx, cy])).query(site_xy[ok])
+    nearest[ok] = cells[index]
+    return nearest
+
+
+def join_outputs(gdf: gpd.GeoDataFrame, list_paths_netcdf: list[str]) -> dict:
+    """
+    Niveaux de retour de tous les fichiers netcdf à la maille la plus
+    proche de chaque site, en une passe.
+
+    Les fichiers sont d'abord parcourus sans être lus (dimensions, périodes,
+    type) pour préallouer le résultat, puis lus un par un : la mémoire
+    utilisée est celle du résultat (sites x sorties x périodes) et d'une
+    grille. L'appariement site -> maille est recalculé uniquement lorsque
+    la grille ou ses mailles valides changent d'un fichier à l'autre.
 
     Parameters
     ----------
-    path : str
-        Chemin vers le fichier netcdf.
+    gdf : gpd.GeoDataFrame
+        GeoDataFrame des sites (colonne code_aiot, géométries ponctuelles)
+    list_paths_netcdf : list[str]
+        Chemins des fichiers produits par netcdf_processing (fichiers
+        d'ensemble <var>_RP_<scénario>_<statistique>.nc ou autres)
+
+    Raises
+    ------
+    ValueError
+        Si un fichier n'est pas trouvé ou si les fichiers n'ont pas les
+        mêmes périodes de retour.
 
     Returns
     -------
-    df : gpd.GeoDataFrame
-        GeoDataFrame des données netcdf.
+    dict
+        codes (code_aiot des sites), files, scenarios, statistics (listes
+        alignées, une entrée par sortie ; statistique None si le nom du
+        fichier n'est pas celui d'un fichier d'ensemble), periods et
+        values, tableau de forme (n_sites, n_sorties, n_périodes).
 
     """
-    df = xr.open_dataset(path)
-    try:
-        df.drop_dims("gev_params")
-    except ValueError:
-        pass
-    df = (
-        df.stack(points=("y", "x", "periods"))
-        .to_dataframe()
-        .reset_index()
-        .dropna()
-        .pivot(
-            index=["x", "y", "lat", "lon"],
-            columns="periods",
-            values="return_levels",
-        )
-        .reset_index()
+    layout, files, scenarios, statistics, dtypes = [], [], [], [], []
+    periods = None
+    for path in list_paths_netcdf:
+        if not os.path.exists(path):
+            raise ValueError(f"file not found at {path}")
+        with xr.open_dataset(path) as ds:
+            rl = ds["return_levels"]
+            extra = [d for d in rl.dims if d not in ("y", "x", "periods")]
+            labels = rl[extra[0]].values.tolist() if extra else [None]
+            if periods is None:
+                periods = rl["periods"].values
+            elif not np.array_equal(periods, rl["periods"].values):
+                raise ValueError(f"périodes de retour différentes : {path}")
+            dtypes.append(rl.dtype)
+        layout.append((path, extra, len(labels)))
+        names, stats = output_labels(path, labels)
+        files += [os.path.basename(path)] * len(labels)
+        scenarios += names
+        statistics += stats
+
+    sites = gdf.to_crs(2154)
+    site_xy = np.column_stack([sites.geometry.x, sites.geometry.y])
+    values = np.full(
+        (len(gdf), len(files), 0 if periods is None else len(periods)),
+        np.nan,
+        dtype=np.result_type(*dtypes) if dtypes else np.float64,
     )
-    geoms = gpd.GeoSeries(
-        gpd.points_from_xy(df["x"], df["y"]), name="geometry", crs=27572
-    ).to_crs(2154)
-    df = df.join(geoms).drop(["x", "y"], axis=1)
-    df = gpd.GeoDataFrame(df, crs=2154)
-    return df
 
+    grid = nearest = None
+    start = 0
+    with stage("join", sites=len(gdf), outputs=len(files)):
+        for path, extra, count in layout:
+            with xr.open_dataset(path) as ds:
+                rl = ds["return_levels"].transpose(*extra, "y", "x", "periods")
+                x, y = rl["x"].values, rl["y"].values
+                block = rl.values.reshape(count, len(y) * len(x), -1)
+            valid = np.isfinite(block).any(axis=(0, 2))
+            if grid is None or not (
+                np.array_equal(grid[0], x)
+                and np.array_equal(grid[1], y)
+                and np.array_equal(grid[2], valid)
+            ):
+                grid = (x, y, valid)
+                nearest = _nearest_cells(x, y, valid, site_xy)
+            found = nearest >= 0
+            values[found, start : start + count, :] = block[
+                :, nearest[found], :
+            ].transpose(1, 0, 2)
+            start += count
 
-def join_dataset_meteo(
-    gdf: gpd.GeoDataFrame, path_netcdf: str
-) -> gpd.GeoDataFrame:
+    return {
+        "codes": gdf["code_aiot"].to_numpy(),
+        "files": files,
+        "scenarios": scenarios,
+        "statistics": statistics,
+        "periods": periods,
+        "values": values,
+    }
+
+
+def _categorical(labels, repeat: int = 1, tile: int = 1) -> pd.Categorical:
+    "Colonne catégorielle de `labels` répétés, sans copie des libellés"
+    codes, categories = pd.factorize(np.asarray(labels, dtype=object))
+    codes = np.tile(np.repeat(codes, repeat), tile)
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def scenarii_table(
+    gdf: gpd.GeoDataFrame, list_paths_netcdf: list[str], arrow: bool = False
+):
     """
-    Jointure d'un dataset (ICPE) à un scenario météo
+    Table longue des niveaux de retour aux sites, pour tous les fichiers
+    netcdf (cf. join_outputs).
+
+    Une ligne par site et par sortie (scénario, statistique), dans l'ordre
+    des sites puis des fichiers ; les colonnes des périodes de retour sont
+    des vues du tableau de join_outputs (pas de copie par scénario).
 
     Parameters
     ----------
     gdf : gpd.GeoDataFrame
-        GeoDataFrame du semi de point étudié (ici les ICPE)
-    path_netcdf : str
-        Chemin vers le fichier netcdf généré par le module netcdf_processing
+        GeoDataFrame des sites (colonne code_aiot)
+    list_paths_netcdf : list[str]
+        Chemins des fichiers produits par netcdf_processing
+    arrow : bool, optional
+        Si True, renvoie une table pyarrow (colonnes catégorielles encodées
+        par dictionnaire). False par défaut.
 
     Returns
     -------
-    gdf : gpd.GeoDataFrame
-        GeoDataFrame assemblé
+    pd.DataFrame | pa.Table
+        Colonnes code_aiot, scenario, statistic (catégorielles), puis une
+        colonne par période de retour ("2", "5", ...).
 
-        Le dataframe contient les colonnes du dataframe initial, augmenté des
-        données (ici température) pour le scénario donné à
-        périodes de retour 2, 5, 10, 20, 50, 100.
+    Ex.:
+        code_aiot    scenario statistic      2      5     10  ...    100
+    0  0003205293    hist_ref       inf  33.13  34.21  34.76  ...  36.10
+    1  0003205293    hist_ref    median  33.79  35.08  35.97  ...  37.73
+    2  0003205293    hist_ref       sup  34.44  35.63  36.40  ...  39.33
+    3  0003205293  ssp3_+2.7C       inf  34.83  36.08  36.77  ...  38.00
 
     """
+    joined = join_outputs(gdf, list_paths_netcdf)
+    values = joined["values"]
+    n_sites, n_outputs, n_periods = values.shape
 
-    meteo = parse_netcdf_to_dataframe(path_netcdf)
+    df = pd.DataFrame(
+        values.reshape(n_sites * n_outputs, n_periods),
+        columns=[str(p) for p in joined["periods"]],
+        copy=False,
+    )
+    df.insert(0, "code_aiot", _categorical(joined["codes"], n_outputs))
+    df.insert(1, "scenario", _categorical(joined["scenarios"], 1, n_sites))
+    df.insert(2, "statistic", _categorical(joined["statistics"], 1, n_sites))
+    if arrow:
+        import pyarrow as pa
 
-    gdf = gpd.sjoin_nearest(gdf, meteo, how="left").drop("index_right", axis=1)
-    gdf = gdf.drop(["lat", "lon"], axis=1)
-    return gdf
+        return pa.Table.from_pandas(df, preserve_index=False)
+    return df
 
 
 def all_scenarii(
@@ -86,6 +212,10 @@ def all_scenarii(
     """
     Calcul des scenarii pour chaque ICPE
 
+    Les valeurs sont lues en une passe par join_outputs ; le scénario est
+    le nom du fichier netcdf (cf. scenarii_table pour une table typée
+    distinguant scénario et statistique).
+
     Parameters
     ----------
     gdf : gpd.GeoDataFrame
@@ -119,24 +249,62 @@ def all_scenarii(
                tasmax_RP_GEV_TRACC2.nc    37.564950  38.979659  39.938044  
 
     """
-    all_gdfs = []
-    for path in list_paths_netcdf:
-        if not os.path.exists(path):
-            raise ValueError("file not found at %s", path)
-        filename = os.path.basename(path)
-        gdf_with_scenario = join_dataset_meteo(gdf, path)
-        gdf_with_scenario["scenario"] = filename
-        all_gdfs.append(gdf_with_scenario)
-
-    gdf = gpd.pd.concat(all_gdfs)
-
-    cols = [2, 5, 10, 20, 50, 100]
-    df = gdf.set_index(["code_aiot", "scenario"])[cols]
-    df = df.rename(columns={x: str(x) for x in cols})
+    joined = join_outputs(gdf, list_paths_netcdf)
+    values = joined["values"]
+    n_sites, n_outputs, n_periods = values.shape
+    index = pd.MultiIndex.from_arrays(
+        [
+            np.repeat(joined["codes"], n_outputs),
+            np.tile(joined["files"], n_sites),
+        ],
+        names=["code_aiot", "scenario"],
+    )
+    df = pd.DataFrame(
+        values.reshape(n_sites * n_outputs, n_periods),
+        index=index,
+        columns=[str(p) for p in joined["periods"]],
+    )
     df = df.sort_index()
     return df
 
 
+def update_scenarii(
+    gdf: gpd.GeoDataFrame,
+    list_paths_netcdf: list[str],
+    previous: pd.DataFrame,
+    codes: list[str],
+) -> pd.DataFrame:
+    """
+    Mise à jour des scenarii pour les seules ICPE nouvelles ou modifiées
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        GeoDataFrame des ICPE considérées (inventaire complet)
+    list_paths_netcdf : list[str]
+        Liste des chemins des fichiers netcdf, identiques à ceux utilisés
+        pour `previous`
+    previous : pd.DataFrame
+        Résultat précédent de all_scenarii
+    codes : list[str]
+        Codes AIOT des ICPE à joindre de nouveau
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Même structure que all_scenarii ; les ICPE absentes de `gdf` sont
+        retirées.
+
+    """
+    codes = set(codes)
+    keep = set(gdf["code_aiot"]) - codes
+    parts = [previous[previous.index.get_level_values("code_aiot").isin(keep)]]
+    subset = gdf[gdf["code_aiot"].isin(codes)]
+    if len(subset):
+        parts.append(all_scenarii(subset, list_paths_netcdf))
+    return pd.concat(parts).sort_index()
+
+
 # if __name__ == "__main__":
 #     from hackathon_climat_donnees import INPUT
 #     from hackathon_climat_donnees.prep_datasets import prep_dataset_icpe
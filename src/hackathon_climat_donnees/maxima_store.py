@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stockage intermédiaire des maxima annuels, partagé entre processus
+
+Les maxima annuels d'un modèle (années x y x x) sont écrits une seule fois
+sous forme de fichier brut float32 accompagné d'un en-tête JSON :
+
+    <store>/<clé>.f32    données, ordre C (time, y, x)
+    <store>/<clé>.json   en-tête : forme, années, coordonnées x/y, ...
+    <store>/<clé>.npz    coordonnées 2D (lat, lon), si présentes
+
+Les workers ouvrent le fichier avec np.memmap (sans copie) et ajustent des
+tuiles spatiales disjointes : les lectures journalières ne sont faites
+qu'une fois et la mémoire n'est pas dupliquée entre processus.
+"""
+
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from hackathon_climat_donnees import OUTPUT
+
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = os.path.join(OUTPUT, "maxima")
+
+DEFAULT_TILE = 32
+
+
+def store_key(model_key: str, experiment: str) -> str:
+    """
+    Clé du stockage des maxima d'un membre (série historique + scénario),
+    ex. "CNRM-ESM2-1__r1i1p1f2__RACMO23E__ssp370".
+    """
+    return f"{model_key}__{experiment}"
+
+
+def write_maxima(
+    maximums: xr.DataArray, key: str, store_dir: str = STORE_DIR
+) -> str:
+    """
+    Ecrit les maxima annuels d'un modèle dans le stockage.
+
+    Parameters
+    ----------
+    maximums : xr.DataArray
+        Maxima annuels de dimensions (time, y, x).
+    key : str
+        Clé du modèle (ex. member_key).
+    store_dir : str, optional
+        Répertoire du stockage. STORE_DIR par défaut.
+
+    Returns
+    -------
+    str
+        Chemin de l'en-tête JSON.
+
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    maximums = maximums.transpose("time", "y", "x")
+    values = np.ascontiguousarray(maximums.values, dtype=np.float32)
+
+    base = os.path.join(store_dir, key)
+    # écriture dans un fichier temporaire puis renommage, pour que les
+    # lecteurs ne voient jamais un fichier partiel
+    values.tofile(base + ".f32.tmp")
+    os.replace(base + ".f32.tmp", base + ".f32")
+
+    coords_2d = {
+        name: coord.values
+        for name, coord in maximums.coords.items()
+        if coord.dims == ("y", "x")
+    }
+    if coords_2d:
+        # np.savez ajoute l'extension .npz à un chemin, pas à un fichier
+        with open(base + ".npz.tmp", "wb") as f:
+            np.savez(f, **coords_2d)
+        os.replace(base + ".npz.tmp", base + ".npz")
+
+    header = {
+        "shape": list(values.shape),
+        "dtype": "float32",
+        "dims": ["time", "y", "x"],
+        "years": maximums["time"].dt.year.values.tolist(),
+        "y": maximums["y"].values.tolist(),
+        "x": maximums["x"].values.tolist(),
+        "coords_2d": sorted(coords_2d),
+        "name": maximums.name,
+    }
+    # en-tête écrit en dernier : un modèle n'est lisible qu'une fois complet
+    with open(base + ".json.tmp", "w", encoding="utf8") as f:
+        json.dump(header, f)
+    os.replace(base + ".json.tmp", base + ".json")
+    return base + ".json"
+
+
+def read_header(key: str, store_dir: str = STORE_DIR) -> dict:
+    "En-tête JSON d'un modèle du stockage"
+    with open(os.path.join(store_dir, key + ".json"), encoding="utf8") as f:
+        return json.load(f)
+
+
+def exists(key: str, store_dir: str = STORE_DIR) -> bool:
+    "True si les maxima du modèle sont présents dans le stockage"
+    base = os.path.join(store_dir, key)
+    return os.path.exists(base + ".json") and os.path.exists(base + ".f32")
+
+
+def open_maxima(
+    key: str, store_dir: str = STORE_DIR
+) -> tuple[np.memmap, dict]:
+    """
+    Ouvre en lecture seule (np.memmap) les maxima d'un modèle.
+
+    Parameters
+    ----------
+    key : str
+        Clé du modèle.
+    store_dir : str, optional
+        Répertoire du stockage. STORE_DIR par défaut.
+
+    Returns
+    -------
+    values : np.memmap
+        Maxima annuels, de forme (time, y, x).
+    header : dict
+        En-tête du modèle.
+
+    """
+    header = read_header(key, store_dir)
+    values = np.memmap(
+        os.path.join(store_dir, key + ".f32"),
+        dtype=header["dtype"],
+        mode="r",
+        shape=tuple(header["shape"]),
+    )
+    return values, header
+
+
+def open_dataarray(key: str, store_dir: str = STORE_DIR) -> xr.DataArray:
+    """
+    Maxima d'un modèle sous forme de DataArray adossé au memmap.
+
+    Parameters
+    ----------
+    key : str
+        Clé du modèle.
+    store_dir : str, optional
+        Répertoire du stockage. STORE_DIR par défaut.
+
+    Returns
+    -------
+    xr.DataArray
+        Maxima annuels (time, y, x) ; "time" porte les années.
+
+    """
+    values, header = open_maxima(key, store_dir)
+    coords = {"time": header["years"], "y": header["y"], "x": header["x"]}
+    if header["coords_2d"]:
+        with np.load(os.path.join(store_dir, key + ".npz")) as npz:
+            for name in header["coords_2d"]:
+                coords[name] = (("y", "x"), npz[name])
+    return xr.DataArray(
+        values, dims=header["dims"], coords=coords, name=header["name"]
+    )
+
+
+def tiles(shape: tuple, tile: int = DEFAULT_TILE) -> list[tuple[slice]]:
+    """
+    Découpe une grille (ny, nx) en tuiles disjointes.
+
+    Parameters
+    ----------
+    shape : tuple
+        Dimensions (ny, nx).
+    tile : int, optional
+        Côté des tuiles, en mailles. DEFAULT_TILE par défaut.
+
+    Returns
+    -------
+    list[tuple[slice]]
+        Couples (slice y, slice x).
+
+    """
+    ny, nx = shape
+    return [
+        (slice(y, min(y + tile, ny)), slice(x, min(x + tile, nx)))
+        for y in range(0, ny, tile)
+        for x in range(0, nx, tile)
+    ]
+
+
+def _year_slice(header: dict, start: int, end: int) -> slice:
+    years = np.array(header["years"])
+    i0 = int(np.searchsorted(years, start, side="left"))
+    i1 = int(np.searchsorted(years, end, side="right"))
+    return slice(i0, i1)
+
+
+def fit_tile(args: tuple) -> tuple:
+    """
+    Ajustement GEV d'une tuile, exécuté dans un worker : le worker ouvre le
+    memmap et ne lit que la tuile demandée.
+
+    Parameters
+    ----------
+    args : tuple
+        (key, store_dir, (start, end), ys, xs, periods) : clé du modèle,
+        répertoire du stockage, fenêtre d'années (incluses), tranches de
+        la tuile (cf. tiles) et périodes de retour.
+
+    Returns
+    -------
+    tuple
+        (ys, xs, return_levels, gev_params) de la tuile, de dimensions
+        (y, x, periods) et (y, x, 3).
+
+    """
+    from hackathon_climat_donnees.netcdf_processing import RP_calcul_vectorized
+
+    key, store_dir, years, ys, xs, periods = args
+    values, header = open_maxima(key, store_dir)
+    block = values[_year_slice(header, *years), ys, xs]
+
+    ny, nx = block.shape[1:]
+    rv = np.full((ny, nx, len(periods)), np.nan)
+    params = np.full((ny, nx, 3), np.nan)
+    for j in range(ny):
+        for i in range(nx):
+            rv[j, i], params[j, i] = RP_calcul_vectorized(
+                block[:, j, i], periods
+            )
+    return ys, xs, rv, params
+
+
+def fit_from_store(
+    key: str,
+    start: int,
+    end: int,
+    periods: np.ndarray,
+    n_workers: int = None,
+    tile: int = DEFAULT_TILE,
+    store_dir: str = STORE_DIR,
+    executor: ProcessPoolExecutor = None,
+) -> xr.Dataset:
+    """
+    Ajustement GEV par maille sur une fenêtre d'années, réparti entre
+    plusieurs processus par tuiles spatiales.
+
+    Parameters
+    ----------
+    key : str
+        Clé du modèle.
+    start : int
+        Première année de la fenêtre (incluse).
+    end : int
+        Dernière année de la fenêtre (incluse).
+    periods : np.ndarray
+        Périodes de retour.
+    n_workers : int, optional
+        Nombre de processus. Par défaut, le nombre de coeurs ; 1 pour un
+        calcul sans processus supplémentaire.
+    tile : int, optional
+        Côté des tuiles, en mailles. DEFAULT_TILE par défaut.
+    store_dir : str, optional
+        Répertoire du stockage. STORE_DIR par défaut.
+    executor : ProcessPoolExecutor, optional
+        Pool de processus à réutiliser d'un appel à l'autre. Si None, un
+        pool de `n_workers` processus est créé pour l'appel.
+
+    Returns
+    -------
+    ds_RP : xr.Dataset
+        Dataset contenant "return_levels" (y, x, periods) et
+        "gev_params" (y, x, gev_params), comme fit_return_levels.
+
+    """
+    header = read_header(key, store_dir)
+    ny, nx = header["shape"][1:]
+    jobs = [
+        (key, store_dir, (start, end), ys, xs, periods)
+        for ys, xs in tiles((ny, nx), tile)
+    ]
+
+    rv = np.full((ny, nx, len(periods)), np.nan)
+    params = np.full((ny, nx, 3), np.nan)
+    if executor is not None:
+        results = executor.map(fit_tile, jobs)
+    elif n_workers == 1:
+        results = map(fit_tile, jobs)
+    else:
+        with ProcessPoolExecutor(n_workers) as pool:
+            results = list(pool.map(fit_tile, jobs))
+    for ys, xs, rv_tile, params_tile in results:
+        rv[ys, xs] = rv_tile
+        params[ys, xs] = params_tile
+
+    coords = {"y": header["y"], "x": header["x"]}
+    if header["coords_2d"]:
+        with np.load(os.path.join(store_dir, key + ".npz")) as npz:
+            for name in header["coords_2d"]:
+                coords[name] = (("y", "x"), npz[name])
+    return xr.Dataset(
+        {
+            "return_levels": (("y", "x", "periods"), rv),
+            "gev_params": (("y", "x", "gev_params"), params),
+        },
+        coords={**coords, "periods": periods},
+    )
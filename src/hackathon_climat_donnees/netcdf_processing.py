@@ -8,6 +8,7 @@ import logging
 import os
 import time
 import gc
+from concurrent.futures import ProcessPoolExecutor
 
 import xarray as xr
 import pandas as pd
@@ -15,10 +16,40 @@ import numpy as np
 from scipy.stats import genextreme as gev
 
 from hackathon_climat_donnees import INPUT, OUTPUT
+from hackathon_climat_donnees.catalog import (
+    SCENARIOS,
+    build_catalog,
+    file_metadata,
+    match_pivots,
+    member_key,
+    scenario_lists,
+    time_slice,
+)
+from hackathon_climat_donnees.cluster import input_chunks, start_client
+from hackathon_climat_donnees.diagnostics import (
+    DIAGNOSTICS,
+    gev_diagnostics,
+    mask_cells,
+)
+from hackathon_climat_donnees.instrumentation import profile, stage, summary
+from hackathon_climat_donnees.maxima_store import (
+    STORE_DIR,
+    fit_from_store,
+    open_dataarray,
+    store_key,
+    write_maxima,
+)
+from hackathon_climat_donnees.nonstationary import (
+    fit_nonstationary,
+    warming_level_covariate,
+)
+from hackathon_climat_donnees.regional import fit_regional
 
 
 logger = logging.getLogger(__name__)
 
+RWL_LIST = ["2C", "2.7C", "4C"]
+
 
 # ----------------------------
 # 1. Fonction GEV
@@ -40,16 +71,6 @@ def get_period(is_historical, pivot):
     return pivot - 15, pivot + 14
 
 
-# ----------------------------
-# 3. Extraction GCM / RCM
-# ----------------------------
-def extract_gcm_rcm(path):
-    parts = path.split("/")
-    gcm = parts[5]
-    rcm = parts[7]
-    return gcm, rcm
-
-
 def convert(data, var):
     if var == "prAdjust":
         data[var] = data[var] * 86400
@@ -58,131 +79,633 @@ def convert(data, var):
     return data
 
 
-def process_netcdf_bunch():
+def preview_grid(ds, coarsen=None, stride=None):
+    """
+    Réduit la grille d'un dataset (mode aperçu).
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Données journalières.
+    coarsen : int, optional
+        Agrège les mailles par blocs de coarsen x coarsen (moyenne ; les
+        mailles en bord de grille qui ne forment pas un bloc complet sont
+        ignorées).
+    stride : int, optional
+        Ne lit qu'une maille sur `stride` dans chaque direction, à la
+        lecture.
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Données sur la grille réduite.
+
+    """
+    if stride:
+        ds = ds.isel(y=slice(None, None, stride), x=slice(None, None, stride))
+    if coarsen:
+        ds = ds.coarsen(y=coarsen, x=coarsen, boundary="trim").mean()
+    return ds
+
+
+def open_input(path, var, model_key=None, chunks=None, grid=None):
+    """
+    Ouvre un fichier d'entrée (chemin relatif à INPUT) et convertit la
+    variable dans l'unité d'usage.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier, tel que listé dans liste_*_tasmax.txt.
+    var : str
+        Variable traitée.
+    model_key : str, optional
+        Modèle concerné, pour l'instrumentation.
+    chunks : dict, optional
+        Blocs spatiaux (mode découpé), ex. {"y": 64, "x": 64}. La dimension
+        "time" n'est pas découpée. Si None, ouverture sans dask.
+    grid : dict, optional
+        Réduction de la grille (mode aperçu), arguments de preview_grid,
+        ex. {"coarsen": 4}. Si None, grille complète.
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Dataset converti.
+
+    """
+    path = os.path.join(INPUT, path)
+    # ouverture paresseuse : le volume lu est imputé à l'étape qui charge
+    # les données (annual_max, volume décompressé ; compute en mode découpé)
+    with stage("open", model=model_key):
+        if chunks is None:
+            ds = xr.open_dataset(path)
+        else:
+            ds = xr.open_dataset(path, chunks=input_chunks(chunks))
+        if grid:
+            ds = preview_grid(ds, **grid)
+    with stage("convert", model=model_key):
+        ds = convert(ds, var)
+    return ds
+
+
+def fit_return_levels(maximums, periods, model_key=None, regional=None):
+    """
+    Ajustement GEV maille par maille d'un DataArray de maxima annuels.
+
+    Parameters
+    ----------
+    maximums : xr.DataArray
+        Maxima annuels de dimensions (time, y, x).
+    periods : np.ndarray
+        Périodes de retour.
+    model_key : str, optional
+        Modèle concerné, pour l'instrumentation.
+    regional : dict, optional
+        Si fourni, ajustement régional (regional.fit_regional) avec ces
+        arguments (radius, regions) : paramètre de forme commun au
+        voisinage, position et échelle locales. None par défaut.
+
+    Returns
+    -------
+    ds_RP : xr.Dataset
+        Dataset contenant "return_levels", "gev_params" et les diagnostics
+        d'ajustement (cf. diagnostics.DIAGNOSTICS).
+
+    """
+    if maximums.chunks:
+        maximums = maximums.chunk({"time": -1})
+    cells = int(np.prod([n for d, n in maximums.sizes.items() if d != "time"]))
+    if regional is not None:
+        with stage("fit", model=model_key, cells=cells):
+            ds_RP = fit_regional(maximums, periods, **regional)
+        return add_diagnostics(ds_RP, maximums, model_key)
+    with stage("fit", model=model_key, cells=cells):
+        rv, params = xr.apply_ufunc(
+            RP_calcul_vectorized,
+            maximums,
+            periods,
+            input_core_dims=[["time"], ["periods"]],
+            output_core_dims=[["periods"], ["gev_params"]],
+            vectorize=True,
+            dask="parallelized",
+            output_dtypes=[float, float],
+            dask_gufunc_kwargs={"output_sizes": {"gev_params": 3}},
+        )
+    rv = rv.assign_coords(periods=periods)
+    ds_RP = xr.Dataset({"return_levels": rv, "gev_params": params})
+    return add_diagnostics(ds_RP, maximums, model_key)
+
+
+def add_diagnostics(ds_RP, maximums, model_key=None):
+    """
+    Ajoute les diagnostics d'ajustement GEV aux résultats d'un modèle.
+
+    Parameters
+    ----------
+    ds_RP : xr.Dataset
+        Dataset contenant "return_levels" et "gev_params".
+    maximums : xr.DataArray
+        Maxima annuels ajustés, de dimensions (time, y, x).
+    model_key : str, optional
+        Modèle concerné, pour l'instrumentation.
+
+    Returns
+    -------
+    ds_RP : xr.Dataset
+        Dataset complété des variables de DIAGNOSTICS.
+
+    """
+    cells = int(np.prod([n for d, n in maximums.sizes.items() if d != "time"]))
+    with stage("diagnostics", model=model_key, cells=cells):
+        diag = gev_diagnostics(maximums, ds_RP["gev_params"])
+    return ds_RP.assign(diag.data_vars)
+
+
+def write_output(
+    ds, filename, model_key=None, compute=True, output_dir=OUTPUT, attrs=None
+):
+    """
+    Ecrit un dataset de résultats.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Dataset à écrire.
+    filename : str
+        Nom du fichier.
+    model_key : str, optional
+        Modèle concerné, pour l'instrumentation.
+    compute : bool, optional
+        Si False (mode découpé), renvoie l'écriture différée sans la
+        calculer. True par défaut.
+    output_dir : str, optional
+        Répertoire de sortie. OUTPUT par défaut.
+    attrs : dict, optional
+        Attributs globaux ajoutés au fichier (ex. {"preview": ...}).
+
+    Returns
+    -------
+    dask.delayed.Delayed ou None
+        Ecriture différée si compute vaut False.
+
+    """
+    with stage("write", model=model_key):
+        if attrs:
+            ds = ds.assign_attrs(**attrs)
+        return ds.to_netcdf(
+            os.path.join(output_dir, filename), compute=compute
+        )
+
+
+def compute_writes(writes, model_key=None):
+    """
+    Exécute en un seul graphe les écritures différées d'un modèle (mode
+    découpé). Sans effet en mode sans dask.
+
+    Parameters
+    ----------
+    writes : list
+        Résultats de write_output.
+    model_key : str, optional
+        Modèle concerné, pour l'instrumentation.
+
+    """
+    writes = [w for w in writes if w is not None]
+    if not writes:
+        return
+    import dask
+
+    with stage("compute", model=model_key):
+        dask.compute(*writes)
+
+
+def annual_maxima(ds_hist, ds_ssp, var, model_key=None):
+    """
+    Maxima annuels sur la série complète historique + scénario.
+
+    Parameters
+    ----------
+    ds_hist : xr.Dataset
+        Données journalières historiques (converties).
+    ds_ssp : xr.Dataset
+        Données journalières du scénario (converties).
+    var : str
+        Variable traitée.
+    model_key : str, optional
+        Modèle concerné, pour l'instrumentation.
+
+    Returns
+    -------
+    maximums : xr.DataArray
+        Maxima annuels (time, y, x).
+
+    """
+    with stage("annual_max", model=model_key) as rec:
+        if not ds_hist[var].chunks:
+            rec["bytes_read"] = ds_hist[var].nbytes + ds_ssp[var].nbytes
+        return xr.concat(
+            [
+                ds_hist[var].resample(time="1YE").max(skipna=True),
+                ds_ssp[var].resample(time="1YE").max(skipna=True),
+            ],
+            dim="time",
+        )
+
+
+def fit_period(
+    ds,
+    path,
+    var,
+    start,
+    end,
+    periods,
+    model_key,
+    executor=None,
+    store_dir=STORE_DIR,
+    key=None,
+    regional=None,
+):
+    """
+    Niveaux de retour d'un modèle sur une fenêtre d'années.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Données journalières (converties). Ignoré si `executor` est fourni.
+    path : str
+        Chemin du fichier de `ds`, pour planifier le découpage temporel.
+    var : str
+        Variable traitée.
+    start : int
+        Première année de la fenêtre (incluse).
+    end : int
+        Dernière année de la fenêtre (incluse).
+    periods : np.ndarray
+        Périodes de retour.
+    model_key : str
+        Modèle concerné.
+    executor : ProcessPoolExecutor, optional
+        Si fourni, les maxima annuels sont lus dans le stockage
+        intermédiaire (maxima_store) et l'ajustement est réparti par tuiles
+        entre les processus du pool.
+    store_dir : str, optional
+        Répertoire du stockage intermédiaire. STORE_DIR par défaut.
+    key : str, optional
+        Clé des maxima dans le stockage intermédiaire (cf.
+        maxima_store.store_key). Par défaut, `model_key`.
+    regional : dict, optional
+        Arguments de l'ajustement régional (cf. fit_return_levels). Le
+        voisinage traversant les tuiles, l'ajustement porte alors sur toute
+        la grille lue dans le stockage, sans répartition entre processus.
+        None par défaut.
+
+    Returns
+    -------
+    ds_RP : xr.Dataset
+        Dataset contenant "return_levels", "gev_params" et les diagnostics
+        d'ajustement.
+
+    """
+    if executor is not None:
+        key = model_key if key is None else key
+        # même fenêtre que la lecture directe : limitée aux années du fichier
+        years = file_metadata(path)["years"]
+        start, end = max(start, years[0]), min(end, years[-1])
+        if regional is not None:
+            maximums = open_dataarray(key, store_dir).sel(
+                time=slice(start, end)
+            )
+            return fit_return_levels(maximums, periods, model_key, regional)
+        with stage("fit", model=model_key):
+            ds_RP = fit_from_store(
+                key,
+                start,
+                end,
+                periods,
+                store_dir=store_dir,
+                executor=executor,
+            )
+        maximums = open_dataarray(key, store_dir).sel(time=slice(start, end))
+        return add_diagnostics(ds_RP, maximums, model_key)
+
+    ds_sel = ds.isel(time=time_slice(path, start, end))
+    with stage("annual_max", model=model_key) as rec:
+        if not ds_sel[var].chunks:
+            rec["bytes_read"] = ds_sel[var].nbytes
+        maximums = ds_sel.resample(time="1YE").max(skipna=True)
+    return fit_return_levels(maximums[var], periods, model_key, regional)
+
+
+def process_nonstationary(ds_hist, ds_ssp, row, var, periods, warming_levels):
+    """
+    Ajustement GEV non-stationnaire d'un modèle sur la série complète
+    historique + SSP, avec le niveau de réchauffement comme covariable.
+
+    Parameters
+    ----------
+    ds_hist : xr.Dataset
+        Données journalières historiques (converties).
+    ds_ssp : xr.Dataset
+        Données journalières du scénario (converties).
+    row : pd.Series
+        Ligne de TRACC_pivot.csv correspondant au modèle.
+    var : str
+        Variable traitée.
+    periods : np.ndarray
+        Périodes de retour.
+    warming_levels : np.ndarray
+        Niveaux de réchauffement pour lesquels calculer les niveaux de retour.
+
+    Returns
+    -------
+    ds_RP : xr.Dataset
+        Niveaux de retour (warming_level, periods, y, x) et paramètres.
+
+    """
+    model_key = member_key(row)
+    maximums = annual_maxima(ds_hist, ds_ssp, var, model_key)
+    pivots = {float(RWL.rstrip("C")): row[RWL] for RWL in RWL_LIST}
+    gwl = warming_level_covariate(maximums.time.dt.year.values, pivots)
+    cells = int(np.prod(maximums.shape[1:]))
+    with stage("fit", model=model_key, cells=cells):
+        return fit_nonstationary(maximums, gwl, warming_levels, periods)
+
+
+def process_netcdf_bunch(
+    nonstationary: bool = False,
+    warming_levels: list[float] = None,
+    chunks: dict = None,
+    cluster: dict = None,
+    n_workers: int = None,
+    mask_poor_fits: bool = False,
+    preview: dict = None,
+    scenarios: list[str] = None,
+    regional: dict = None,
+):
+    """
+    Calcul des niveaux de retour par modèle puis des statistiques
+    multi-modèles.
+
+    Parameters
+    ----------
+    nonstationary : bool, optional
+        Si True, ajuste une GEV non-stationnaire par modèle sur la série
+        complète 1950-2100 au lieu des fenêtres de 30 ans autour des années
+        pivots. False par défaut.
+    warming_levels : list[float], optional
+        Niveaux de réchauffement pour lesquels calculer les niveaux de retour
+        en mode non-stationnaire. Par défaut, ceux de RWL_LIST.
+    chunks : dict, optional
+        Active le mode découpé (dask) avec ces blocs spatiaux, ex.
+        {"y": 64, "x": 64} : pour chaque modèle, maxima annuels, ajustements
+        et écritures forment un seul graphe de tâches. None par défaut
+        (exécution sans dask).
+    cluster : dict, optional
+        Arguments de cluster.start_client (n_workers, threads_per_worker,
+        processes, memory_limit, ou address d'un scheduler multi-noeuds).
+        Si None, le scheduler dask courant est utilisé.
+    n_workers : int, optional
+        Active le stockage intermédiaire des maxima annuels
+        (maxima_store) : les maxima de chaque modèle sont calculés une fois
+        sur toute la série, écrits sur disque, puis les ajustements sont
+        répartis par tuiles entre `n_workers` processus qui les lisent par
+        memmap. None par défaut (sans stockage intermédiaire).
+    mask_poor_fits : bool, optional
+        Si True, les mailles dont l'ajustement est jugé de mauvaise qualité
+        (indicateur "fit_ok" des diagnostics, ou "converged" en mode
+        non-stationnaire) sont exclues des statistiques multi-modèles.
+        False par défaut.
+    preview : dict, optional
+        Active le mode aperçu : grille réduite à la lecture ("coarsen" :
+        moyenne par blocs de n x n mailles, ou "stride" : une maille sur n)
+        et éventuellement sous-ensemble de modèles ("models" : nombre de
+        modèles, ou liste de clés <GCM>__<membre>__<RCM>), ex.
+        {"coarsen": 4, "models": 3}. Les sorties ont la même structure que
+        les sorties complètes, portent l'attribut global "preview" et sont
+        écrites dans OUTPUT/preview. None par défaut.
+    scenarios : list[str], optional
+        Scénarios à traiter (expériences DRIAS, cf. catalog.SCENARIOS), ex.
+        ["ssp126", "ssp245", "ssp370", "ssp585"]. Les fichiers sont lus dans
+        liste_<scénario>_tasmax.txt et les années pivots dans les lignes
+        du scénario de TRACC_pivot.csv. La référence historique
+        (<var>_RP_hist_<modèle>.nc) est ajustée une seule fois par membre
+        et commune à tous les scénarios ; les fichiers des scénarios sont
+        nommés <var>_RP_<étiquette>_<modèle>_+<RWL>.nc (ex. "ssp3").
+        Par défaut, ["ssp370"].
+    regional : dict, optional
+        Active l'analyse fréquentielle régionale (cf. regional) : le
+        paramètre de forme de chaque maille est estimé sur un voisinage
+        ("radius" : rayon en mailles) ou sur des régions homogènes
+        ("regions" : DataArray (y, x) de numéros de régions), puis la
+        position et l'échelle sont ajustées localement, ex. {"radius": 2}.
+        Les sorties portent l'attribut global "regional". Sans effet en
+        mode non-stationnaire. None par défaut.
+
+    Returns
+    -------
+    list[str]
+        Chemins des fichiers écrits par ce run (fichiers par modèle et
+        fichiers d'ensemble), dans OUTPUT ou OUTPUT/preview.
+
+    """
 
     VAR = "tasmaxAdjust"
     periods = np.array([2, 5, 10, 20, 50, 100])
-    HIST_DONE = False
+    if warming_levels is None:
+        warming_levels = [float(RWL.rstrip("C")) for RWL in RWL_LIST]
+    if scenarios is None:
+        scenarios = ["ssp370"]
 
     # ------------------------
-    # 4.3 Listes fichiers
+    # 4.3 Catalogue des fichiers
     # ------------------------
-    with open(os.path.join(INPUT, "liste_ssp370_tasmax.txt")) as f:
-        ssp_files = [l.strip() for l in f.readlines()]
-    with open(os.path.join(INPUT, "liste_hist_tasmax.txt")) as f:
-        hist_files = [l.strip() for l in f.readlines()]
-
-    hist_dict = {extract_gcm_rcm(f): f for f in hist_files}
-    ssp_dict = {extract_gcm_rcm(f): f for f in ssp_files}
+    catalog = build_catalog(scenario_lists(scenarios))
 
     # ------------------------
-    # 4.4 Tableau des modèles
+    # 4.4 Tableau des modèles, apparié par membre d'ensemble : une ligne par
+    # membre et par scénario
     # ------------------------
-    df = pd.read_csv(os.path.join(INPUT, "TRACC_pivot.csv"))
+    pivots = pd.read_csv(os.path.join(INPUT, "TRACC_pivot.csv"))
+    df = pd.concat(
+        [
+            match_pivots(catalog, pivots, experiment=exp, variable=VAR).assign(
+                experiment=exp
+            )
+            for exp in scenarios
+        ],
+        ignore_index=True,
+    )
+    df["model_key"] = df.apply(member_key, axis=1)
+
+    output_dir, store_dir, grid, attrs = OUTPUT, STORE_DIR, None, {}
+    written = []
+    if preview:
+        output_dir = os.path.join(OUTPUT, "preview")
+        store_dir = os.path.join(output_dir, "maxima")
+        os.makedirs(output_dir, exist_ok=True)
+        grid = {k: v for k, v in preview.items() if k in ("coarsen", "stride")}
+        attrs["preview"] = ", ".join(f"{k}={v}" for k, v in preview.items())
+        models = preview.get("models")
+        if isinstance(models, int):
+            complete = df.dropna(subset=["hist_path", "ssp_path"])
+            models = complete["model_key"].unique()[:models]
+        if models is not None:
+            df = df[df["model_key"].isin(models)]
+        logger.info(f"Mode aperçu ({attrs['preview']}) : {len(df)} modèles")
+    if regional is not None:
+        attrs["regional"] = ", ".join(
+            k if k == "regions" else f"{k}={v}" for k, v in regional.items()
+        )
 
     # ------------------------
-    # 4.5 Boucle RWL
+    # 4.5 Boucle membres / scénarios / RWL
     # ------------------------
     datestart = time.time()
-    mods = []
+    compute = chunks is None
+    client = start_client(**cluster) if cluster is not None else None
+    executor = ProcessPoolExecutor(n_workers) if n_workers else None
 
-    for _, row in df.iterrows():
-        gcm = row["GCM"]
-        rcm = row["RCM"]
-        model_key = f"{gcm}__{rcm}"
-
-        hist_path = hist_dict.get((gcm, rcm))
-        ssp_path = ssp_dict.get((gcm, rcm))
-
-        if hist_path is None or ssp_path is None:
+    for model_key, rows in df.groupby("model_key", sort=False):
+        hist_path = rows["hist_path"].iloc[0]
+        if pd.isna(hist_path):
             logger.warning(f"Fichiers manquants pour {model_key}")
             continue
 
-        ds_hist = xr.open_dataset(os.path.join(INPUT, hist_path))
-        ds_hist = convert(ds_hist, VAR)
-
-        ds_ssp = xr.open_dataset(os.path.join(INPUT, ssp_path))
-        ds_ssp = convert(ds_ssp, VAR)
-
-        for RWL in ["2C", "2.7C", "4C"]:
-            logger.info(f"=== RWL : {RWL} ===")
-            pivot = row[RWL]
-            if pd.isna(pivot):
-                pivot = 2085
-            else:
-                pivot = min(int(pivot), 2085)
-
-            # ------------------------
-            # Historique
-            # ------------------------
-            if model_key not in mods and not HIST_DONE:
-                ds_hist_sel = ds_hist.sel(
-                    time=slice("1985-01-01", "2014-12-31")
-                )
-                maximums_hist = ds_hist_sel.resample(time="1YE").max(
-                    skipna=True
-                )
-                # maximums_hist = maximums_hist.chunk({"time": -1})
-
-                rv, params = xr.apply_ufunc(
-                    RP_calcul_vectorized,
-                    maximums_hist[VAR],
-                    periods,
-                    input_core_dims=[["time"], ["periods"]],
-                    output_core_dims=[["periods"], ["gev_params"]],
-                    vectorize=True,
-                    dask="parallelized",
-                    output_dtypes=[float, float],
-                )
-
-                rv = rv.assign_coords(periods=periods)
-                ds_RP = xr.Dataset({"return_levels": rv, "gev_params": params})
-
-                ds_RP.to_netcdf(
-                    os.path.join(OUTPUT, f"{VAR}_RP_hist_{model_key}.nc")
-                )
-
-                mods.append(model_key)
-                del ds_hist_sel, maximums_hist, rv, params, ds_RP
-                gc.collect()
-                logger.info(f"Historique traité pour {model_key}")
-            else:
-                logger.info(f"{model_key} historique déjà traité")
-
-            # ------------------------
-            # SSP370
-            # ------------------------
-            start, end = get_period(False, pivot)
-
-            ds_ssp_sel = ds_ssp.sel(
-                time=slice(f"{start}-01-01", f"{end}-12-31")
-            )
-            maximums_ssp = ds_ssp_sel.resample(time="1YE").max(skipna=True)
-            # maximums_ssp = maximums_ssp.chunk({"time": -1})
-
-            rv, params = xr.apply_ufunc(
-                RP_calcul_vectorized,
-                maximums_ssp[VAR],
-                periods,
-                input_core_dims=[["time"], ["periods"]],
-                output_core_dims=[["periods"], ["gev_params"]],
-                vectorize=True,
-                dask="parallelized",
-                output_dtypes=[float, float],
-            )
-            rv = rv.assign_coords(periods=periods)
-            ds_RP = xr.Dataset({"return_levels": rv, "gev_params": params})
-
-            ds_RP.to_netcdf(
-                os.path.join(OUTPUT, f"{VAR}_RP_ssp3_{model_key}_+{RWL}.nc")
-            )
-
-            del ds_ssp_sel, maximums_ssp, rv, params, ds_RP
-            gc.collect()
-
-            logger.info(
-                f"RWL {RWL} terminée ({(time.time()-datestart)/60:.2f} min)"
-            )
+        with profile(model_key):
+            ds_hist = open_input(hist_path, VAR, model_key, chunks, grid)
+            hist_done = False
+
+            for _, row in rows.iterrows():
+                experiment = row["experiment"]
+                label = SCENARIOS[experiment]
+                ssp_path = row["ssp_path"]
+                if pd.isna(ssp_path):
+                    logger.warning(
+                        f"Fichiers manquants pour {model_key} ({experiment})"
+                    )
+                    continue
+
+                ds_ssp = open_input(ssp_path, VAR, model_key, chunks, grid)
+                key = store_key(model_key, experiment)
+                writes = []
+
+                if nonstationary:
+                    ds_RP = process_nonstationary(
+                        ds_hist, ds_ssp, row, VAR, periods, warming_levels
+                    )
+                    name = f"{VAR}_RP_ns_{label}_{model_key}.nc"
+                    written.append(os.path.join(output_dir, name))
+                    writes.append(
+                        write_output(
+                            ds_RP,
+                            name,
+                            model_key,
+                            compute,
+                            output_dir,
+                            attrs,
+                        )
+                    )
+                    compute_writes(writes, model_key)
+                    del ds_RP
+                    gc.collect()
+                    logger.info(
+                        f"{model_key} {experiment} non-stationnaire terminé "
+                        f"({(time.time()-datestart)/60:.2f} min)"
+                    )
+                    continue
+
+                if executor is not None:
+                    write_maxima(
+                        annual_maxima(ds_hist, ds_ssp, VAR, model_key),
+                        key,
+                        store_dir,
+                    )
+
+                # ------------------------
+                # Historique : une seule fois par membre, commun à tous les
+                # scénarios
+                # ------------------------
+                if not hist_done:
+                    start, end = get_period(True, None)
+                    ds_RP = fit_period(
+                        ds_hist,
+                        hist_path,
+                        VAR,
+                        start,
+                        end,
+                        periods,
+                        model_key,
+                        executor,
+                        store_dir,
+                        key,
+                        regional,
+                    )
+                    name = f"{VAR}_RP_hist_{model_key}.nc"
+                    written.append(os.path.join(output_dir, name))
+                    writes.append(
+                        write_output(
+                            ds_RP,
+                            name,
+                            model_key,
+                            compute,
+                            output_dir,
+                            attrs,
+                        )
+                    )
+                    hist_done = True
+                    del ds_RP
+                    gc.collect()
+                    logger.info(f"Historique traité pour {model_key}")
+
+                for RWL in RWL_LIST:
+                    logger.info(f"=== {experiment} RWL : {RWL} ===")
+                    pivot = row[RWL]
+                    if pd.isna(pivot):
+                        pivot = 2085
+                    else:
+                        pivot = min(int(pivot), 2085)
+
+                    # ------------------------
+                    # Scénario
+                    # ------------------------
+                    start, end = get_period(False, pivot)
+
+                    ds_RP = fit_period(
+                        ds_ssp,
+                        ssp_path,
+                        VAR,
+                        start,
+                        end,
+                        periods,
+                        model_key,
+                        executor,
+                        store_dir,
+                        key,
+                        regional,
+                    )
+                    name = f"{VAR}_RP_{label}_{model_key}_+{RWL}.nc"
+                    written.append(os.path.join(output_dir, name))
+                    writes.append(
+                        write_output(
+                            ds_RP,
+                            name,
+                            model_key,
+                            compute,
+                            output_dir,
+                            attrs,
+                        )
+                    )
+
+                    del ds_RP
+                    gc.collect()
+
+                    logger.info(
+                        f"{experiment} RWL {RWL} terminée "
+                        f"({(time.time()-datestart)/60:.2f} min)"
+                    )
+
+                compute_writes(writes, model_key)
 
     logger.info(f"Temps total : {(time.time()-datestart)/60:.2f} min")
 
@@ -204,49 +727,84 @@ def process_netcdf_bunch():
             datasets = []
             for f in files:
                 ds = xr.open_dataset(f)
-                if "gev_params" in ds:
-                    ds = ds.drop_vars("gev_params")
+                if mask_poor_fits:
+                    ds = mask_cells(ds)
+                for params in [
+                    "gev_params",
+                    "gev_params_ns",
+                    "converged",
+                    *DIAGNOSTICS,
+                ]:
+                    if params in ds:
+                        ds = ds.drop_vars(params)
 
                 datasets.append(ds)
 
-            ds_all = xr.concat(
-                datasets, dim="modele", compat="override", coords="minimal"
-            )
+            with stage("ensemble", model=out_prefix):
+                ds_all = xr.concat(
+                    datasets, dim="modele", compat="override", coords="minimal"
+                )
 
-            ds_all.median(dim="modele").to_netcdf(
-                os.path.join(input_path, f"{out_prefix}_median.nc")
-            )
-            ds_all.quantile(0.95, dim="modele").to_netcdf(
-                os.path.join(input_path, f"{out_prefix}_sup.nc")
-            )
-            ds_all.quantile(0.05, dim="modele").to_netcdf(
-                os.path.join(input_path, f"{out_prefix}_inf.nc")
-            )
+                statistics = {
+                    "median": ds_all.median(dim="modele"),
+                    "sup": ds_all.quantile(0.95, dim="modele"),
+                    "inf": ds_all.quantile(0.05, dim="modele"),
+                }
+                for name, ds_stat in statistics.items():
+                    path = os.path.join(input_path, f"{out_prefix}_{name}.nc")
+                    ds_stat.assign_attrs(attrs).to_netcdf(path)
+                    written.append(path)
+
+        labels = [SCENARIOS[exp] for exp in scenarios]
+        if nonstationary:
+            for label in labels:
+                ns_files = [
+                    os.path.join(output_dir, f)
+                    for f in os.listdir(output_dir)
+                    if f.startswith(f"{var}_RP_ns_{label}_")
+                    and f.endswith(".nc")
+                    and not f.endswith(("_median.nc", "_sup.nc", "_inf.nc"))
+                ]
+                load_concat_reduce(ns_files, f"{var}_RP_ns_{label}")
+            logger.info("\nReconstruction terminée.")
+            return
+
+        # --- Historique, commun à tous les scénarios ---
+        logger.info("\nReconstruction médianes / quantiles historiques")
+        hist_files = [
+            os.path.join(output_dir, f)
+            for f in os.listdir(output_dir)
+            if f.startswith(f"{var}_RP_hist_")
+            and f.endswith(".nc")
+            and not f.startswith(f"{var}_RP_hist_ref")
+        ]
+        load_concat_reduce(hist_files, f"{var}_RP_hist_ref")
+
+        for label in labels:
+            for RWL in RWL_list:
+                logger.info(
+                    f"\nReconstruction médianes / quantiles pour {label} "
+                    f"RWL {RWL}"
+                )
+                ssp_files = [
+                    os.path.join(output_dir, f)
+                    for f in os.listdir(output_dir)
+                    if f.startswith(f"{var}_RP_{label}_")
+                    and f.endswith(f"+{RWL}.nc")
+                ]
+                load_concat_reduce(ssp_files, f"{var}_RP_{label}_+{RWL}")
 
-        for RWL in RWL_list:
-            logger.info(
-                f"\nReconstruction médianes / quantiles pour RWL {RWL}"
-            )
+        logger.info("\nReconstruction terminée.")
 
-            # # --- Historique ---
-            hist_files = [
-                os.path.join(output_dir, f)
-                for f in os.listdir(output_dir)
-                if f.startswith(f"{var}_RP_hist_") and f.endswith(".nc")
-            ]
-            load_concat_reduce(hist_files, f"{var}_RP_hist_ref")
-
-            # --- SSP370 ---
-            ssp_files = [
-                os.path.join(output_dir, f)
-                for f in os.listdir(output_dir)
-                if f.startswith(f"{var}_RP_ssp3_") and f.endswith(f"+{RWL}.nc")
-            ]
-            load_concat_reduce(ssp_files, f"{var}_RP_ssp3_+{RWL}")
+    compute_final_statistics(output_dir, output_dir, VAR, RWL_list=RWL_LIST)
 
-        logger.info("\nReconstruction terminée.")
+    logger.info(f"Bilan par étape :\n{summary().to_string()}")
 
-    compute_final_statistics("out", OUTPUT, VAR, RWL_list=["2C", "2.7C", "4C"])
+    if client is not None:
+        client.close()
+    if executor is not None:
+        executor.shutdown()
+    return written
 
 
 if __name__ == "__main__":
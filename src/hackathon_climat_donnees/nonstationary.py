@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ajustement GEV non-stationnaire sur la série complète 1950-2100
+
+La position et l'échelle de la GEV dépendent linéairement du niveau de
+réchauffement du modèle (covariable) :
+
+    mu(T) = mu0 + mu1 * T
+    log(sigma(T)) = phi0 + phi1 * T
+    xi constant
+
+Un seul ajustement par maille permet ensuite de calculer les niveaux de
+retour pour n'importe quel niveau de réchauffement.
+
+Les mailles sont ajustées par blocs : une seule minimisation L-BFGS-B de la
+somme des log-vraisemblances du bloc, avec gradient analytique par maille.
+L'arrêt portant sur l'objectif du bloc, les tolérances sont serrées et la
+convergence est évaluée maille par maille (norme du gradient projeté) ; les
+niveaux de retour ne dépendent du découpage qu'aux tolérances près (cf.
+check_chunking).
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.optimize import minimize
+
+from hackathon_climat_donnees.constants import RWL_HIST_ANCHORS
+
+logger = logging.getLogger(__name__)
+
+NS_PARAMS = ["mu0", "mu1", "phi0", "phi1", "xi"]
+
+# Bornes sur le paramètre de forme (convention xi, opposée à celle de scipy)
+XI_BOUNDS = (-0.5, 0.5)
+
+# Seuil en-deçà duquel 1 + xi * z est considéré hors support
+_EPS = 1e-8
+_PENALTY = 1e4
+
+
+def warming_level_covariate(
+    years: np.ndarray, pivots: dict, anchors: dict = None
+) -> np.ndarray:
+    """
+    Construit la covariable "niveau de réchauffement" année par année à
+    partir des années pivots TRACC d'un modèle.
+
+    La série est interpolée linéairement entre les points d'ancrage
+    historiques et les années pivots, puis prolongée linéairement au-delà du
+    dernier point connu.
+
+    Parameters
+    ----------
+    years : np.ndarray
+        Années pour lesquelles calculer la covariable.
+    pivots : dict
+        Années pivots du modèle, par niveau de réchauffement.
+        Ex. : {2.0: 2033, 2.7: 2050, 4.0: 2072}. Les valeurs manquantes
+        (NaN, None) sont ignorées.
+    anchors : dict, optional
+        Points d'ancrage historiques {année: niveau}. Par défaut,
+        RWL_HIST_ANCHORS (réchauffement observé en France, même échelle que
+        les niveaux TRACC). Les points postérieurs à la première année
+        pivot sont ignorés.
+
+    Returns
+    -------
+    gwl : np.ndarray
+        Niveau de réchauffement pour chaque année.
+
+    """
+    if anchors is None:
+        anchors = RWL_HIST_ANCHORS
+    pivots = {
+        float(year): float(level)
+        for level, year in pivots.items()
+        if year is not None and not pd.isna(year)
+    }
+    first = min(pivots, default=np.inf)
+    points = {
+        float(year): level
+        for year, level in anchors.items()
+        if float(year) < first
+    }
+    points.update(pivots)
+
+    xp = np.array(sorted(points))
+    fp = np.array([points[x] for x in xp])
+
+    years = np.asarray(years, dtype=float)
+    gwl = np.interp(years, xp, fp)
+
+    # prolongation linéaire aux extrémités
+    slope_end = (fp[-1] - fp[-2]) / (xp[-1] - xp[-2])
+    after = years > xp[-1]
+    gwl[after] = fp[-1] + slope_end * (years[after] - xp[-1])
+    slope_start = (fp[1] - fp[0]) / (xp[1] - xp[0])
+    before = years < xp[0]
+    gwl[before] = fp[0] + slope_start * (years[before] - xp[0])
+    return gwl
+
+
+def _nll_and_grad(
+    theta: np.ndarray, x: np.ndarray, gwl: np.ndarray, mask: np.ndarray
+) -> tuple[float, np.ndarray]:
+    """
+    Log-vraisemblance négative d'un bloc de mailles et son gradient.
+
+    L'objectif est la somme des log-vraisemblances négatives des mailles ;
+    chaque maille n'intervenant que dans ses propres termes, le gradient
+    par rapport aux paramètres d'une maille est celui de sa seule
+    log-vraisemblance.
+
+    Parameters
+    ----------
+    theta : np.ndarray
+        Paramètres aplatis paramètre par paramètre, de forme (5 * n_cells,) :
+        (mu0 de toutes les mailles, puis mu1, phi0, phi1 et xi).
+    x : np.ndarray
+        Maxima annuels standardisés, de forme (n_years, n_cells). Les valeurs
+        masquées doivent être finies (elles sont ignorées).
+    gwl : np.ndarray
+        Covariable, de forme (n_years,).
+    mask : np.ndarray
+        Masque des valeurs valides, de forme (n_years, n_cells).
+
+    Returns
+    -------
+    nll : float
+        Somme des log-vraisemblances négatives des mailles.
+    grad : np.ndarray
+        Gradient, de même forme et même ordre que `theta`.
+
+    """
+    mu0, mu1, phi0, phi1, xi = theta.reshape(5, x.shape[1])
+    T = gwl[:, None]
+
+    # éviter la singularité en xi = 0
+    xi = np.where(np.abs(xi) < 1e-6, np.copysign(1e-6, xi), xi)
+
+    mu = mu0 + mu1 * T
+    phi = phi0 + phi1 * T
+    sigma = np.exp(phi)
+    z = (x - mu) / sigma
+    t = 1 + xi * z
+
+    # hors support : pénalité linéaire pour garder un objectif fini
+    outside = (t < _EPS) & mask
+    t_safe = np.where(t < _EPS, _EPS, t)
+
+    y = np.log(t_safe)
+    A = np.exp(np.minimum(-y / xi, 700))
+    nll = phi + (1 + 1 / xi) * y + A
+    nll = np.where(outside, phi + _PENALTY * (1 + _EPS - t), nll)
+    nll = np.where(mask, nll, 0)
+
+    # dérivées par rapport à mu, phi et xi
+    common = ((xi + 1) - A) / t_safe
+    d_mu = -common / sigma
+    d_phi = 1 - z * common
+    d_xi = -y / xi**2 * (1 - A) + z / t_safe * ((1 + 1 / xi) - A / xi)
+
+    # contribution de la pénalité (dt/dmu = -xi/sigma, etc.)
+    d_mu = np.where(outside, _PENALTY * xi / sigma, d_mu)
+    d_phi = np.where(outside, 1 + _PENALTY * xi * z, d_phi)
+    d_xi = np.where(outside, -_PENALTY * z, d_xi)
+
+    d_mu = np.where(mask, d_mu, 0)
+    d_phi = np.where(mask, d_phi, 0)
+    d_xi = np.where(mask, d_xi, 0)
+
+    grad = np.concatenate(
+        [
+            d_mu.sum(axis=0),
+            (d_mu * T).sum(axis=0),
+            d_phi.sum(axis=0),
+            (d_phi * T).sum(axis=0),
+            d_xi.sum(axis=0),
+        ]
+    )
+    return nll.sum(), grad
+
+
+def _initial_params(x: np.ndarray, gwl: np.ndarray, mask: np.ndarray):
+    """
+    Point de départ d'un bloc de mailles (données standardisées) :
+    régression linéaire de la position sur la covariable, échelle tirée de
+    l'écart-type des résidus (méthode des moments, Gumbel).
+    """
+    n_cells = x.shape[1]
+    w = mask.astype(float)
+    n = w.sum(axis=0)
+    T = gwl[:, None]
+    t_mean = (w * T).sum(axis=0) / n
+    x_mean = (w * x).sum(axis=0) / n
+    cov = (w * (T - t_mean) * (x - x_mean)).sum(axis=0)
+    var = (w * (T - t_mean) ** 2).sum(axis=0)
+    mu1 = np.where(var > 0, cov / np.where(var > 0, var, 1), 0)
+    resid = x - x_mean - mu1 * (T - t_mean)
+    scale = np.sqrt((w * resid**2).sum(axis=0) / n) * np.sqrt(6) / np.pi
+    scale = np.where(scale > 0, scale, 1)
+    mu0 = x_mean - mu1 * t_mean - 0.5772 * scale
+    return np.concatenate(
+        [mu0, mu1, np.log(scale), np.zeros(n_cells), np.full(n_cells, -0.1)]
+    )
+
+
+def _fit_batch(
+    x: np.ndarray, gwl: np.ndarray, mask: np.ndarray, maxiter: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Ajuste simultanément un bloc de mailles (données standardisées), par une
+    seule minimisation L-BFGS-B de la somme de leurs log-vraisemblances.
+
+    Returns
+    -------
+    params : np.ndarray
+        Paramètres de forme (5, n_cells).
+    grad_norm : np.ndarray
+        Norme du gradient projeté par maille (moyenné par année) à la
+        convergence.
+
+    """
+    n_cells = x.shape[1]
+    bounds = [(None, None)] * (4 * n_cells) + [XI_BOUNDS] * n_cells
+
+    # tolérances serrées : l'arrêt porte sur l'objectif du bloc, chaque
+    # maille doit néanmoins atteindre son propre optimum
+    res = minimize(
+        _nll_and_grad,
+        _initial_params(x, gwl, mask),
+        args=(x, gwl, mask),
+        jac=True,
+        method="L-BFGS-B",
+        bounds=bounds,
+        options={
+            "maxiter": maxiter,
+            "maxfun": 2 * maxiter,
+            "ftol": 1e-12,
+            "gtol": 1e-6,
+        },
+    )
+    _, grad = _nll_and_grad(res.x, x, gwl, mask)
+
+    # gradient projeté : sur une borne de xi, la composante sortante est nulle
+    params = res.x.reshape(5, n_cells)
+    grad = grad.reshape(5, n_cells)
+    at_lower = np.isclose(params[4], XI_BOUNDS[0]) & (grad[4] > 0)
+    at_upper = np.isclose(params[4], XI_BOUNDS[1]) & (grad[4] < 0)
+    grad[4] = np.where(at_lower | at_upper, 0, grad[4])
+    grad_norm = np.sqrt((grad**2).sum(axis=0)) / mask.sum(axis=0)
+    return params, grad_norm
+
+
+def fit_gev_nonstationary(
+    maxima: np.ndarray,
+    gwl: np.ndarray,
+    min_years: int = 20,
+    batch_size: int = 64,
+    maxiter: int = 1000,
+    gtol: float = 1e-3,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Ajustement vectorisé d'une GEV non-stationnaire sur un ensemble de
+    mailles, par blocs de `batch_size` mailles.
+
+    Parameters
+    ----------
+    maxima : np.ndarray
+        Maxima annuels, de forme (n_years, n_cells).
+    gwl : np.ndarray
+        Niveau de réchauffement de chaque année, de forme (n_years,).
+    min_years : int, optional
+        Nombre minimal d'années valides pour ajuster une maille. 20 par
+        défaut.
+    batch_size : int, optional
+        Nombre de mailles optimisées simultanément. 64 par défaut.
+    maxiter : int, optional
+        Nombre maximal d'itérations L-BFGS-B par bloc. 1000 par défaut.
+    gtol : float, optional
+        Seuil sur la norme du gradient (moyenné par année) en-deçà duquel une
+        maille est considérée convergée. 1e-3 par défaut.
+
+    Returns
+    -------
+    params : np.ndarray
+        Paramètres (mu0, mu1, phi0, phi1, xi), de forme (5, n_cells).
+        NaN pour les mailles non ajustées.
+    converged : np.ndarray
+        Indicateur de convergence par maille, de forme (n_cells,).
+
+    """
+    maxima = np.asarray(maxima, dtype=float)
+    gwl = np.asarray(gwl, dtype=float)
+    n_cells = maxima.shape[1]
+
+    params = np.full((5, n_cells), np.nan)
+    converged = np.zeros(n_cells, dtype=bool)
+
+    mask = np.isfinite(maxima)
+    valid = np.flatnonzero(mask.sum(axis=0) >= min_years)
+
+    for start in range(0, valid.size, batch_size):
+        cells = valid[start : start + batch_size]
+        x = maxima[:, cells]
+        m = mask[:, cells]
+
+        # standardisation par maille pour le conditionnement
+        loc = np.nanmean(x, axis=0)
+        scale = np.nanstd(x, axis=0)
+        scale = np.where(scale > 0, scale, 1)
+        xs = np.where(m, (x - loc) / scale, 0)
+
+        p, grad_norm = _fit_batch(xs, gwl, m, maxiter)
+
+        # retour à l'échelle d'origine
+        params[0, cells] = loc + scale * p[0]
+        params[1, cells] = scale * p[1]
+        params[2, cells] = np.log(scale) + p[2]
+        params[3, cells] = p[3]
+        params[4, cells] = p[4]
+        converged[cells] = grad_norm < gtol
+
+        logger.info(
+            "GEV non-stationnaire : %s/%s mailles ajustées",
+            min(start + batch_size, valid.size),
+            valid.size,
+        )
+
+    return params, converged
+
+
+def return_levels_nonstationary(
+    params: np.ndarray, warming_levels: np.ndarray, periods: np.ndarray
+) -> np.ndarray:
+    """
+    Niveaux de retour pour des niveaux de réchauffement quelconques.
+
+    Parameters
+    ----------
+    params : np.ndarray
+        Paramètres (mu0, mu1, phi0, phi1, xi), de forme (5, n_cells).
+    warming_levels : np.ndarray
+        Niveaux de réchauffement, de forme (n_wl,).
+    periods : np.ndarray
+        Périodes de retour, de forme (n_periods,).
+
+    Returns
+    -------
+    rl : np.ndarray
+        Niveaux de retour, de forme (n_wl, n_periods, n_cells).
+
+    """
+    mu0, mu1, phi0, phi1, xi = params
+    T = np.asarray(warming_levels, dtype=float)[:, None, None]
+    p = np.asarray(periods, dtype=float)[None, :, None]
+
+    mu = mu0 + mu1 * T
+    sigma = np.exp(phi0 + phi1 * T)
+    yp = -np.log(1 - 1 / p)
+    return mu + sigma / xi * (yp ** (-xi) - 1)
+
+
+def _fit_block(
+    values: np.ndarray,
+    gwl: np.ndarray,
+    warming_levels: np.ndarray,
+    periods: np.ndarray,
+    **kwargs,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Ajuste un bloc de mailles de forme (..., time), pour xr.apply_ufunc.
+    """
+    shape = values.shape[:-1]
+    params, converged = fit_gev_nonstationary(
+        values.reshape(-1, values.shape[-1]).T, gwl, **kwargs
+    )
+    rl = return_levels_nonstationary(params, warming_levels, periods)
+    return (
+        np.moveaxis(rl, -1, 0).reshape(*shape, *rl.shape[:2]),
+        params.T.reshape(*shape, len(NS_PARAMS)),
+        converged.reshape(shape),
+    )
+
+
+def fit_nonstationary(
+    maximums: xr.DataArray,
+    gwl: np.ndarray,
+    warming_levels: np.ndarray,
+    periods: np.ndarray,
+    **kwargs,
+) -> xr.Dataset:
+    """
+    Ajustement non-stationnaire d'un DataArray de maxima annuels.
+
+    Compatible avec les DataArray découpés en blocs (dask) : chaque bloc
+    spatial est ajusté indépendamment.
+
+    Parameters
+    ----------
+    maximums : xr.DataArray
+        Maxima annuels de dimensions (time, y, x), sur toute la série
+        (historique + scénario).
+    gwl : np.ndarray
+        Niveau de réchauffement pour chaque pas de temps de `maximums`.
+    warming_levels : np.ndarray
+        Niveaux de réchauffement pour lesquels calculer les niveaux de
+        retour.
+    periods : np.ndarray
+        Périodes de retour.
+    **kwargs
+        Arguments transmis à fit_gev_nonstationary.
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Dataset contenant "return_levels" (warming_level, periods, y, x),
+        "gev_params_ns" (y, x, gev_params_ns) et "converged" (y, x).
+
+    """
+    if maximums.chunks:
+        # l'ajustement nécessite la série complète dans un seul bloc
+        maximums = maximums.chunk({"time": -1})
+
+    rl, params, converged = xr.apply_ufunc(
+        _fit_block,
+        maximums,
+        input_core_dims=[["time"]],
+        output_core_dims=[["warming_level", "periods"], ["gev_params_ns"], []],
+        dask="parallelized",
+        output_dtypes=[float, float, bool],
+        dask_gufunc_kwargs={
+            "output_sizes": {
+                "warming_level": len(warming_levels),
+                "periods": len(periods),
+                "gev_params_ns": len(NS_PARAMS),
+            }
+        },
+        kwargs={
+            "gwl": np.asarray(gwl, dtype=float),
+            "warming_levels": np.asarray(warming_levels, dtype=float),
+            "periods": np.asarray(periods),
+            **kwargs,
+        },
+    )
+    rl = rl.assign_coords(
+        warming_level=np.asarray(warming_levels),
+        periods=np.asarray(periods),
+    ).transpose("warming_level", "periods", ...)
+    params = params.assign_coords(gev_params_ns=NS_PARAMS)
+    return xr.Dataset(
+        {
+            "return_levels": rl,
+            "gev_params_ns": params,
+            "converged": converged,
+        }
+    )
+
+
+def check_chunking(
+    maximums: xr.DataArray,
+    gwl: np.ndarray,
+    warming_levels: np.ndarray,
+    periods: np.ndarray,
+    chunks: dict,
+    rtol: float = 1e-4,
+    **kwargs,
+) -> xr.Dataset:
+    """
+    Vérifie que l'ajustement découpé en blocs (dask) reproduit l'ajustement
+    direct, par exemple sur un extrait de grille avant un run complet en mode
+    découpé.
+
+    Les mailles étant optimisées par blocs, les niveaux de retour ne sont
+    identiques qu'aux tolérances de l'optimisation près ; les indicateurs de
+    convergence doivent être identiques.
+
+    Parameters
+    ----------
+    maximums : xr.DataArray
+        Maxima annuels de dimensions (time, y, x).
+    gwl : np.ndarray
+        Niveau de réchauffement pour chaque pas de temps de `maximums`.
+    warming_levels : np.ndarray
+        Niveaux de réchauffement.
+    periods : np.ndarray
+        Périodes de retour.
+    chunks : dict
+        Blocs spatiaux, ex. {"y": 64, "x": 64}.
+    rtol : float, optional
+        Tolérance relative sur les niveaux de retour. 1e-4 par défaut.
+    **kwargs
+        Arguments transmis à fit_gev_nonstationary.
+
+    Raises
+    ------
+    AssertionError
+        Si les niveaux de retour diffèrent au-delà de `rtol` ou si les
+        indicateurs de convergence diffèrent.
+
+    Returns
+    -------
+    ds : xr.Dataset
+        Résultat de l'ajustement direct.
+
+    """
+    eager = fit_nonstationary(
+        maximums.load(), gwl, warming_levels, periods, **kwargs
+    )
+    chunked = fit_nonstationary(
+        maximums.chunk(chunks), gwl, warming_levels, periods, **kwargs
+    ).compute()
+    xr.testing.assert_allclose(
+        eager["return_levels"], chunked["return_levels"], rtol=rtol
+    )
+    xr.testing.assert_equal(eager["converged"], chunked["converged"])
+    return eager
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fichiers d'ensemble et index des niveaux de retour aux sites
+
+Les fichiers d'ensemble produits par netcdf_processing
+(<var>_RP_<scénario>_<statistique>.nc) sont repérés par leur nom
+(list_outputs, parse_output_name, output_labels), puis chargés en un seul
+tableau (load_grid_outputs) ; SiteIndex y apparie chaque site à sa maille
+la plus proche et répond aux requêtes par site, emprise ou point.
+
+Ces briques sont partagées par la jointure (join_netcdf), l'agrégation
+(regrid), l'export web (web_export) et le service HTTP (service).
+
+Ex.:
+    >>> from hackathon_climat_donnees.outputs import SiteIndex, list_outputs
+    >>> index = SiteIndex(gdf, list_outputs())
+    >>> index.query("site", ("0003205293",), scenario="ssp3_+2C")
+"""
+
+import json
+import logging
+import os
+import re
+from functools import lru_cache
+from glob import glob
+
+import numpy as np
+
+from hackathon_climat_donnees import OUTPUT
+
+logger = logging.getLogger(__name__)
+
+STATISTICS = ["median", "sup", "inf"]
+
+OUTPUT_PATTERN = re.compile(
+    r"^(?P<var>[^_]+)_RP_(?P<scenario>.+)_(?P<statistic>median|sup|inf)\.nc$"
+)
+
+
+def parse_output_name(path: str) -> tuple[str, str]:
+    """
+    Scénario et statistique d'un fichier d'ensemble.
+
+    Ex. : "tasmaxAdjust_RP_ssp3_+2C_median.nc" -> ("ssp3_+2C", "median")
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier.
+
+    Raises
+    ------
+    ValueError
+        Si le nom ne correspond pas à un fichier d'ensemble.
+
+    Returns
+    -------
+    tuple[str, str]
+        Scénario, statistique.
+
+    """
+    match = OUTPUT_PATTERN.match(os.path.basename(path))
+    if match is None:
+        raise ValueError(f"fichier d'ensemble non reconnu : {path}")
+    return match["scenario"], match["statistic"]
+
+
+def output_labels(path: str, labels: list) -> tuple[list, list]:
+    """
+    Scénario et statistique de chaque sortie d'un fichier de résultats.
+
+    Une dimension supplémentaire (ex. warming_level des fichiers
+    non-stationnaires) est dépliée en autant de scénarios :
+    "ns_ssp3" au niveau 2 -> "ns_ssp3_+2C".
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier. Si son nom n'est pas celui d'un fichier
+        d'ensemble, le scénario est le nom du fichier (sans extension) et
+        la statistique None.
+    labels : list
+        Valeurs de la dimension supplémentaire, ou [None] s'il n'y en a pas.
+
+    Returns
+    -------
+    tuple[list, list]
+        Scénarios et statistiques, une entrée par valeur de `labels`.
+
+    """
+    match = OUTPUT_PATTERN.match(os.path.basename(path))
+    if match is None:
+        scenario = os.path.splitext(os.path.basename(path))[0]
+        statistic = None
+    else:
+        scenario, statistic = match["scenario"], match["statistic"]
+    scenarios = [
+        scenario if label is None else f"{scenario}_+{label:g}C"
+        for label in labels
+    ]
+    return scenarios, [statistic] * len(labels)
+
+
+def list_outputs(output_dir: str = OUTPUT, var: str = "*") -> list[str]:
+    "Fichiers d'ensemble présents dans `output_dir`"
+    return sorted(
+        path
+        for statistic in STATISTICS
+        for path in glob(
+            os.path.join(output_dir, f"{var}_RP_*_{statistic}.nc")
+        )
+        if OUTPUT_PATTERN.match(os.path.basename(path))
+    )
+
+
+def outputs_fingerprint(paths: list[str]) -> tuple:
+    "Empreinte (nom, taille, date) d'un ensemble de fichiers"
+    return tuple(
+        (os.path.basename(p), os.path.getsize(p), os.path.getmtime(p))
+        for p in paths
+    )
+
+
+def load_grid_outputs(paths: list[str]) -> dict:
+    """
+    Charge les niveaux de retour de fichiers d'ensemble partageant la même
+    grille.
+
+    Les dimensions supplémentaires (ex. warming_level des fichiers
+    non-stationnaires) sont dépliées en autant de scénarios.
+
+    Parameters
+    ----------
+    paths : list[str]
+        Fichiers d'ensemble.
+
+    Raises
+    ------
+    FileNotFoundError
+        Si `paths` est vide.
+    ValueError
+        Si les fichiers ne partagent pas la même grille.
+
+    Returns
+    -------
+    dict
+        scenarios, statistics (listes alignées, une entrée par sortie),
+        periods, x, y (coordonnées de la grille, EPSG:27572) et values,
+        tableau float32 de forme (n_sorties, n_mailles, n_périodes).
+
+    """
+    import xarray as xr
+
+    if not paths:
+        raise FileNotFoundError("aucun fichier d'ensemble")
+    scenarios, statistics, arrays = [], [], []
+    x = y = periods = None
+    for path in paths:
+        # fichiers d'ensemble uniquement (ValueError sinon)
+        parse_output_name(path)
+        with xr.open_dataset(path) as ds:
+            rl = ds["return_levels"]
+            if x is None:
+                x, y = rl["x"].values, rl["y"].values
+                periods = rl["periods"].values
+            elif not (
+                np.array_equal(x, rl["x"].values)
+                and np.array_equal(y, rl["y"].values)
+            ):
+                raise ValueError(f"grille différente : {path}")
+
+            extra = [d for d in rl.dims if d not in ("y", "x", "periods")]
+            rl = rl.transpose(*extra, "y", "x", "periods")
+            values = rl.values.reshape(-1, len(y) * len(x), len(periods))
+            labels = rl[extra[0]].values.tolist() if extra else [None]
+            names, stats = output_labels(path, labels)
+            scenarios += names
+            statistics += stats
+            arrays += list(values)
+
+    return {
+        "scenarios": scenarios,
+        "statistics": statistics,
+        "periods": periods,
+        "x": x,
+        "y": y,
+        "values": np.stack(arrays).astype(np.float32),
+    }
+
+
+class SiteIndex:
+    """
+    Index en mémoire des niveaux de retour, par site et par maille.
+
+    Parameters
+    ----------
+    sites : gpd.GeoDataFrame
+        Sites (colonne code_aiot, géométries ponctuelles).
+    paths : list[str]
+        Fichiers d'ensemble à charger.
+    cache_size : int, optional
+        Nombre de réponses conservées dans le cache LRU. 4096 par défaut.
+
+    """
+
+    def __init__(self, sites, paths: list[str], cache_size: int = 4096):
+        from pyproj import Transformer
+        from scipy.spatial import cKDTree
+
+        grid = load_grid_outputs(paths)
+        self.fingerprint = outputs_fingerprint(paths)
+        self.scenarios = np.array(grid["scenarios"])
+        self.statistics = np.array(grid["statistics"])
+        self.periods = grid["periods"]
+        self.values = grid["values"]
+
+        # centres des mailles valides, en Lambert 93 (comme join_netcdf)
+        xx, yy = np.meshgrid(grid["x"], grid["y"])
+        valid = np.isfinite(self.values).any(axis=(0, 2))
+        self.cells = np.flatnonzero(valid)
+        to_2154 = Transformer.from_crs(27572, 2154, always_xy=True)
+        cx, cy = to_2154.transform(xx.ravel()[valid], yy.ravel()[valid])
+        self.tree = cKDTree(np.column_stack([cx, cy]))
+        self.from_4326 = Transformer.from_crs(4326, 2154, always_xy=True)
+
+        # appariement des sites à la maille la plus proche
+        sites = sites.to_crs(2154)
+        self.codes = sites["code_aiot"].astype(str).to_numpy()
+        self.site_xy = np.column_stack([sites.geometry.x, sites.geometry.y])
+        to_4326 = Transformer.from_crs(2154, 4326, always_xy=True)
+        lon, lat = to_4326.transform(self.site_xy[:, 0], self.site_xy[:, 1])
+        self.site_lonlat = np.column_stack([lon, lat])
+        _, nearest = self.tree.query(self.site_xy)
+        self.site_cells = self.cells[nearest]
+        self.site_values = self.values[:, self.site_cells, :]
+        self.positions = {code: i for i, code in enumerate(self.codes)}
+
+        self.query = lru_cache(maxsize=cache_size)(self._query)
+
+    def _select(self, scenario, statistic, period) -> tuple:
+        outputs = np.ones(len(self.scenarios), dtype=bool)
+        if scenario is not None:
+            outputs &= self.scenarios == scenario
+        if statistic is not None:
+            outputs &= self.statistics == statistic
+        periods = np.ones(len(self.periods), dtype=bool)
+        if period is not None:
+            periods = self.periods == int(period)
+        return np.flatnonzero(outputs), np.flatnonzero(periods)
+
+    def _format(self, values, outputs, periods) -> dict:
+        "{scénario: {statistique: {période: valeur}}}"
+        result = {}
+        for i, output in enumerate(outputs):
+            scenario = str(self.scenarios[output])
+            statistic = str(self.statistics[output])
+            result.setdefault(scenario, {})[statistic] = {
+                str(self.periods[p]): (
+                    round(float(values[i, j]), 3)
+                    if np.isfinite(values[i, j])
+                    else None
+                )
+                for j, p in enumerate(periods)
+            }
+        return result
+
+    def _query(
+        self,
+        kind: str,
+        key: tuple,
+        scenario: str = None,
+        statistic: str = None,
+        period: int = None,
+    ) -> bytes:
+        outputs, periods = self._select(scenario, statistic, period)
+
+        if kind == "site":
+            (code,) = key
+            if code not in self.positions:
+                return None
+            i = self.positions[code]
+            values = self.site_values[np.ix_(outputs, [i], periods)][:, 0]
+            result = {
+                "code_aiot": code,
+                "values": self._format(values, outputs, periods),
+            }
+
+        elif kind == "bbox":
+            xmin, ymin, xmax, ymax = key
+            lon, lat = self.site_lonlat[:, 0], self.site_lonlat[:, 1]
+            inside = np.flatnonzero(
+                (lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax)
+            )
+            values = self.site_values[np.ix_(outputs, inside, periods)]
+            result = {
+                "sites": [
+                    {
+                        "code_aiot": self.codes[i],
+                        "values": self._format(values[:, k], outputs, periods),
+                    }
+                    for k, i in enumerate(inside)
+                ]
+            }
+
+        elif kind == "point":
+            lat, lon = key
+            x, y = self.from_4326.transform(lon, lat)
+            distance, nearest = self.tree.query([x, y])
+            cell = self.cells[nearest]
+            values = self.values[np.ix_(outputs, [cell], periods)][:, 0]
+            result = {
+                "lat": lat,
+                "lon": lon,
+                "distance": round(float(distance), 1),
+                "values": self._format(values, outputs, periods),
+            }
+
+        else:
+            raise ValueError(f"requête inconnue : {kind}")
+
+        return json.dumps(result).encode("utf8")
@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Orchestration de la chaîne complète avec mise en cache des étapes
+
+La chaîne prep_datasets -> netcdf_processing -> join_netcdf est décrite
+comme un graphe d'étapes, chacune déclarant ses dépendances, ses fichiers
+d'entrée, ses paramètres et les fichiers qu'elle produit :
+
+    icpe    (prep_dataset_icpe)     -> OUTPUT/sample.gpkg, sample.csv
+    netcdf  (process_netcdf_bunch)  -> OUTPUT/<var>_RP_*.nc (écrits par le
+                                       run, ou OUTPUT/preview en aperçu)
+    join    (all_scenarii)          -> OUTPUT/scenarii.csv
+            dépend de icpe et netcdf
+    export  (export_bundle)         -> OUTPUT/web/manifest.json, shards/*
+            dépend de icpe et netcdf
+
+Chaque étape est identifiée par une empreinte (sha1) de ses paramètres, de
+ses fichiers d'entrée, du code des modules qui l'implémentent et des
+sorties de ses dépendances. L'empreinte et l'empreinte des sorties sont
+conservées dans OUTPUT/pipeline/<étape>.json : une étape n'est relancée que
+si l'une de ces empreintes a changé ou si ses sorties ont été modifiées ou
+supprimées. Les étapes indépendantes (icpe et netcdf) sont exécutées en
+parallèle.
+
+Les entrées de l'étape icpe (inventaire Géorisques) sont distantes et ne
+peuvent pas être identifiées par empreinte : l'étape a une durée de validité
+(max_age, par défaut celle du cache HTTP, CACHE_DURATION_SECONDS) au-delà de
+laquelle elle est relancée, en mode incrémental le cas échéant. Plus tôt,
+`--force icpe` la relance, mais relit alors les réponses en cache.
+
+Ex.:
+    >>> from hackathon_climat_donnees.pipeline import run
+    >>> run()  # reconstruit seulement ce qui est périmé
+    {'icpe': False, 'netcdf': True, 'join': True, 'export': True}
+
+    ou :
+    python -m hackathon_climat_donnees run join --workers 2
+    python -m hackathon_climat_donnees stages
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from glob import glob
+from typing import Callable
+
+from hackathon_climat_donnees import INPUT, OUTPUT
+from hackathon_climat_donnees.constants import CACHE_DURATION_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_DIR = os.path.join(OUTPUT, "pipeline")
+
+# au-delà, les fichiers sont identifiés par taille et date de modification
+# plutôt que par leur contenu (fichiers d'entrée DRIAS de plusieurs Go)
+HASH_MAX_BYTES = 64 * 1024**2
+
+PACKAGE_DIR = os.path.dirname(__file__)
+
+
+@dataclass
+class Stage:
+    """
+    Etape de la chaîne.
+
+    Attributes
+    ----------
+    name : str
+        Nom de l'étape.
+    run : Callable[[dict], list[str]]
+        Fonction exécutant l'étape à partir de ses paramètres et renvoyant
+        les chemins des fichiers produits.
+    artifact : str
+        Type des fichiers produits (ex. "geodataframe", "netcdf",
+        "table"), informatif.
+    deps : list[str]
+        Etapes dont les sorties sont utilisées.
+    inputs : Callable[[], list[str]]
+        Fichiers d'entrée (hors sorties des dépendances).
+    modules : list[str]
+        Modules du paquet implémentant l'étape : toute modification de leur
+        code invalide le cache.
+    params : dict
+        Paramètres de l'étape, transmis à `run`.
+    max_age : float
+        Durée de validité (s) des sorties, pour les étapes dont les entrées
+        sont distantes : au-delà, l'étape est relancée même si son empreinte
+        est inchangée. None (par défaut) : pas de limite.
+
+    """
+
+    name: str
+    run: Callable[[dict], list[str]]
+    artifact: str
+    deps: list[str] = field(default_factory=list)
+    inputs: Callable[[], list[str]] = list
+    modules: list[str] = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    max_age: float = None
+
+
+def file_hash(path: str) -> str:
+    """
+    Empreinte d'un fichier : contenu (sha1) pour les fichiers de moins de
+    HASH_MAX_BYTES, taille et date de modification au-delà.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier.
+
+    Returns
+    -------
+    str
+        Empreinte, ou "missing" si le fichier n'existe pas.
+
+    """
+    if not os.path.exists(path):
+        return "missing"
+    stat = os.stat(path)
+    if stat.st_size > HASH_MAX_BYTES:
+        return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stage_key(stage: Stage, dep_outputs: dict) -> str:
+    """
+    Empreinte d'une étape : paramètres, fichiers d'entrée, code et sorties
+    des dépendances.
+
+    Parameters
+    ----------
+    stage : Stage
+        Etape.
+    dep_outputs : dict
+        Empreintes des sorties de chaque dépendance ({étape: {chemin:
+        empreinte}}).
+
+    Returns
+    -------
+    str
+        Empreinte sha1.
+
+    """
+    content = {
+        "name": stage.name,
+        "params": stage.params,
+        "inputs": {path: file_hash(path) for path in sorted(stage.inputs())},
+        "code": {
+            module: file_hash(os.path.join(PACKAGE_DIR, module + ".py"))
+            for module in sorted(stage.modules)
+        },
+        "deps": {dep: dep_outputs[dep] for dep in sorted(stage.deps)},
+    }
+    payload = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf8")).hexdigest()
+
+
+def read_manifest(name: str, manifest_dir: str = MANIFEST_DIR) -> dict:
+    "Manifeste de la dernière exécution d'une étape (vide si absent)"
+    path = os.path.join(manifest_dir, name + ".json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def write_manifest(
+    name: str, manifest: dict, manifest_dir: str = MANIFEST_DIR
+) -> None:
+    "Ecrit le manifeste d'une étape (écriture atomique)"
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = os.path.join(manifest_dir, name + ".json")
+    with open(path + ".tmp", "w", encoding="utf8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def is_fresh(manifest: dict, key: str, max_age: float = None) -> bool:
+    """
+    True si l'étape a déjà été exécutée avec cette empreinte, il y a moins
+    de `max_age` secondes (si fourni), et que ses sorties sont inchangées.
+    """
+    if manifest.get("key") != key or not manifest.get("outputs"):
+        return False
+    if max_age is not None and (
+        time.time() - manifest.get("completed", 0) > max_age
+    ):
+        return False
+    return all(file_hash(path) == h for path, h in manifest["outputs"].items())
+
+
+# =============================================================================
+# Etapes de la chaîne
+# =============================================================================
+
+
+def _run_icpe(params: dict) -> list[str]:
+    from hackathon_climat_donnees.prep_datasets import prep_dataset_icpe
+
+    prep_dataset_icpe(save=True, **params)
+    return [
+        os.path.join(OUTPUT, "sample.gpkg"),
+        os.path.join(OUTPUT, "sample.csv"),
+    ]
+
+
+def _netcdf_inputs(scenarios: list[str] = None) -> list[str]:
+    from hackathon_climat_donnees.catalog import scenario_lists
+
+    paths = [os.path.join(INPUT, "TRACC_pivot.csv")]
+    for name in scenario_lists(scenarios or ["ssp370"]):
+        paths.append(os.path.join(INPUT, name))
+        if os.path.exists(paths[-1]):
+            with open(paths[-1]) as f:
+                paths += [
+                    os.path.join(INPUT, line.strip())
+                    for line in f
+                    if line.strip()
+                ]
+    return paths
+
+
+def _run_netcdf(params: dict) -> list[str]:
+    from hackathon_climat_donnees.netcdf_processing import (
+        process_netcdf_bunch,
+    )
+
+    # fichiers écrits par ce run uniquement (ni sorties d'un run précédent
+    # restées dans OUTPUT, ni oubli des sorties du mode aperçu)
+    return sorted(process_netcdf_bunch(**params))
+
+
+def _read_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def _run_join(params: dict) -> list[str]:
+    import geopandas as gpd
+    import pandas as pd
+
+    from hackathon_climat_donnees.join_netcdf import (
+        all_scenarii,
+        update_scenarii,
+    )
+
+    gdf = gpd.read_file(os.path.join(OUTPUT, "sample.gpkg"))
+    statistic = params.get("statistic", "median")
+    scenarii = sorted(glob(os.path.join(OUTPUT, f"*_{statistic}.nc")))
+    path = os.path.join(OUTPUT, "scenarii.csv")
+
+    # jointure limitée aux ICPE nouvelles ou modifiées (cf.
+    # prep_dataset_icpe(incremental=True)) si le résultat précédent porte
+    # sur la version précédente des ICPE et sur les mêmes fichiers netcdf
+    state_path = os.path.join(OUTPUT, "scenarii.json")
+    changes = _read_json(os.path.join(OUTPUT, "icpe_changes.json"))
+    state = _read_json(state_path)
+    sources = {os.path.basename(p): file_hash(p) for p in scenarii}
+    if (
+        changes
+        and os.path.exists(path)
+        and state.get("sources") == sources
+        and state.get("icpe") == changes["from"]
+    ):
+        previous = pd.read_csv(
+            path, sep=";", dtype={"code_aiot": str}, index_col=[0, 1]
+        )
+        codes = changes["new"] + changes["modified"]
+        logger.info("Jointure incrémentale : %s ICPE", len(codes))
+        df = update_scenarii(gdf, scenarii, previous, codes)
+    else:
+        df = all_scenarii(gdf, scenarii)
+    df.to_csv(path, sep=";")
+
+    with open(state_path, "w", encoding="utf8") as f:
+        json.dump({"icpe": changes.get("to"), "sources": sources}, f)
+    return [path]
+
+
+def _run_export(params: dict) -> list[str]:
+    import geopandas as gpd
+
+    from hackathon_climat_donnees.web_export import (
+        EXPORT_DIR,
+        bundle_files,
+        export_bundle,
+    )
+
+    gdf = gpd.read_file(os.path.join(OUTPUT, "sample.gpkg"))
+    export_bundle(gdf, **params)
+    return bundle_files(params.get("export_dir", EXPORT_DIR))
+
+
+def default_stages(
+    netcdf_params: dict = None,
+    join_params: dict = None,
+    icpe_params: dict = None,
+    export_params: dict = None,
+    icpe_max_age: float = CACHE_DURATION_SECONDS,
+) -> dict[str, Stage]:
+    """
+    Etapes de la chaîne complète.
+
+    Parameters
+    ----------
+    netcdf_params : dict, optional
+        Paramètres de process_netcdf_bunch (nonstationary, chunks,
+        n_workers, scenarios...). None par défaut.
+    join_params : dict, optional
+        Paramètres de la jointure : "statistic" (statistique d'ensemble à
+        joindre, "median" par défaut).
+    icpe_params : dict, optional
+        Paramètres de prep_dataset_icpe (selection, metropole,
+        natural_hazards). None par défaut.
+    export_params : dict, optional
+        Paramètres de web_export.export_bundle (columns, zoom...). None
+        par défaut.
+    icpe_max_age : float, optional
+        Durée de validité (s) de l'étape icpe, au-delà de laquelle
+        l'inventaire est téléchargé de nouveau. CACHE_DURATION_SECONDS par
+        défaut ; None pour ne la relancer que sur `force`.
+
+    Returns
+    -------
+    dict[str, Stage]
+        Etapes, par nom.
+
+    """
+    netcdf_params = netcdf_params or {}
+    stages = [
+        Stage(
+            name="icpe",
+            run=_run_icpe,
+            artifact="geodataframe",
+            modules=["prep_datasets", "constants"],
+            params=icpe_params or {},
+            max_age=icpe_max_age,
+        ),
+        Stage(
+            name="netcdf",
+            run=_run_netcdf,
+            artifact="netcdf",
+            inputs=lambda: _netcdf_inputs(netcdf_params.get("scenarios")),
+            modules=[
+                "netcdf_processing",
+                "nonstationary",
+                "regional",
+                "catalog",
+                "maxima_store",
+                "cluster",
+                "constants",
+            ],
+            params=netcdf_params,
+        ),
+        Stage(
+            name="join",
+            run=_run_join,
+            artifact="table",
+            deps=["icpe", "netcdf"],
+            modules=["join_netcdf"],
+            params=join_params or {"statistic": "median"},
+        ),
+        Stage(
+            name="export",
+            run=_run_export,
+            artifact="bundle",
+            deps=["icpe", "netcdf"],
+            modules=["web_export", "outputs"],
+            params=export_params or {},
+        ),
+    ]
+    return {stage.name: stage for stage in stages}
+
+
+def status(
+    stages: dict[str, Stage] = None, manifest_dir: str = MANIFEST_DIR
+) -> dict[str, str]:
+    """
+    Etat de chaque étape, sans rien exécuter.
+
+    Parameters
+    ----------
+    stages : dict[str, Stage], optional
+        Graphe des étapes. Par défaut, default_stages().
+    manifest_dir : str, optional
+        Répertoire des manifestes. MANIFEST_DIR par défaut.
+
+    Returns
+    -------
+    dict[str, str]
+        "à jour", "périmée" ou "jamais exécutée", par étape.
+
+    """
+    stages = default_stages() if stages is None else stages
+    outputs, result = {}, {}
+    for name in _required(stages, list(stages)):
+        manifest = read_manifest(name, manifest_dir)
+        outputs[name] = manifest.get("outputs", {})
+        if not manifest:
+            result[name] = "jamais exécutée"
+        elif is_fresh(
+            manifest, stage_key(stages[name], outputs), stages[name].max_age
+        ):
+            result[name] = "à jour"
+        else:
+            result[name] = "périmée"
+    return result
+
+
+def _required(stages: dict[str, Stage], targets: list[str]) -> list[str]:
+    "Etapes nécessaires aux cibles, dépendances comprises"
+    required = []
+
+    def visit(name):
+        if name not in stages:
+            raise ValueError(f"étape inconnue : {name}")
+        if name in required:
+            return
+        for dep in stages[name].deps:
+            visit(dep)
+        required.append(name)
+
+    for target in targets:
+        visit(target)
+    return required
+
+
+def run(
+    targets: list[str] = None,
+    stages: dict[str, Stage] = None,
+    force: bool | list[str] = False,
+    max_workers: int = 2,
+    manifest_dir: str = MANIFEST_DIR,
+) -> dict[str, bool]:
+    """
+    Exécute les étapes périmées nécessaires aux cibles.
+
+    Parameters
+    ----------
+    targets : list[str], optional
+        Etapes à produire. Par défaut, toutes.
+    stages : dict[str, Stage], optional
+        Graphe des étapes. Par défaut, default_stages().
+    force : bool | list[str], optional
+        True pour tout relancer, ou liste des étapes à relancer même si
+        elles sont à jour. False par défaut.
+    max_workers : int, optional
+        Nombre d'étapes exécutées simultanément. 2 par défaut.
+    manifest_dir : str, optional
+        Répertoire des manifestes. MANIFEST_DIR par défaut.
+
+    Returns
+    -------
+    dict[str, bool]
+        Pour chaque étape nécessaire, True si elle a été exécutée, False si
+        son cache a été réutilisé.
+
+    """
+    stages = default_stages() if stages is None else stages
+    required = _required(stages, targets or list(stages))
+    if force is True:
+        force = required
+    force = set(force or [])
+
+    outputs = {}
+    executed = {}
+    pending = list(required)
+    running = {}
+
+    def submit(pool, name):
+        stage = stages[name]
+        key = stage_key(stage, outputs)
+        manifest = read_manifest(name, manifest_dir)
+        if name not in force and is_fresh(manifest, key, stage.max_age):
+            logger.info("Etape %s à jour", name)
+            outputs[name] = manifest["outputs"]
+            executed[name] = False
+            return None
+        logger.info("Etape %s : exécution", name)
+        return pool.submit(stage.run, stage.params), key
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        while pending or running:
+            for name in list(pending):
+                if any(dep not in outputs for dep in stages[name].deps):
+                    continue
+                pending.remove(name)
+                job = submit(pool, name)
+                if job is not None:
+                    running[job[0]] = (name, job[1])
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                paths = future.result()
+                outputs[name] = {path: file_hash(path) for path in paths}
+                write_manifest(
+                    name,
+                    {
+                        "key": key,
+                        "artifact": stages[name].artifact,
+                        "params": stages[name].params,
+                        "outputs": outputs[name],
+                        "completed": time.time(),
+                    },
+                    manifest_dir,
+                )
+                executed[name] = True
+    return executed
+
+
+if __name__ == "__main__":
+    import sys
+
+    from hackathon_climat_donnees.cli import main
+
+    sys.exit(main(["run", *sys.argv[1:]]))
@@ -3,32 +3,85 @@
 Extraction des données sur les installations classées depuis Géorisques
 """
 
+import hashlib
 import io
+import json
 import logging
 import os
+from functools import lru_cache
 from zipfile import ZipFile
 
 import geopandas as gpd
 import pandas as pd
-from requests_cache import CachedSession
-from tqdm import tqdm
 
-from hackathon_climat_donnees.constants import GEREP_THRESHOLDS
+from hackathon_climat_donnees.constants import (
+    CACHE_DURATION_SECONDS,
+    GEREP_THRESHOLDS,
+)
 from hackathon_climat_donnees import OUTPUT
+from hackathon_climat_donnees.instrumentation import stage
 
 logger = logging.getLogger(__name__)
 
-CACHE_DURATION_SECONDS = 60 * 60 * 24 * 10
-SESSION = CachedSession(
-    "cache",
-    backend="sqlite",
-    expire_after=CACHE_DURATION_SECONDS,
-    allowable_methods=("GET", "POST"),
-)
-
 GEORISQUES_SERVICES = "https://www.georisques.gouv.fr/themes/custom/georisques/assets/dist/js/georisques_commun/web-service-urls.json"
-webservices = SESSION.get(GEORISQUES_SERVICES).json()
-download_url = webservices["DOWNLOAD"]
+
+
+@lru_cache(maxsize=None)
+def session():
+    """
+    Session HTTP avec cache SQLite, ouverte à la première requête (et non
+    à l'import du module).
+    """
+    from requests_cache import CachedSession
+
+    return CachedSession(
+        "cache",
+        backend="sqlite",
+        expire_after=CACHE_DURATION_SECONDS,
+        allowable_methods=("GET", "POST"),
+    )
+
+
+@lru_cache(maxsize=None)
+def download_url() -> str:
+    "URL du service de téléchargement de Géorisques"
+    return session().get(GEORISQUES_SERVICES).json()["DOWNLOAD"]
+
+
+# critères de sélection des ICPE par défaut (colonne: valeur ou liste de
+# valeurs) : SEVESO seuil haut, priorité nationale, soumis à la directive IED
+SELECTION = {"lib_seveso": "Seveso seuil haut", "priorite_n": 1, "ied": 1}
+
+# colonnes du fichier national non lues
+DROPPED_COLUMNS = [
+    "bovins",
+    "porcs",
+    "volailles",
+    "carriere",
+    "eolienne",
+    "industrie",
+]
+
+# jeu de données précédent (GeoParquet, une ligne par code_aiot) et
+# différences avec celui-ci, pour la mise à jour incrémentale
+SNAPSHOT_PATH = os.path.join(OUTPUT, "icpe_snapshot.parquet")
+CHANGES_PATH = os.path.join(OUTPUT, "icpe_changes.json")
+
+# champs de l'inventaire ICPE datant la dernière modification d'une fiche
+DATE_FIELDS = ["date_modif", "derniere_i"]
+
+# indicateur du snapshot : False pour les installations de l'inventaire
+# écartées faute de géolocalisation (absentes du dataset produit)
+GEOLOCATED_FLAG = "geolocalise"
+
+# renommage des risques pour éviter les troncatures SHP
+HAZARD_NAMES = {
+    "Feu de foret": "feu foret",
+    "Recul du trait de cote": "recul tdc",
+    "Remontée de nappe": "in. nappe",
+    "Retrait gonflement des argiles": "argiles",
+    "Risques côtiers (submersion marine, tsunami)": "risq. cot.",
+}
 
 
 def to_disk(gdf: gpd.GeoDataFrame) -> None:
@@ -43,46 +96,114 @@ def to_disk(gdf: gpd.GeoDataFrame) -> None:
     gdf.to_file(os.path.join(OUTPUT, "ample.geojson"), driver="GeoJSON")
 
 
-def prepare_dataset() -> gpd.GeoDataFrame:
+def where_clause(selection: dict, metropole: bool = True) -> str:
+    """
+    Traduit des critères de sélection en clause WHERE (SQL OGR), appliquée
+    par le lecteur lui-même.
+
+    Parameters
+    ----------
+    selection : dict
+        Critères {colonne: valeur ou liste de valeurs}.
+    metropole : bool, optional
+        Si True, exclut les communes d'outre-mer (code INSEE en 97) ; les
+        installations sans code INSEE sont conservées. True par défaut.
+
+    Returns
+    -------
+    str
+        Clause WHERE, ou None si aucun critère.
+
+    Ex.:
+        >>> where_clause({"lib_seveso": ["Seveso seuil bas"], "ied": 1})
+        "lib_seveso IN ('Seveso seuil bas') AND ied = 1 AND (cd_insee IS NULL OR cd_insee NOT LIKE '97%')"
+
+    """
+
+    def literal(value):
+        if isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return str(value)
+
+    clauses = []
+    for col, value in selection.items():
+        if isinstance(value, (list, tuple, set)):
+            values = ", ".join(literal(v) for v in value)
+            clauses.append(f"{col} IN ({values})")
+        else:
+            clauses.append(f"{col} = {literal(value)}")
+    if metropole:
+        # NOT LIKE est NULL (donc faux) pour un code INSEE absent
+        clauses.append("(cd_insee IS NULL OR cd_insee NOT LIKE '97%')")
+    return " AND ".join(clauses) or None
+
+
+def prepare_dataset(
+    selection: dict = None, metropole: bool = True
+) -> gpd.GeoDataFrame:
     """
     Identification des principales ICPE métropolitaines. Utilise la base
     de données "Installations industrielles" de Géorisques
 
-    La sélection opérée est :
+    La sélection par défaut (SELECTION) est :
         * SEVESO seuil haut
         * classé en priorité nationale
         * en métropole
         * soumis à la directive IED
 
+    Le fichier national est lu par pyogrio au format Arrow : les critères
+    de sélection et la liste des colonnes sont transmis au lecteur, qui ne
+    construit que les lignes et colonnes retenues.
+
+    Parameters
+    ----------
+    selection : dict, optional
+        Critères de sélection {colonne: valeur ou liste de valeurs}, ex.
+        {"lib_seveso": ["Seveso seuil haut", "Seveso seuil bas"]}. {} pour
+        l'ensemble des installations. Par défaut, SELECTION.
+    metropole : bool, optional
+        Si True, seules les installations métropolitaines sont retenues.
+        True par défaut.
+
     Returns
     -------
     gdf : gpd.GeoDataFrame
         GeoDataFrame des principales ICPE métropolitaines
 
     """
+    import pyogrio
 
-    files = SESSION.get(download_url + "/icpe", data={"annemin": 2003}).json()
-    url = files["national"]["lien"]
+    selection = SELECTION if selection is None else selection
 
-    content = SESSION.get(url).content
-    gdf = gpd.read_file(io.BytesIO(content))
-
-    # échantillon de sites SEVESO & priorité nationale
-    gdf = gdf[(gdf.lib_seveso == "Seveso seuil haut") & (gdf.priorite_n == 1)]
-    gdf = gdf.drop(
-        ["bovins", "porcs", "volailles", "carriere", "eolienne", "industrie"],
-        axis=1,
-    )
+    files = session().get(download_url() + "/icpe", data={"annemin": 2003})
+    files = files.json()
+    url = files["national"]["lien"]
 
-    # metropole :
-    gdf = gdf[gdf.cd_insee.str[:2] != "97"]
+    with stage("download", model="icpe") as rec:
+        content = session().get(url).content
+        rec["bytes_read"] = len(content)
+
+    fields = pyogrio.read_info(io.BytesIO(content))["fields"]
+    with stage("read", model="icpe") as rec:
+        gdf = gpd.read_file(
+            io.BytesIO(content),
+            engine="pyogrio",
+            use_arrow=True,
+            columns=[col for col in fields if col not in DROPPED_COLUMNS],
+            where=where_clause(selection, metropole),
+        )
+        rec["rows"] = len(gdf)
 
-    # IED
-    gdf = gdf[gdf.ied == 1]
-    gdf = gdf.drop("ied", axis=1)
+    # colonne constante après sélection
+    if selection.get("ied") == 1:
+        gdf = gdf.drop("ied", axis=1)
 
     rubriques = ["rubriques_", "rubrique_1", "rubrique_2"]
-    gdf["rubrique"] = gdf[rubriques].fillna("").agg("|".join, axis=1)
+    gdf["rubrique"] = (
+        gdf[rubriques[0]]
+        .fillna("")
+        .str.cat([gdf[col].fillna("") for col in rubriques[1:]], sep="|")
+    )
     gdf = gdf.drop(rubriques, axis=1)
 
     return gdf
@@ -149,7 +270,8 @@ def profile_irep() -> gpd.GeoDataFrame:
 
     """
 
-    files = SESSION.get(download_url + "/irep", data={"annemin": 2003}).json()
+    files = session().get(download_url() + "/irep", data={"annemin": 2003})
+    files = files.json()
     seek = ["etablissements", "emissions", "prelevements", "rejets"]
 
     # Sélection des 5 derniers millésimes
@@ -177,7 +299,9 @@ def profile_irep() -> gpd.GeoDataFrame:
     dict_df = {x: [] for x in seek}
     for year, url in files.items():
         logger.info("dl %s", url)
-        r = SESSION.get(url)
+        with stage("download", model=f"irep_{year}") as rec:
+            r = session().get(url)
+            rec["bytes_read"] = len(r.content)
         file = io.BytesIO(r.content)
         with ZipFile(file) as handle:
             read = {
@@ -200,25 +324,28 @@ def profile_irep() -> gpd.GeoDataFrame:
     df = df.sort_values(["identifiant", "year"], ascending=[1, 0])
     df = df.groupby("identifiant").first().reset_index(drop=False)
     df["adresse"] = (
-        df[["adresse", "code_postal", "commune"]]
+        df["adresse"]
         .fillna("")
-        .agg(" ".join, axis=1)
+        .str.cat(
+            [df[col].fillna("") for col in ["code_postal", "commune"]], sep=" "
+        )
     )
     df = df.drop(["code_postal", "commune"], axis=1)
 
-    df["geometry"] = None
-    for epsg in df.code_epsg.dropna().unique():
-        ix = df[df.code_epsg == epsg].index
-        geoms = gpd.GeoSeries(
+    # reprojection par système de coordonnées déclaré
+    geoms = [
+        gpd.GeoSeries(
             gpd.points_from_xy(
-                df.loc[ix, "coordonnees_x"],
-                df.loc[ix, "coordonnees_y"],
-                crs=epsg,
+                group["coordonnees_x"],
+                group["coordonnees_y"],
+                crs=int(epsg),
             ),
-            index=ix,
+            index=group.index,
         ).to_crs(2154)
-        df.loc[ix, "geometry"] = geoms
-    df = gpd.GeoDataFrame(df, crs=2154)
+        for epsg, group in df.groupby("code_epsg")
+    ]
+    geometry = gpd.GeoSeries(pd.concat(geoms), crs=2154).reindex(df.index)
+    df = gpd.GeoDataFrame(df, geometry=geometry, crs=2154)
     df = df.drop(["coordonnees_x", "coordonnees_y"], axis=1)
     df = df[
         [
@@ -344,13 +471,16 @@ def profile_irep() -> gpd.GeoDataFrame:
 
     del dict_df["emissions"]
 
+    # jointure unique de tous les profils, indexés par établissement
     etabs = dict_df.pop("etablissements")
-    for key, meta in dict_df.items():
-        etabs = etabs.merge(meta, on="identifiant", how="left")
-
-    for col in ["PLV_Q75", "VOLREJ_Q75", "AIR_Q75", "EAU_Q75", "SOL_Q75"]:
-        ix = etabs[etabs[col].isnull()].index
-        etabs.loc[ix, col] = False
+    profiles = pd.concat(
+        [meta.set_index("identifiant") for meta in dict_df.values()], axis=1
+    )
+    etabs = etabs.merge(
+        profiles, left_on="identifiant", right_index=True, how="left"
+    )
+    cols = ["PLV_Q75", "VOLREJ_Q75", "AIR_Q75", "EAU_Q75", "SOL_Q75"]
+    etabs[cols] = etabs[cols].fillna(False).astype(bool)
 
     return etabs
 
@@ -465,22 +595,25 @@ def hazards(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
             0003300469                                             0  
 
     """
+    from tqdm import tqdm
+
     endpoint = "https://georisques.gouv.fr/api/v1/resultats_rapport_risque"
     gdf = gdf.to_crs(4326)
 
     data = []
-    for site in tqdm(gdf.itertuples(False), total=len(gdf)):
-        x = site.geometry.x
-        y = site.geometry.y
-        lonlat = f"{x},{y}"
-        r = SESSION.get(endpoint, params={"latlon": lonlat})
-        natural_hazard = [
-            detail
-            for haz, detail in r.json()["risquesNaturels"].items()
-            if detail.pop("present")
-        ]
-        [d.update({"code_aiot": site.code_aiot}) for d in natural_hazard]
-        data += natural_hazard
+    with stage("hazards", sites=len(gdf)):
+        for site in tqdm(gdf.itertuples(False), total=len(gdf)):
+            x = site.geometry.x
+            y = site.geometry.y
+            lonlat = f"{x},{y}"
+            r = session().get(endpoint, params={"latlon": lonlat})
+            natural_hazard = [
+                detail
+                for haz, detail in r.json()["risquesNaturels"].items()
+                if detail.pop("present")
+            ]
+            [d.update({"code_aiot": site.code_aiot}) for d in natural_hazard]
+            data += natural_hazard
     data = pd.DataFrame(data)
 
     encoding = {
@@ -507,19 +640,116 @@ def hazards(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
 
     # filtrer les risques climatiques liés aux conditions météo
     drop = ["Mouvements de terrain", "Radon", "Séisme"]
-    data = data.drop(drop, axis=1)
+    data = data.drop(drop, axis=1, errors="ignore")
     return data
 
 
-def prep_dataset_icpe(save: bool = True) -> gpd.GeoDataFrame:
+def snapshot_revision(gdf: gpd.GeoDataFrame) -> str:
+    "Empreinte d'un dataset : codes AIOT et dates de modification"
+    keys = gdf[["code_aiot", *DATE_FIELDS]].astype(str)
+    payload = keys.sort_values("code_aiot").to_csv(index=False)
+    return hashlib.sha1(payload.encode("utf8")).hexdigest()
+
+
+def read_snapshot(path: str = SNAPSHOT_PATH) -> gpd.GeoDataFrame:
+    "Dataset de la dernière exécution (None si absent)"
+    if not os.path.exists(path):
+        return None
+    return gpd.read_parquet(path)
+
+
+def diff_sites(
+    current: pd.DataFrame, previous: pd.DataFrame
+) -> dict[str, list[str]]:
+    """
+    Différences entre deux versions de l'inventaire, par code AIOT.
+
+    Une installation est considérée comme modifiée si l'un des champs
+    DATE_FIELDS a changé.
+
+    Parameters
+    ----------
+    current : pd.DataFrame
+        Inventaire courant (colonnes code_aiot et DATE_FIELDS).
+    previous : pd.DataFrame
+        Inventaire précédent.
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Codes AIOT "new", "removed", "modified" et "unchanged".
+
+    """
+    # dates absentes comparées comme chaînes vides (NaN != NaN)
+    cur = current.set_index("code_aiot")[DATE_FIELDS]
+    cur = cur.astype(object).fillna("").astype(str)
+    prev = previous.set_index("code_aiot")[DATE_FIELDS]
+    prev = prev.astype(object).fillna("").astype(str)
+    common = cur.index.intersection(prev.index)
+    changed = (cur.loc[common] != prev.loc[common]).any(axis=1)
+    return {
+        "new": cur.index.difference(prev.index).tolist(),
+        "removed": prev.index.difference(cur.index).tolist(),
+        "modified": common[changed.to_numpy()].tolist(),
+        "unchanged": common[~changed.to_numpy()].tolist(),
+    }
+
+
+def _moved(gdf: gpd.GeoDataFrame, previous: gpd.GeoDataFrame) -> pd.Series:
+    "True pour les sites nouveaux ou dont la géométrie retenue a changé"
+    before = previous.set_index("code_aiot").geometry.to_crs(2154)
+    before = before.reindex(gdf["code_aiot"])
+    after = gdf.set_index("code_aiot").geometry
+    same = after.geom_equals_exact(before, tolerance=1).fillna(False)
+    return pd.Series(~same.to_numpy(), index=gdf.index)
+
+
+def prep_dataset_icpe(
+    save: bool = True,
+    selection: dict = None,
+    metropole: bool = True,
+    natural_hazards: bool = True,
+    incremental: bool = False,
+    snapshot: str = SNAPSHOT_PATH,
+) -> gpd.GeoDataFrame:
     """
     Génération d'un dataset d'environ 260 ICPE contextualisé en matières
     d'émissions dans l'environnement et de risques naturels.
 
+    En mode incrémental, le dataset précédent (snapshot) est comparé à
+    l'inventaire courant par code AIOT (cf. diff_sites). L'assemblage avec
+    IREP (profils et géométrie retenue) est refait pour toutes les
+    installations, les données IREP pouvant changer sans que la fiche ICPE
+    change ; seuls les risques naturels (une requête par site) sont repris
+    du snapshot, pour les installations dont la géométrie retenue n'a pas
+    bougé. Les installations inchangées dont la géométrie a bougé sont
+    comptées comme modifiées. Les différences sont écrites dans
+    CHANGES_PATH, pour la jointure climatique (pipeline).
+
+    Les installations écartées faute de géolocalisation sont conservées
+    dans le snapshot (GEOLOCATED_FLAG à False), sans figurer dans le
+    dataset produit : elles ne sont pas comptées comme nouvelles à chaque
+    exécution.
+
     Parameters
     ----------
     save : bool, optional
         Si True, le dataset est exporté ç divers formats. True par défaut.
+    selection : dict, optional
+        Critères de sélection des ICPE (cf. prepare_dataset). {} pour
+        l'ensemble des installations autorisées. Par défaut, SELECTION.
+    metropole : bool, optional
+        Si True, seules les installations métropolitaines sont retenues.
+        True par défaut.
+    natural_hazards : bool, optional
+        Si True, les risques naturels sont récupérés site par site (API
+        Géorisques, une requête par site). False pour l'inventaire complet.
+        True par défaut.
+    incremental : bool, optional
+        Si True, met à jour le snapshot au lieu de tout recalculer (sans
+        snapshot, le dataset est construit entièrement). False par défaut.
+    snapshot : str, optional
+        Chemin du snapshot. SNAPSHOT_PATH par défaut.
 
     Returns
     -------
@@ -527,28 +757,93 @@ def prep_dataset_icpe(save: bool = True) -> gpd.GeoDataFrame:
         GeoDataFrame des ICPE constextualisé
 
     """
-    gdf = prepare_dataset()
+    gdf = prepare_dataset(selection, metropole)
+    inventory = gdf[["code_aiot", *DATE_FIELDS]]
+
+    previous = read_snapshot(snapshot) if incremental else None
+    if previous is None:
+        changes = {
+            "new": gdf["code_aiot"].tolist(),
+            "removed": [],
+            "modified": [],
+            "unchanged": [],
+        }
+    else:
+        changes = diff_sites(gdf, previous)
+
+    # profils et géométries IREP recalculés pour toutes les installations
     irep_profiles = profile_irep()
     gdf = merge_datasets(gdf, irep_profiles)
 
+    if previous is not None:
+        # géométrie retenue modifiée (par l'inventaire ou par IREP) : la
+        # jointure climatique de l'installation est à refaire
+        moved = _moved(gdf, previous)
+        relocated = set(gdf.loc[moved, "code_aiot"]) & set(
+            changes["unchanged"]
+        )
+        changes["modified"] += sorted(relocated)
+        changes["unchanged"] = [
+            code for code in changes["unchanged"] if code not in relocated
+        ]
+    logger.info(
+        "ICPE : %s nouvelles, %s modifiées, %s supprimées, %s inchangées",
+        *(
+            len(changes[k])
+            for k in ["new", "modified", "removed", "unchanged"]
+        ),
+    )
+
     # Faire le calcul des risques sur les géométries déclarées dans IREP
-    hazards_dset = hazards(gdf)
-    gdf = gdf.merge(hazards_dset, on="code_aiot", how="left")
+    if natural_hazards:
+        if previous is None:
+            hazards_dset = hazards(gdf) if len(gdf) else None
+        else:
+            # risques inchangés si la géométrie retenue n'a pas bougé
+            queried = hazards(gdf[moved]) if moved.any() else None
+            hazard_cols = [
+                c
+                for c in previous.columns
+                if c not in gdf and c != GEOLOCATED_FLAG
+            ]
+            reused = (
+                previous.set_index("code_aiot")
+                .loc[gdf.loc[~moved, "code_aiot"], hazard_cols]
+                .rename({v: k for k, v in HAZARD_NAMES.items()}, axis=1)
+            )
+            hazards_dset = pd.concat([reused, queried])
+        if hazards_dset is not None:
+            gdf = gdf.merge(hazards_dset, on="code_aiot", how="left")
 
     # renommage pour éviter les troncatures SHP
-    gdf = gdf.rename(
-        {
-            "Feu de foret": "feu foret",
-            "Recul du trait de cote": "recul tdc",
-            "Remontée de nappe": "in. nappe",
-            "Retrait gonflement des argiles": "argiles",
-            "Risques côtiers (submersion marine, tsunami)": "risq. cot.",
-        },
-        axis=1,
-    )
+    gdf = gdf.rename(HAZARD_NAMES, axis=1)
 
     if save:
         to_disk(gdf)
+        # installations non géolocalisées conservées dans le snapshot,
+        # pour que diff_sites ne les compte pas comme nouvelles
+        missing = inventory[~inventory["code_aiot"].isin(gdf["code_aiot"])]
+        snap = gpd.GeoDataFrame(
+            pd.concat(
+                [
+                    gdf.assign(**{GEOLOCATED_FLAG: True}),
+                    missing.assign(**{GEOLOCATED_FLAG: False}),
+                ],
+                ignore_index=True,
+            ),
+            geometry="geometry",
+            crs=gdf.crs,
+        )
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+        snap.to_parquet(snapshot + ".tmp")
+        os.replace(snapshot + ".tmp", snapshot)
+        # révisions comparées, pour la jointure climatique incrémentale
+        changes["from"] = (
+            None if previous is None else snapshot_revision(previous)
+        )
+        changes["to"] = snapshot_revision(snap)
+        with open(CHANGES_PATH, "w", encoding="utf8") as f:
+            json.dump(changes, f)
     return gdf
 
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Analyse fréquentielle régionale : paramètre de forme GEV commun à un
+voisinage de mailles
+
+Sur 30 maxima annuels, le paramètre de forme ajusté maille par maille est
+très bruité, et les niveaux de retour centennaux varient fortement d'une
+maille à l'autre. Suivant la méthode des L-moments régionaux (Hosking &
+Wallis, 1997) :
+
+1. les L-moments (l1, l2) et le L-coefficient d'asymétrie t3 = l3 / l2 sont
+   calculés pour toutes les mailles à la fois (séries triées, effectifs
+   variables gérés par masque) ;
+2. t3 ne dépend pas de la position ni de l'échelle : c'est celui des maxima
+   standardisés par leur indice local. Il est mis en commun sur un
+   voisinage glissant de (2 * radius + 1)² mailles (filtre de moyenne sur
+   toute la grille) ou par régions homogènes prédéfinies, en pondérant
+   chaque maille par son nombre d'années ;
+3. le paramètre de forme est déduit du t3 régional (approximation de
+   Hosking, bornée par XI_BOUNDS), puis la position et l'échelle sont
+   ajustées localement à partir des l1 et l2 de chaque maille.
+
+Les paramètres suivent la convention scipy (c, loc, scale), comme
+RP_calcul_vectorized : les niveaux de retour et les diagnostics
+d'ajustement sont calculés de la même façon qu'en mode maille par maille.
+"""
+
+import logging
+
+import numpy as np
+import xarray as xr
+from scipy.ndimage import uniform_filter
+from scipy.special import gamma
+from scipy.stats import genextreme as gev
+
+from hackathon_climat_donnees.nonstationary import XI_BOUNDS
+
+
+logger = logging.getLogger(__name__)
+
+# effectif minimal (cf. RP_calcul_vectorized)
+MIN_YEARS = 5
+
+# rayon (en mailles) du voisinage par défaut
+DEFAULT_RADIUS = 2
+
+
+def lmoments(extremes: np.ndarray) -> tuple[np.ndarray, ...]:
+    """
+    L-moments d'échantillon de séries de maxima annuels.
+
+    Parameters
+    ----------
+    extremes : np.ndarray
+        Maxima annuels, de forme (time, ...) ; les NaN sont ignorés.
+
+    Returns
+    -------
+    tuple[np.ndarray, ...]
+        l1, l2, t3 et effectif n, de forme (...). NaN pour les séries de
+        moins de MIN_YEARS valeurs.
+
+    """
+    x = np.sort(np.asarray(extremes, dtype="float64"), axis=0)
+    n = np.isfinite(x).sum(axis=0)
+    i = np.arange(x.shape[0]).reshape((-1,) + (1,) * (x.ndim - 1))
+    x = np.where(i < n, x, 0)
+
+    nn = np.maximum(n, 3).astype("float64")
+    b0 = x.sum(axis=0) / nn
+    b1 = (i / (nn - 1) * x).sum(axis=0) / nn
+    b2 = (i * (i - 1) / ((nn - 1) * (nn - 2)) * x).sum(axis=0) / nn
+
+    ok = n >= MIN_YEARS
+    l1 = np.where(ok, b0, np.nan)
+    l2 = np.where(ok, 2 * b1 - b0, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t3 = np.where(ok & (l2 > 0), (6 * b2 - 6 * b1 + b0) / l2, np.nan)
+    return l1, l2, t3, n
+
+
+def pool_t3(
+    t3: np.ndarray,
+    n: np.ndarray,
+    radius: int = None,
+    regions: np.ndarray = None,
+) -> np.ndarray:
+    """
+    L-coefficient d'asymétrie régional, moyenne de t3 pondérée par les
+    effectifs sur un voisinage glissant ou par région.
+
+    Parameters
+    ----------
+    t3 : np.ndarray
+        t3 local, de forme (y, x) ; NaN pour les mailles sans données.
+    n : np.ndarray
+        Effectifs, de forme (y, x).
+    radius : int, optional
+        Rayon du voisinage (mailles). Si None et sans `regions`,
+        DEFAULT_RADIUS.
+    regions : np.ndarray, optional
+        Numéros des régions homogènes, de forme (y, x) ; les mailles de
+        numéro négatif ou NaN ne sont rattachées à aucune région et
+        utilisent le voisinage (si `radius` est fourni) ou leur t3 local.
+
+    Returns
+    -------
+    np.ndarray
+        t3 régional, de forme (y, x).
+
+    """
+    valid = np.isfinite(t3)
+    w = np.where(valid, n, 0).astype("float64")
+    wt3 = np.where(valid, w * t3, 0)
+
+    if regions is None and radius is None:
+        radius = DEFAULT_RADIUS
+    pooled = np.where(valid, t3, np.nan)
+    if radius is not None:
+        size = 2 * int(radius) + 1
+        # le facteur size² se simplifie dans le rapport
+        num = uniform_filter(wt3, size=size, mode="constant")
+        den = uniform_filter(w, size=size, mode="constant")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pooled = np.where(valid & (den > 0), num / den, np.nan)
+
+    if regions is not None:
+        regions = np.asarray(regions, dtype="float64")
+        member = np.isfinite(regions) & (regions >= 0) & valid
+        labels = np.where(member, regions, 0).astype("int64")
+        num = np.bincount(labels[member], wt3[member])
+        den = np.bincount(labels[member], w[member])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            regional = num / den
+        pooled = np.where(member, regional[labels], pooled)
+    return pooled
+
+
+def gev_from_lmoments(
+    l1: np.ndarray, l2: np.ndarray, t3: np.ndarray
+) -> tuple[np.ndarray, ...]:
+    """
+    Paramètres GEV (convention scipy) à partir des L-moments.
+
+    Parameters
+    ----------
+    l1, l2 : np.ndarray
+        L-moments locaux.
+    t3 : np.ndarray
+        L-coefficient d'asymétrie (régional).
+
+    Returns
+    -------
+    tuple[np.ndarray, ...]
+        c, loc, scale.
+
+    """
+    z = 2 / (3 + t3) - np.log(2) / np.log(3)
+    c = 7.8590 * z + 2.9554 * z**2
+    # c = -xi
+    c = np.clip(c, -XI_BOUNDS[1], -XI_BOUNDS[0])
+
+    small = np.abs(c) < 1e-6
+    k = np.where(small, 1.0, c)
+    g = gamma(1 + k)
+    scale = np.where(small, l2 / np.log(2), l2 * k / ((1 - 2.0 ** (-k)) * g))
+    loc = np.where(
+        small, l1 - np.euler_gamma * scale, l1 - scale * (1 - g) / k
+    )
+    return c, loc, scale
+
+
+def fit_regional_array(
+    extremes: np.ndarray,
+    periods: np.ndarray,
+    radius: int = None,
+    regions: np.ndarray = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Ajustement régional de toute une grille.
+
+    Parameters
+    ----------
+    extremes : np.ndarray
+        Maxima annuels, de forme (y, x, time) ; les NaN sont ignorés.
+    periods : np.ndarray
+        Périodes de retour.
+    radius : int, optional
+        Rayon du voisinage (mailles), cf. pool_t3.
+    regions : np.ndarray, optional
+        Numéros des régions homogènes, de forme (y, x), cf. pool_t3.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Niveaux de retour (y, x, periods) et paramètres (y, x, 3).
+
+    """
+    l1, l2, t3, n = lmoments(np.moveaxis(extremes, -1, 0))
+    c, loc, scale = gev_from_lmoments(l1, l2, pool_t3(t3, n, radius, regions))
+
+    ok = np.isfinite(c) & np.isfinite(loc) & (scale > 0)
+    params = np.where(
+        ok[..., None], np.stack([c, loc, scale], axis=-1), np.nan
+    )
+    p = 1 - 1 / np.asarray(periods, dtype="float64")
+    rv = gev.ppf(
+        p, params[..., :1], params[..., 1:2], np.where(ok, scale, 1)[..., None]
+    )
+    return np.where(ok[..., None], rv, np.nan), params
+
+
+def fit_regional(
+    maximums: xr.DataArray,
+    periods: np.ndarray,
+    radius: int = None,
+    regions: xr.DataArray | np.ndarray = None,
+) -> xr.Dataset:
+    """
+    Ajustement régional d'un DataArray de maxima annuels.
+
+    Le voisinage traversant les blocs spatiaux, un DataArray découpé (dask)
+    est regroupé en un seul bloc pour l'ajustement (les maxima annuels d'un
+    modèle occupent quelques dizaines de Mo).
+
+    Parameters
+    ----------
+    maximums : xr.DataArray
+        Maxima annuels de dimensions (time, y, x).
+    periods : np.ndarray
+        Périodes de retour.
+    radius : int, optional
+        Rayon du voisinage (mailles). DEFAULT_RADIUS si ni `radius` ni
+        `regions` ne sont fournis.
+    regions : xr.DataArray | np.ndarray, optional
+        Numéros des régions homogènes (y, x). Un DataArray est apparié à la
+        grille des maxima par coordonnées (maille la plus proche), ce qui
+        permet de l'utiliser aussi en mode aperçu.
+
+    Returns
+    -------
+    xr.Dataset
+        Dataset contenant "return_levels" (y, x, periods) et "gev_params"
+        (y, x, gev_params), comme fit_return_levels.
+
+    """
+    if isinstance(regions, xr.DataArray):
+        regions = regions.sel(
+            y=maximums["y"], x=maximums["x"], method="nearest"
+        ).values
+    if maximums.chunks:
+        maximums = maximums.chunk({"time": -1, "y": -1, "x": -1})
+
+    rv, params = xr.apply_ufunc(
+        fit_regional_array,
+        maximums,
+        input_core_dims=[["y", "x", "time"]],
+        output_core_dims=[["y", "x", "periods"], ["y", "x", "gev_params"]],
+        dask="parallelized",
+        output_dtypes=[float, float],
+        dask_gufunc_kwargs={
+            "output_sizes": {"periods": len(periods), "gev_params": 3}
+        },
+        kwargs={"periods": periods, "radius": radius, "regions": regions},
+    )
+    rv = rv.assign_coords(periods=periods)
+    return xr.Dataset({"return_levels": rv, "gev_params": params})
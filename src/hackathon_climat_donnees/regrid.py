@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Agrégation pondérée des résultats maillés sur des polygones
+
+Les niveaux de retour (grille EPSG:27572) sont agrégés sur une couche de
+polygones (communes, départements, emprises personnalisées) par moyenne
+pondérée par la surface d'intersection maille / polygone. Les surfaces sont
+calculées dans une projection équivalente (EPSG:3035, LAEA Europe) : la
+projection de la grille (Lambert II étendu, conforme) ne conserve pas les
+surfaces.
+
+La matrice de poids (creuse, polygones x mailles) est calculée une seule
+fois par couple (grille, couche de polygones) puis conservée sur disque ;
+tous les fichiers de résultats d'une même grille (scénarios, niveaux de
+réchauffement, statistiques d'ensemble et périodes de retour) sont ensuite
+agrégés par un seul produit matriciel creux. Les mailles sans valeur (hors
+France, NaN) sont exclues et les poids renormalisés sur les mailles valides.
+
+Ex.:
+    >>> from hackathon_climat_donnees.regrid import admin_polygons, aggregate
+    >>> communes = admin_polygons("commune")
+    >>> df = aggregate(communes, id_col="code_insee")
+"""
+
+import hashlib
+import logging
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+from hackathon_climat_donnees import OUTPUT
+from hackathon_climat_donnees.outputs import list_outputs, output_labels
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(OUTPUT, "regrid")
+
+GRID_CRS = 27572
+
+# projection équivalente (surfaces conservées) pour les poids
+AREA_CRS = 3035
+
+
+def _edges(centers: np.ndarray) -> np.ndarray:
+    "Limites des mailles à partir de leurs centres (grille régulière ou non)"
+    centers = np.asarray(centers, dtype="float64")
+    middle = (centers[1:] + centers[:-1]) / 2
+    first = centers[0] - (middle[0] - centers[0])
+    last = centers[-1] + (centers[-1] - middle[-1])
+    return np.concatenate([[first], middle, [last]])
+
+
+def grid_cells(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Rectangles des mailles d'une grille, dans l'ordre (y, x) aplati.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Centres des mailles selon x (EPSG:27572).
+    y : np.ndarray
+        Centres des mailles selon y (EPSG:27572).
+
+    Returns
+    -------
+    np.ndarray
+        Tableau de géométries shapely, de taille len(y) * len(x).
+
+    """
+    xe, ye = _edges(x), _edges(y)
+    x0, y0 = np.meshgrid(xe[:-1], ye[:-1])
+    x1, y1 = np.meshgrid(xe[1:], ye[1:])
+    return shapely.box(
+        np.minimum(x0, x1).ravel(),
+        np.minimum(y0, y1).ravel(),
+        np.maximum(x0, x1).ravel(),
+        np.maximum(y0, y1).ravel(),
+    )
+
+
+def _cache_key(x: np.ndarray, y: np.ndarray, polygons: gpd.GeoSeries) -> str:
+    "Empreinte du couple (grille, couche de polygones)"
+    h = hashlib.sha1()
+    h.update(np.asarray(x, dtype="float64").tobytes())
+    h.update(np.asarray(y, dtype="float64").tobytes())
+    h.update(str(polygons.crs).encode("utf8"))
+    h.update(b"".join(shapely.to_wkb(polygons.values, hex=False)))
+    return h.hexdigest()
+
+
+def build_weights(
+    x: np.ndarray,
+    y: np.ndarray,
+    polygons: gpd.GeoDataFrame,
+    cache_dir: str = CACHE_DIR,
+) -> sparse.csr_matrix:
+    """
+    Matrice creuse des surfaces d'intersection polygones x mailles.
+
+    La matrice est lue dans le cache si elle a déjà été calculée pour la
+    même grille et la même couche de polygones (mêmes géométries, dans le
+    même ordre).
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Centres des mailles selon x (EPSG:27572).
+    y : np.ndarray
+        Centres des mailles selon y (EPSG:27572).
+    polygons : gpd.GeoDataFrame
+        Couche de polygones, dans une projection quelconque.
+    cache_dir : str, optional
+        Répertoire du cache. CACHE_DIR par défaut ; None pour le désactiver.
+
+    Returns
+    -------
+    sparse.csr_matrix
+        Matrice (n_polygones, len(y) * len(x)) des surfaces d'intersection,
+        en m² (AREA_CRS).
+
+    """
+    from pyproj import Transformer
+
+    geoms = polygons.geometry.to_crs(AREA_CRS)
+    key = _cache_key(x, y, geoms)
+    path = os.path.join(cache_dir, key + ".npz") if cache_dir else None
+    if path and os.path.exists(path):
+        return sparse.load_npz(path).tocsr()
+
+    # mailles reprojetées, côtés densifiés (quart de maille) pour suivre
+    # leur courbure dans AREA_CRS
+    step = min(np.abs(np.diff(x)).min(), np.abs(np.diff(y)).min()) / 4
+    to_area = Transformer.from_crs(GRID_CRS, AREA_CRS, always_xy=True)
+    cells = shapely.transform(
+        shapely.segmentize(grid_cells(x, y), step),
+        lambda xy: np.column_stack(to_area.transform(xy[:, 0], xy[:, 1])),
+    )
+    tree = shapely.STRtree(cells)
+    poly_idx, cell_idx = tree.query(geoms.values, predicate="intersects")
+    areas = shapely.area(
+        shapely.intersection(geoms.values[poly_idx], cells[cell_idx])
+    )
+    keep = areas > 0
+    weights = sparse.csr_matrix(
+        (areas[keep], (poly_idx[keep], cell_idx[keep])),
+        shape=(len(geoms), len(cells)),
+    )
+    logger.info(
+        "Poids maille -> polygone : %s polygones, %s intersections",
+        len(geoms),
+        weights.nnz,
+    )
+
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # écriture dans un fichier temporaire puis renommage (cf.
+        # maxima_store)
+        sparse.save_npz(path + ".tmp.npz", weights)
+        os.replace(path + ".tmp.npz", path)
+    return weights
+
+
+def apply_weights(
+    weights: sparse.csr_matrix, values: np.ndarray
+) -> np.ndarray:
+    """
+    Moyenne pondérée, par polygone, de valeurs maillées.
+
+    Parameters
+    ----------
+    weights : sparse.csr_matrix
+        Matrice (n_polygones, n_mailles), cf. build_weights.
+    values : np.ndarray
+        Valeurs de forme (n_mailles, ...) ; les NaN sont exclus et les poids
+        renormalisés sur les mailles valides.
+
+    Returns
+    -------
+    np.ndarray
+        Moyennes de forme (n_polygones, ...) ; NaN pour les polygones sans
+        maille valide.
+
+    """
+    shape = values.shape
+    values = values.reshape(shape[0], -1)
+    valid = np.isfinite(values)
+    total = weights @ np.where(valid, values, 0)
+    norm = weights @ valid.astype(weights.dtype)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result = np.where(norm > 0, total / norm, np.nan)
+    return result.reshape((weights.shape[0],) + shape[1:])
+
+
+def aggregate(
+    polygons: gpd.GeoDataFrame,
+    id_col: str,
+    paths: list[str] = None,
+    cache_dir: str = CACHE_DIR,
+) -> pd.DataFrame:
+    """
+    Agrège les fichiers de résultats d'ensemble sur une couche de polygones.
+
+    Les fichiers sont empilés par grille (sorties x périodes) et chaque
+    grille est agrégée par un seul produit avec sa matrice de poids. La
+    dimension warming_level des fichiers non-stationnaires est dépliée dans
+    le scénario (cf. outputs.output_labels) : fichiers stationnaires et
+    non-stationnaires peuvent être agrégés ensemble.
+
+    Parameters
+    ----------
+    polygons : gpd.GeoDataFrame
+        Couche de polygones (communes, départements...).
+    id_col : str
+        Colonne identifiant les polygones (ex. "code_insee").
+    paths : list[str], optional
+        Fichiers à agréger. Par défaut, les fichiers d'ensemble
+        (<var>_RP_<scénario>_<statistique>.nc) de OUTPUT.
+    cache_dir : str, optional
+        Répertoire du cache des poids. CACHE_DIR par défaut.
+
+    Raises
+    ------
+    FileNotFoundError
+        Si aucun fichier n'est à agréger ou si un fichier n'est pas trouvé.
+    ValueError
+        Si les fichiers n'ont pas les mêmes périodes de retour.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Index (id_col, scenario, statistic), une colonne par période de
+        retour.
+
+    Ex.:
+                                        2      5     10  ...
+        code_insee scenario    statistic
+        01001      hist_ref    median     33.21  35.02  ...
+                   ns_ssp3_+2C median     34.35  36.19  ...
+                   ssp3_+2C    median     34.40  36.28  ...
+
+    """
+    import xarray as xr
+
+    if paths is None:
+        paths = list_outputs(OUTPUT)
+    if not paths:
+        raise FileNotFoundError(f"aucun fichier d'ensemble : {OUTPUT}")
+
+    grids, periods = {}, None
+    for path in paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"file not found at {path}")
+        with xr.open_dataset(path) as ds:
+            da = ds["return_levels"]
+            extra = [d for d in da.dims if d not in ("y", "x", "periods")]
+            da = da.transpose("y", "x", *extra, "periods")
+            x, y = da["x"].values, da["y"].values
+            if periods is None:
+                periods = da["periods"].values
+            elif not np.array_equal(periods, da["periods"].values):
+                raise ValueError(f"périodes de retour différentes : {path}")
+            labels = da[extra[0]].values.tolist() if extra else [None]
+            values = da.values.reshape(len(y) * len(x), -1, len(periods))
+        scenarios, statistics = output_labels(path, labels)
+
+        grid = grids.setdefault(
+            (x.tobytes(), y.tobytes()),
+            {"x": x, "y": y, "values": [], "scenarios": [], "statistics": []},
+        )
+        grid["values"].append(values)
+        grid["scenarios"] += scenarios
+        grid["statistics"] += statistics
+
+    ids = polygons[id_col].to_numpy()
+    all_dfs = []
+    for grid in grids.values():
+        weights = build_weights(grid["x"], grid["y"], polygons, cache_dir)
+        # (mailles, sorties, périodes) : un seul produit creux par grille
+        result = apply_weights(weights, np.concatenate(grid["values"], 1))
+        n_outputs = result.shape[1]
+        index = pd.MultiIndex.from_arrays(
+            [
+                np.repeat(ids, n_outputs),
+                np.tile(grid["scenarios"], len(ids)),
+                np.tile(np.array(grid["statistics"], dtype=object), len(ids)),
+            ],
+            names=[id_col, "scenario", "statistic"],
+        )
+        all_dfs.append(
+            pd.DataFrame(
+                result.reshape(len(index), len(periods)),
+                index=index,
+                columns=[str(p) for p in periods],
+            )
+        )
+    return pd.concat(all_dfs).sort_index()
+
+
+def admin_polygons(level: str = "commune") -> gpd.GeoDataFrame:
+    """
+    Contours administratifs (ADMIN EXPRESS COG CARTO, IGN) via pynsee.
+
+    Parameters
+    ----------
+    level : str, optional
+        "commune", "departement" ou "region". "commune" par défaut.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Contours en EPSG:2154, identifiés par la colonne "code_insee".
+
+    """
+    from pynsee.geodata import get_geodata
+
+    gdf = get_geodata(
+        f"ADMINEXPRESS-COG-CARTO.LATEST:{level}", crs="EPSG:2154"
+    )
+    return gpd.GeoDataFrame(gdf, geometry="geometry", crs=2154)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sensibilité des niveaux de retour à la longueur des fenêtres et aux années
+pivots
+
+process_netcdf_bunch ajuste une GEV sur des fenêtres de 30 ans centrées sur
+l'année pivot de chaque niveau de réchauffement (get_period), les pivots
+étant plafonnés à 2085. Ce module évalue d'un coup une grille de réglages :
+
+* window : longueur de la fenêtre (années)
+* pivot_shift : décalage appliqué aux années pivots (incertitude sur
+  l'année d'atteinte du niveau de réchauffement)
+* clamp : plafond des années pivots (None : pas de plafond)
+
+Les maxima annuels de chaque modèle sont lus dans le stockage intermédiaire
+(maxima_store, calculés une fois si absents). Les fenêtres distinctes de
+tous les réglages et de tous les modèles sont ajustées en un seul lot,
+réparti par tuiles entre les processus d'un pool : une fenêtre commune à
+plusieurs réglages n'est ajustée qu'une fois. Le résultat est un cube
+
+    return_levels (setting, scenario, modele, y, x, periods)
+
+écrit dans <OUTPUT>/sensitivity/<var>_RP_<ssp>_sensitivity.nc (ex. "ssp3"
+pour SSP3-7.0). Le réglage
+(window=30, pivot_shift=0, clamp=2085) reproduit les fichiers par modèle
+de process_netcdf_bunch.
+
+Ex.:
+    >>> from hackathon_climat_donnees.sensitivity import settings_grid, sweep
+    >>> settings = settings_grid(windows=[20, 30, 40], pivot_shifts=[-5, 0, 5])
+    >>> ds = sweep(settings, n_workers=8)
+    >>> ds.return_levels.sel(periods=100).median("modele")
+"""
+
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from hackathon_climat_donnees import INPUT, OUTPUT
+from hackathon_climat_donnees.catalog import (
+    SCENARIOS,
+    build_catalog,
+    file_metadata,
+    match_pivots,
+    member_key,
+    scenario_lists,
+)
+from hackathon_climat_donnees.instrumentation import stage
+from hackathon_climat_donnees.maxima_store import (
+    DEFAULT_TILE,
+    STORE_DIR,
+    fit_tile,
+    exists,
+    read_header,
+    store_key,
+    tiles,
+    write_maxima,
+)
+
+
+logger = logging.getLogger(__name__)
+
+SENSITIVITY_DIR = os.path.join(OUTPUT, "sensitivity")
+
+# fin de la période historique de référence (cf. get_period)
+HIST_END = 2014
+
+
+def settings_grid(
+    windows: list[int] = (30,),
+    pivot_shifts: list[int] = (0,),
+    clamps: list[int] = (2085,),
+) -> pd.DataFrame:
+    """
+    Grille des réglages (produit cartésien).
+
+    Parameters
+    ----------
+    windows : list[int], optional
+        Longueurs de fenêtre, en années. (30,) par défaut.
+    pivot_shifts : list[int], optional
+        Décalages des années pivots, en années. (0,) par défaut.
+    clamps : list[int], optional
+        Plafonds des années pivots (None : pas de plafond). (2085,) par
+        défaut.
+
+    Returns
+    -------
+    pd.DataFrame
+        Une ligne par réglage : window, pivot_shift, clamp ; index
+        "setting" (ex. "w30_s+0_c2085").
+
+    """
+    product = list(itertools.product(windows, pivot_shifts, clamps))
+    index = pd.Index(
+        [f"w{w}_s{s:+d}_c{'none' if c is None else c}" for w, s, c in product],
+        name="setting",
+    )
+    return pd.DataFrame(
+        product, index=index, columns=["window", "pivot_shift", "clamp"]
+    )
+
+
+def setting_windows(
+    pivots: pd.Series, setting, rwl_list: list[str]
+) -> dict[str, tuple[int, int]]:
+    """
+    Fenêtres d'ajustement d'un modèle pour un réglage.
+
+    Parameters
+    ----------
+    pivots : pd.Series
+        Années pivots du modèle, par niveau de réchauffement (ligne de
+        TRACC_pivot.csv).
+    setting : namedtuple ou pd.Series
+        Réglage (window, pivot_shift, clamp).
+    rwl_list : list[str]
+        Niveaux de réchauffement (ex. ["2C", "2.7C", "4C"]).
+
+    Returns
+    -------
+    dict[str, tuple[int, int]]
+        Première et dernière années (incluses) par scénario : "hist" puis
+        "+<RWL>". None si le niveau de réchauffement n'est pas atteint et
+        que le réglage n'a pas de plafond.
+
+    """
+    window = int(setting.window)
+    # fenêtre de 30 ans : [pivot - 15, pivot + 14] (cf. get_period)
+    before = window // 2
+    windows = {"hist": (HIST_END - window + 1, HIST_END)}
+    clamp = None if pd.isna(setting.clamp) else int(setting.clamp)
+    for RWL in rwl_list:
+        pivot = pivots[RWL]
+        if pd.isna(pivot):
+            # niveau non atteint : année plafond, comme process_netcdf_bunch
+            pivot = clamp
+        elif clamp is not None:
+            pivot = min(int(pivot), clamp)
+        if pivot is None:
+            windows[f"+{RWL}"] = None
+            continue
+        start = int(pivot) + int(setting.pivot_shift) - before
+        windows[f"+{RWL}"] = (start, start + window - 1)
+    return windows
+
+
+def ensure_maxima(
+    df: pd.DataFrame,
+    var: str,
+    experiment: str = "ssp370",
+    store_dir: str = STORE_DIR,
+) -> list[str]:
+    """
+    Calcule et écrit les maxima annuels des modèles absents du stockage.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tableau des modèles (cf. catalog.match_pivots).
+    var : str
+        Variable traitée.
+    experiment : str, optional
+        Scénario. "ssp370" par défaut.
+    store_dir : str, optional
+        Répertoire du stockage. STORE_DIR par défaut.
+
+    Returns
+    -------
+    list[str]
+        Clés des modèles dont les maxima sont disponibles dans le stockage.
+
+    """
+    from hackathon_climat_donnees.netcdf_processing import (
+        annual_maxima,
+        open_input,
+    )
+
+    keys = []
+    for _, row in df.iterrows():
+        key = member_key(row)
+        if pd.isna(row["hist_path"]) or pd.isna(row["ssp_path"]):
+            logger.warning(f"Fichiers manquants pour {key}")
+            continue
+        if not exists(store_key(key, experiment), store_dir):
+            ds_hist = open_input(row["hist_path"], var, key)
+            ds_ssp = open_input(row["ssp_path"], var, key)
+            write_maxima(
+                annual_maxima(ds_hist, ds_ssp, var, key),
+                store_key(key, experiment),
+                store_dir,
+            )
+        keys.append(key)
+    return keys
+
+
+def sweep(
+    settings: pd.DataFrame = None,
+    periods: np.ndarray = None,
+    rwl_list: list[str] = None,
+    var: str = "tasmaxAdjust",
+    experiment: str = "ssp370",
+    models: list[str] = None,
+    n_workers: int = None,
+    tile: int = DEFAULT_TILE,
+    store_dir: str = STORE_DIR,
+    output_dir: str = SENSITIVITY_DIR,
+) -> xr.Dataset:
+    """
+    Niveaux de retour de tous les modèles pour une grille de réglages.
+
+    Parameters
+    ----------
+    settings : pd.DataFrame, optional
+        Réglages (cf. settings_grid). Par défaut, fenêtres de 20, 30 et
+        40 ans, décalages de -5, 0 et +5 ans, plafond à 2085 ou sans
+        plafond.
+    periods : np.ndarray, optional
+        Périodes de retour. Par défaut, celles de process_netcdf_bunch.
+    rwl_list : list[str], optional
+        Niveaux de réchauffement. Par défaut, RWL_LIST.
+    var : str, optional
+        Variable. "tasmaxAdjust" par défaut.
+    experiment : str, optional
+        Scénario (cf. catalog.SCENARIOS). "ssp370" par défaut.
+    models : list[str], optional
+        Clés des modèles (<GCM>__<membre>__<RCM>). Tous par défaut.
+    n_workers : int, optional
+        Nombre de processus. Par défaut, le nombre de coeurs ; 1 pour un
+        calcul sans processus supplémentaire.
+    tile : int, optional
+        Côté des tuiles, en mailles. DEFAULT_TILE par défaut.
+    store_dir : str, optional
+        Répertoire du stockage des maxima. STORE_DIR par défaut.
+    output_dir : str, optional
+        Répertoire de sortie. SENSITIVITY_DIR par défaut. Si None, le cube
+        n'est pas écrit.
+
+    Returns
+    -------
+    xr.Dataset
+        "return_levels" (setting, scenario, modele, y, x, periods), et
+        "start" / "end" (setting, scenario, modele) : fenêtre ajustée. Les
+        coordonnées window, pivot_shift et clamp (NaN : sans plafond)
+        décrivent chaque réglage.
+
+    """
+    from hackathon_climat_donnees.netcdf_processing import RWL_LIST
+
+    if settings is None:
+        settings = settings_grid([20, 30, 40], [-5, 0, 5], [2085, None])
+    if periods is None:
+        periods = np.array([2, 5, 10, 20, 50, 100])
+    rwl_list = RWL_LIST if rwl_list is None else rwl_list
+
+    catalog = build_catalog(scenario_lists([experiment]))
+    df = pd.read_csv(os.path.join(INPUT, "TRACC_pivot.csv"))
+    df = match_pivots(catalog, df, experiment=experiment, variable=var)
+    if models is not None:
+        df = df[df.apply(member_key, axis=1).isin(models)]
+    keys = ensure_maxima(df, var, experiment, store_dir)
+    if not keys:
+        raise ValueError(
+            f"aucun modèle disponible pour {var} / {experiment}"
+            + ("" if models is None else f" parmi {models}")
+        )
+    df = df[df.apply(member_key, axis=1).isin(keys)]
+
+    # fenêtres de chaque (réglage, scénario, modèle), limitées aux années du
+    # fichier historique ou du scénario (cf. fit_period)
+    scenarios = ["hist"] + [f"+{RWL}" for RWL in rwl_list]
+    spans = {}
+    for _, row in df.iterrows():
+        key = member_key(row)
+        hist_years = file_metadata(row["hist_path"])["years"]
+        ssp_years = file_metadata(row["ssp_path"])["years"]
+        for setting in settings.itertuples():
+            windows = setting_windows(row, setting, rwl_list)
+            for scenario, window in windows.items():
+                if window is None:
+                    continue
+                years = hist_years if scenario == "hist" else ssp_years
+                start = max(window[0], years[0])
+                end = min(window[1], years[-1])
+                spans[setting.Index, scenario, key] = (start, end)
+
+    # un ajustement par fenêtre distincte, tous modèles confondus
+    unique = sorted({(key, span) for (_, _, key), span in spans.items()})
+    if not unique:
+        raise ValueError("aucune fenêtre d'ajustement pour ces réglages")
+    header = read_header(store_key(keys[0], experiment), store_dir)
+    ny, nx = header["shape"][1:]
+    jobs = [
+        (store_key(key, experiment), store_dir, span, ys, xs, periods)
+        for key, span in unique
+        for ys, xs in tiles((ny, nx), tile)
+    ]
+    n_tiles = len(jobs) // len(unique)
+    logger.info(
+        f"{len(spans)} ajustements demandés, {len(unique)} fenêtres "
+        f"distinctes, {len(jobs)} tuiles"
+    )
+
+    fits = {
+        fit: np.full((ny, nx, len(periods)), np.nan, dtype="float32")
+        for fit in unique
+    }
+    with stage("fit", model="sensitivity", cells=len(unique) * ny * nx):
+        if n_workers == 1:
+            results = map(fit_tile, jobs)
+        else:
+            with ProcessPoolExecutor(n_workers) as pool:
+                results = list(pool.map(fit_tile, jobs))
+        for i, (ys, xs, rv_tile, _) in enumerate(results):
+            key, span = unique[i // n_tiles]
+            fits[key, span][ys, xs] = rv_tile
+
+    keys = df.apply(member_key, axis=1).tolist()
+    shape = (len(settings), len(scenarios), len(keys))
+    rv = np.full(shape + (ny, nx, len(periods)), np.nan, dtype="float32")
+    bounds = np.full(shape + (2,), -1, dtype="int32")
+    for (setting, scenario, key), span in spans.items():
+        ix = (
+            settings.index.get_loc(setting),
+            scenarios.index(scenario),
+            keys.index(key),
+        )
+        rv[ix] = fits[key, span]
+        bounds[ix] = span
+
+    coords = {"y": header["y"], "x": header["x"]}
+    if header["coords_2d"]:
+        base = os.path.join(store_dir, store_key(keys[0], experiment))
+        with np.load(base + ".npz") as npz:
+            for name in header["coords_2d"]:
+                coords[name] = (("y", "x"), npz[name])
+    dims = ("setting", "scenario", "modele")
+    ds = xr.Dataset(
+        {
+            "return_levels": (dims + ("y", "x", "periods"), rv),
+            "start": (dims, bounds[..., 0]),
+            "end": (dims, bounds[..., 1]),
+        },
+        coords={
+            **coords,
+            "setting": settings.index.tolist(),
+            "window": ("setting", settings["window"].to_numpy()),
+            "pivot_shift": ("setting", settings["pivot_shift"].to_numpy()),
+            "clamp": (
+                "setting",
+                settings["clamp"].astype("float").to_numpy(),
+            ),
+            "scenario": scenarios,
+            "modele": keys,
+            "periods": periods,
+        },
+    )
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        label = SCENARIOS[experiment]
+        path = os.path.join(output_dir, f"{var}_RP_{label}_sensitivity.nc")
+        with stage("write", model="sensitivity"):
+            ds.to_netcdf(path)
+        logger.info(f"Cube de sensibilité écrit : {path}")
+    return ds
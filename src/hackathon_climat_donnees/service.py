@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Service local (lecture seule) d'interrogation des niveaux de retour
+
+Les fichiers d'ensemble produits par netcdf_processing
+(<var>_RP_<scénario>_<statistique>.nc) sont chargés une seule fois en
+mémoire, ainsi que l'appariement de chaque site à sa maille la plus proche.
+Les requêtes (par code_aiot, emprise ou point lat/lon) sont ensuite servies
+depuis cet index, avec un cache LRU des réponses. L'index est reconstruit
+puis remplacé d'un bloc lorsque de nouveaux fichiers sont détectés.
+
+Lancement :
+    >>> from hackathon_climat_donnees.service import serve
+    >>> serve(port=8765)
+
+Interrogation :
+    >>> from hackathon_climat_donnees.service import ServiceClient
+    >>> client = ServiceClient("http://127.0.0.1:8765")
+    >>> client.site("0003205293", scenario="ssp3_+2C", statistic="median")
+    >>> client.point(45.0, 5.9, period=100)
+    >>> client.bbox(4.5, 45.0, 6.0, 46.0)
+
+Routes HTTP (GET, réponses JSON) : /sites/<code_aiot>, /bbox, /point,
+/health ; POST /reload force le rechargement.
+"""
+
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from hackathon_climat_donnees import OUTPUT
+from hackathon_climat_donnees.outputs import (
+    SiteIndex,
+    list_outputs,
+    outputs_fingerprint,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Service:
+    """
+    Index rechargeable : les requêtes utilisent l'index courant, qui est
+    remplacé d'un bloc (après construction complète) lorsque les fichiers
+    d'ensemble changent. Tant qu'aucun fichier n'est présent (avant le
+    premier run), l'index est vide (None) et les requêtes reçoivent une
+    erreur 503 ; il est construit à l'arrivée des fichiers.
+
+    Parameters
+    ----------
+    sites : gpd.GeoDataFrame
+        Sites à indexer.
+    output_dir : str, optional
+        Répertoire des fichiers d'ensemble. OUTPUT par défaut.
+    var : str, optional
+        Variable. "tasmaxAdjust" par défaut.
+    poll_interval : float, optional
+        Intervalle (s) de vérification des fichiers. 30 par défaut ; None
+        pour désactiver.
+
+    """
+
+    def __init__(
+        self,
+        sites,
+        output_dir: str = OUTPUT,
+        var: str = "tasmaxAdjust",
+        poll_interval: float = 30,
+    ):
+        self.sites = sites
+        self.output_dir = output_dir
+        self.var = var
+        self.lock = threading.Lock()
+        self.index = None
+        self.reload()
+
+        self.stopped = threading.Event()
+        if poll_interval:
+            thread = threading.Thread(
+                target=self._poll, args=(poll_interval,), daemon=True
+            )
+            thread.start()
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Reconstruit l'index si les fichiers d'ensemble ont changé.
+
+        Returns
+        -------
+        bool
+            True si l'index a été remplacé.
+
+        """
+        with self.lock:
+            paths = list_outputs(self.output_dir, self.var)
+            if not paths:
+                if self.index is None:
+                    logger.warning(
+                        "Aucun fichier d'ensemble dans %s", self.output_dir
+                    )
+                return False
+            fingerprint = outputs_fingerprint(paths)
+            if (
+                not force
+                and self.index is not None
+                and fingerprint == self.index.fingerprint
+            ):
+                return False
+            logger.info("Chargement de %s fichiers d'ensemble", len(paths))
+            index = SiteIndex(self.sites, paths)
+            self.index = index
+            return True
+
+    def _poll(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            try:
+                self.reload()
+            except Exception:
+                # fichiers en cours d'écriture : l'index courant est conservé
+                logger.exception("Rechargement impossible")
+
+
+def make_handler(service: Service):
+    "Classe de gestionnaire HTTP liée à un Service"
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, status: int, message: str) -> None:
+            self._send(status, json.dumps({"error": message}).encode("utf8"))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            filters = {
+                "scenario": params.get("scenario"),
+                "statistic": params.get("statistic"),
+                "period": params.get("period"),
+            }
+            index = service.index
+            if index is None and url.path == "/health":
+                body = json.dumps({"sites": 0, "scenarios": []})
+                return self._send(200, body.encode("utf8"))
+            if index is None:
+                return self._error(503, "aucun fichier d'ensemble chargé")
+            try:
+                if url.path.startswith("/sites/"):
+                    code = url.path[len("/sites/") :]
+                    body = index.query("site", (code,), **filters)
+                    if body is None:
+                        return self._error(404, f"site inconnu : {code}")
+                elif url.path == "/bbox":
+                    key = tuple(
+                        float(params[k])
+                        for k in ["xmin", "ymin", "xmax", "ymax"]
+                    )
+                    body = index.query("bbox", key, **filters)
+                elif url.path == "/point":
+                    key = (float(params["lat"]), float(params["lon"]))
+                    body = index.query("point", key, **filters)
+                elif url.path == "/health":
+                    body = json.dumps(
+                        {
+                            "sites": len(index.codes),
+                            "scenarios": sorted(set(index.scenarios)),
+                            "cache": index.query.cache_info()._asdict(),
+                        }
+                    ).encode("utf8")
+                else:
+                    return self._error(404, f"route inconnue : {url.path}")
+            except (KeyError, ValueError) as exc:
+                return self._error(400, f"paramètre invalide : {exc}")
+            self._send(200, body)
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/reload":
+                return self._error(404, "route inconnue")
+            reloaded = service.reload(force=True)
+            self._send(200, json.dumps({"reloaded": reloaded}).encode("utf8"))
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return Handler
+
+
+def serve(
+    sites=None,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    output_dir: str = OUTPUT,
+    var: str = "tasmaxAdjust",
+    poll_interval: float = 30,
+) -> None:
+    """
+    Lance le service HTTP (bloquant).
+
+    Parameters
+    ----------
+    sites : gpd.GeoDataFrame, optional
+        Sites à indexer. Par défaut, le dataset ICPE exporté par
+        prep_datasets (OUTPUT/sample.gpkg).
+    host : str, optional
+        Adresse d'écoute. "127.0.0.1" par défaut.
+    port : int, optional
+        Port d'écoute. 8765 par défaut.
+    output_dir : str, optional
+        Répertoire des fichiers d'ensemble. OUTPUT par défaut.
+    var : str, optional
+        Variable. "tasmaxAdjust" par défaut.
+    poll_interval : float, optional
+        Intervalle (s) de détection de nouveaux fichiers. 30 par défaut.
+
+    """
+    if sites is None:
+        import geopandas as gpd
+
+        sites = gpd.read_file(os.path.join(OUTPUT, "sample.gpkg"))
+
+    service = Service(sites, output_dir, var, poll_interval)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logger.info("Service à l'écoute sur http://%s:%s", host, port)
+    try:
+        server.serve_forever()
+    finally:
+        service.stopped.set()
+        server.server_close()
+
+
+class ServiceClient:
+    """
+    Client Python du service.
+
+    Parameters
+    ----------
+    base_url : str, optional
+        URL du service. "http://127.0.0.1:8765" par défaut.
+
+    """
+
+    def __init__(self, base_url: str = "http://127.0.0.1:8765"):
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def _get(self, route: str, **params) -> dict:
+        params = {k: v for k, v in params.items() if v is not None}
+        r = self.session.get(self.base_url + route, params=params)
+        r.raise_for_status()
+        return r.json()
+
+    def site(
+        self,
+        code_aiot: str,
+        scenario: str = None,
+        statistic: str = None,
+        period: int = None,
+    ) -> dict:
+        "Niveaux de retour d'un site"
+        return self._get(
+            f"/sites/{code_aiot}",
+            scenario=scenario,
+            statistic=statistic,
+            period=period,
+        )
+
+    def bbox(
+        self,
+        xmin: float,
+        ymin: float,
+        xmax: float,
+        ymax: float,
+        scenario: str = None,
+        statistic: str = None,
+        period: int = None,
+    ) -> dict:
+        "Niveaux de retour des sites d'une emprise (lon/lat WGS84)"
+        return self._get(
+            "/bbox",
+            xmin=xmin,
+            ymin=ymin,
+            xmax=xmax,
+            ymax=ymax,
+            scenario=scenario,
+            statistic=statistic,
+            period=period,
+        )
+
+    def point(
+        self,
+        lat: float,
+        lon: float,
+        scenario: str = None,
+        statistic: str = None,
+        period: int = None,
+    ) -> dict:
+        "Niveaux de retour de la maille la plus proche d'un point"
+        return self._get(
+            "/point",
+            lat=lat,
+            lon=lon,
+            scenario=scenario,
+            statistic=statistic,
+            period=period,
+        )
+
+    def health(self) -> dict:
+        "Etat du service"
+        return self._get("/health")
+
+    def reload(self) -> dict:
+        "Force le rechargement de l'index"
+        r = self.session.post(self.base_url + "/reload")
+        r.raise_for_status()
+        return r.json()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Séries journalières aux sites, extraites une seule fois des fichiers modèles
+
+Pour chaque fichier historique et SSP listé dans liste_*_tasmax.txt, les
+séries journalières des seules mailles les plus proches des sites sont
+lues, converties (°C) et écrites dans un stockage Parquet (float32),
+partitionné par modèle et par expérience :
+
+    <store>/sites.parquet
+        code_aiot, grid, cell, y, x, distance : appariement site -> maille
+    <store>/model=<GCM>__<membre>__<RCM>/experiment=<exp>/data.parquet
+        grid, cell, year, doy, <var>
+
+Les dates sont stockées en année / jour de l'année pour rester valables
+quel que soit le calendrier du modèle. Les indicateurs aux sites (jours
+chauds, nuits tropicales, vagues de chaleur, ajustements GEV...) peuvent
+ensuite être calculés sur quelques Mo plutôt que sur les grilles.
+
+Ex.:
+    >>> from hackathon_climat_donnees.site_series import (
+    ...     extract_site_series, read_site_series, days_above
+    ... )
+    >>> extract_site_series(gdf)
+    >>> df = read_site_series(sites=["0005200259"], experiments=["ssp370"])
+    >>> days_above(35)
+"""
+
+import logging
+import os
+
+import numpy as np
+import polars as pl
+import xarray as xr
+
+from hackathon_climat_donnees import INPUT, OUTPUT
+from hackathon_climat_donnees.catalog import build_catalog, file_metadata
+from hackathon_climat_donnees.instrumentation import stage
+
+
+logger = logging.getLogger(__name__)
+
+SERIES_DIR = os.path.join(OUTPUT, "site_series")
+
+
+def nearest_cells(da: xr.DataArray, gdf) -> dict:
+    """
+    Maille renseignée la plus proche de chaque site (comme
+    join_netcdf.join_outputs).
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Variable d'un fichier d'entrée, de dimensions (time, y, x).
+    gdf : gpd.GeoDataFrame
+        Sites (colonne code_aiot).
+
+    Returns
+    -------
+    dict
+        Tableaux code_aiot, cell (indice aplati y, x), y, x (coordonnées
+        de la maille, EPSG:27572) et distance (m, EPSG:2154).
+
+    """
+    from pyproj import Transformer
+    from scipy.spatial import cKDTree
+
+    valid = np.flatnonzero(np.isfinite(da.isel(time=0).values).ravel())
+    xx, yy = np.meshgrid(da["x"].values, da["y"].values)
+    xx, yy = xx.ravel()[valid], yy.ravel()[valid]
+    to_2154 = Transformer.from_crs(27572, 2154, always_xy=True)
+    cx, cy = to_2154.transform(xx, yy)
+
+    geoms = gdf.geometry.to_crs(2154)
+    distance, nearest = cKDTree(np.column_stack([cx, cy])).query(
+        np.column_stack([geoms.x, geoms.y])
+    )
+    return {
+        "code_aiot": gdf["code_aiot"].astype(str).to_numpy(),
+        "cell": valid[nearest].astype("int32"),
+        "y": yy[nearest],
+        "x": xx[nearest],
+        "distance": distance.astype("float32"),
+    }
+
+
+def _partition(store_dir: str, model: str, experiment: str) -> str:
+    return os.path.join(
+        store_dir, f"model={model}", f"experiment={experiment}", "data.parquet"
+    )
+
+
+def _is_fresh(path: str, source: str, cells: np.ndarray) -> bool:
+    "Partition plus récente que le fichier source et couvrant les mailles"
+    if not os.path.exists(path):
+        return False
+    if os.path.getmtime(path) < os.path.getmtime(source):
+        return False
+    stored = pl.scan_parquet(path).select("cell").unique().collect()
+    return bool(np.isin(cells, stored["cell"].to_numpy()).all())
+
+
+def extract_file(
+    path: str, var: str, cells: np.ndarray, grid: str
+) -> pl.DataFrame:
+    """
+    Séries journalières de quelques mailles d'un fichier d'entrée.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du fichier, relatif à INPUT.
+    var : str
+        Variable.
+    cells : np.ndarray
+        Indices aplatis (y, x) des mailles.
+    grid : str
+        Empreinte de la grille du fichier.
+
+    Returns
+    -------
+    pl.DataFrame
+        Colonnes grid, cell, year, doy, <var> (float32), triées par maille
+        puis par date.
+
+    """
+    from hackathon_climat_donnees.netcdf_processing import convert
+
+    ds = convert(xr.open_dataset(os.path.join(INPUT, path)), var)
+    try:
+        ny, nx = ds.sizes["y"], ds.sizes["x"]
+        iy, ix = np.unravel_index(cells, (ny, nx))
+        values = (
+            ds[var]
+            .isel(
+                y=xr.DataArray(iy, dims="cell"),
+                x=xr.DataArray(ix, dims="cell"),
+            )
+            .transpose("cell", "time")
+            .values.astype("float32")
+        )
+        years = ds["time"].dt.year.values.astype("int16")
+        doys = ds["time"].dt.dayofyear.values.astype("int16")
+    finally:
+        ds.close()
+
+    nt = values.shape[1]
+    return pl.DataFrame(
+        {
+            "grid": np.full(len(cells) * nt, grid),
+            "cell": np.repeat(cells.astype("int32"), nt),
+            "year": np.tile(years, len(cells)),
+            "doy": np.tile(doys, len(cells)),
+            var: values.ravel(),
+        }
+    )
+
+
+def extract_site_series(
+    gdf,
+    lists: list[str] = None,
+    var: str = "tasmaxAdjust",
+    store_dir: str = SERIES_DIR,
+    overwrite: bool = False,
+) -> str:
+    """
+    Extrait en une passe les séries journalières aux sites de tous les
+    fichiers historiques et SSP.
+
+    Les partitions déjà présentes, plus récentes que leur fichier source et
+    couvrant les mailles des sites, ne sont pas recalculées.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Sites (colonne code_aiot), par exemple le dataset ICPE.
+    lists : list[str], optional
+        Fichiers de listes. Par défaut, catalog.LISTS.
+    var : str, optional
+        Variable. "tasmaxAdjust" par défaut.
+    store_dir : str, optional
+        Répertoire du stockage. SERIES_DIR par défaut.
+    overwrite : bool, optional
+        Si True, toutes les partitions sont recalculées. False par défaut.
+
+    Returns
+    -------
+    str
+        Répertoire du stockage.
+
+    """
+    catalog = build_catalog(lists, scan=True)
+    catalog = catalog[catalog["variable"] == var].dropna(subset=["grid"])
+    os.makedirs(store_dir, exist_ok=True)
+
+    mappings = {}
+    for _, row in catalog.iterrows():
+        model = f"{row['gcm']}__{row['member']}__{row['rcm']}"
+        grid = row["grid"]
+        if grid not in mappings:
+            with xr.open_dataset(os.path.join(INPUT, row["path"])) as ds:
+                mappings[grid] = nearest_cells(ds[var], gdf)
+        cells = np.unique(mappings[grid]["cell"])
+
+        target = _partition(store_dir, model, row["experiment"])
+        source = os.path.join(INPUT, row["path"])
+        if not overwrite and _is_fresh(target, source, cells):
+            logger.info("%s %s déjà extrait", model, row["experiment"])
+            continue
+
+        n_time = file_metadata(row["path"])["offsets"][-1]
+        with stage("extract", model=model, cells=len(cells)) as rec:
+            df = extract_file(row["path"], var, cells, grid)
+            rec["bytes_read"] = len(cells) * n_time * 4
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # écriture dans un fichier temporaire puis renommage (cf.
+        # maxima_store)
+        df.write_parquet(target + ".tmp", compression="zstd")
+        os.replace(target + ".tmp", target)
+
+    sites = pl.concat(
+        [
+            pl.DataFrame(mapping).with_columns(grid=pl.lit(grid))
+            for grid, mapping in mappings.items()
+        ]
+    )
+    sites.write_parquet(os.path.join(store_dir, "sites.parquet"))
+    return store_dir
+
+
+def read_site_series(
+    sites: list[str] = None,
+    models: list[str] = None,
+    experiments: list[str] = None,
+    store_dir: str = SERIES_DIR,
+    lazy: bool = False,
+) -> pl.DataFrame:
+    """
+    Séries journalières aux sites, depuis le stockage.
+
+    Parameters
+    ----------
+    sites : list[str], optional
+        Codes AIOT. Tous par défaut.
+    models : list[str], optional
+        Modèles (<GCM>__<membre>__<RCM>). Tous par défaut.
+    experiments : list[str], optional
+        Expériences (ex. ["historical", "ssp370"]). Toutes par défaut.
+    store_dir : str, optional
+        Répertoire du stockage. SERIES_DIR par défaut.
+    lazy : bool, optional
+        Si True, renvoie la requête (pl.LazyFrame) sans l'exécuter, pour y
+        ajouter des agrégations. False par défaut.
+
+    Returns
+    -------
+    pl.DataFrame
+        Colonnes code_aiot, model, experiment, year, doy et la variable.
+
+    """
+    series = pl.scan_parquet(
+        os.path.join(store_dir, "model=*", "experiment=*", "*.parquet"),
+        hive_partitioning=True,
+    )
+    if models is not None:
+        series = series.filter(pl.col("model").is_in(models))
+    if experiments is not None:
+        series = series.filter(pl.col("experiment").is_in(experiments))
+
+    mapping = pl.scan_parquet(os.path.join(store_dir, "sites.parquet"))
+    if sites is not None:
+        mapping = mapping.filter(pl.col("code_aiot").is_in(sites))
+    mapping = mapping.select("code_aiot", "grid", "cell")
+
+    query = (
+        series.join(mapping, on=["grid", "cell"])
+        .drop("grid", "cell")
+        .sort("code_aiot", "model", "experiment", "year", "doy")
+    )
+    query = query.select(
+        "code_aiot",
+        "model",
+        "experiment",
+        "year",
+        "doy",
+        pl.exclude("code_aiot", "model", "experiment", "year", "doy"),
+    )
+    return query if lazy else query.collect()
+
+
+def days_above(
+    threshold: float,
+    var: str = "tasmaxAdjust",
+    store_dir: str = SERIES_DIR,
+    **filters,
+) -> pl.DataFrame:
+    """
+    Nombre annuel de jours au-dessus d'un seuil, par site et par modèle
+    (exemple d'indicateur calculé sur le stockage).
+
+    Parameters
+    ----------
+    threshold : float
+        Seuil (°C pour tasmaxAdjust).
+    var : str, optional
+        Variable. "tasmaxAdjust" par défaut.
+    store_dir : str, optional
+        Répertoire du stockage. SERIES_DIR par défaut.
+    **filters
+        sites, models, experiments : cf. read_site_series.
+
+    Returns
+    -------
+    pl.DataFrame
+        Colonnes code_aiot, model, experiment, year, days.
+
+    """
+    query = read_site_series(store_dir=store_dir, lazy=True, **filters)
+    return (
+        query.group_by("code_aiot", "model", "experiment", "year")
+        .agg(days=(pl.col(var) > threshold).sum())
+        .sort("code_aiot", "model", "experiment", "year")
+        .collect()
+    )
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export compact des résultats aux sites pour la carte publique
+
+Les niveaux de retour de tous les fichiers d'ensemble
+(<var>_RP_<scénario>_<statistique>.nc, cf. outputs) sont lus à la maille la
+plus proche de chaque site, puis écrits sous forme d'un paquet statique
+directement chargeable par la carte :
+
+    <export>/manifest.json
+        version du format, révision, échelle de quantification, sorties
+        (scénario, statistique), périodes et liste des tuiles
+    <export>/shards/<empreinte>.json
+        table des sites d'une tuile : code_aiot, coordonnées Web Mercator
+        (m, entiers) et attributs, les attributs répétitifs étant encodés
+        par dictionnaire ({"values": [...], "codes": [...]})
+    <export>/shards/<empreinte>.bin
+        niveaux de retour de la tuile, int16 little-endian de forme
+        (sites, sorties, périodes), en centièmes de degré ; NODATA pour les
+        valeurs manquantes
+
+Les sites sont regroupés par tuile Web Mercator (niveau ZOOM) : la carte ne
+charge que les tuiles visibles. Les fichiers sont nommés par l'empreinte
+(sha1) de leur contenu : lors d'une mise à jour, seules les tuiles dont un
+site a changé sont réécrites, les autres sont conservées (et restent en
+cache chez les clients). Le manifeste est remplacé en dernier, puis les
+fichiers qui ne sont plus référencés sont supprimés.
+
+Ex.:
+    >>> from hackathon_climat_donnees.web_export import export_bundle
+    >>> manifest = export_bundle(gdf)
+    >>> manifest["revision"]
+"""
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from hackathon_climat_donnees import OUTPUT
+from hackathon_climat_donnees.instrumentation import stage
+from hackathon_climat_donnees.outputs import SiteIndex, list_outputs
+
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.path.join(OUTPUT, "web")
+
+# version du format du paquet, à incrémenter à chaque changement de
+# structure
+FORMAT_VERSION = 1
+
+# quantification : valeur = code / SCALE (°C), NODATA si manquante
+SCALE = 100
+NODATA = -32768
+
+# niveau des tuiles Web Mercator (environ 200 km en France métropolitaine)
+ZOOM = 7
+
+# attributs des sites exportés (s'ils sont présents)
+COLUMNS = [
+    "nom_ets",
+    "commune",
+    "num_dep",
+    "lib_naf",
+    "lib_regime",
+    "lib_seveso",
+]
+
+# un attribut est encodé par dictionnaire si son nombre de valeurs
+# distinctes ne dépasse pas cette proportion du nombre de sites
+DICTIONARY_RATIO = 0.5
+
+_HALF_WORLD = 20037508.342789244
+
+
+def quantize(values: np.ndarray) -> np.ndarray:
+    """
+    Quantification des niveaux de retour en int16.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Niveaux de retour (°C), NaN si manquants.
+
+    Returns
+    -------
+    np.ndarray
+        Codes int16 (centièmes de degré), NODATA pour les NaN.
+
+    """
+    codes = np.rint(np.asarray(values, dtype="float64") * SCALE)
+    codes = np.where(np.isfinite(codes), codes, NODATA)
+    return np.clip(codes, NODATA, np.iinfo("int16").max).astype("<i2")
+
+
+def tile_keys(x: np.ndarray, y: np.ndarray, zoom: int = ZOOM) -> np.ndarray:
+    """
+    Tuile Web Mercator ("<zoom>/<x>/<y>") de points en EPSG:3857.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Coordonnées (m, EPSG:3857).
+    zoom : int, optional
+        Niveau des tuiles. ZOOM par défaut.
+
+    Returns
+    -------
+    np.ndarray
+        Clés des tuiles.
+
+    """
+    size = 2 * _HALF_WORLD / 2**zoom
+    tx = np.floor((np.asarray(x) + _HALF_WORLD) / size).astype(int)
+    ty = np.floor((_HALF_WORLD - np.asarray(y)) / size).astype(int)
+    return np.array([f"{zoom}/{i}/{j}" for i, j in zip(tx, ty)])
+
+
+def encode_column(values) -> list | dict:
+    """
+    Encodage d'un attribut : liste brute, ou dictionnaire si les valeurs
+    se répètent.
+
+    Parameters
+    ----------
+    values : array-like
+        Valeurs de l'attribut (converties en chaînes, None si manquantes).
+
+    Returns
+    -------
+    list | dict
+        Valeurs, ou {"values": valeurs distinctes, "codes": indices}.
+
+    """
+    values = [None if v is None or v != v else str(v) for v in values]
+    distinct = sorted(set(values), key=lambda v: (v is None, v))
+    if len(distinct) > max(1, DICTIONARY_RATIO * len(values)):
+        return values
+    position = {v: i for i, v in enumerate(distinct)}
+    return {"values": distinct, "codes": [position[v] for v in values]}
+
+
+def _digest(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()[:16]
+
+
+def _write_shard(shards_dir: str, content: bytes, suffix: str) -> tuple:
+    "Ecrit un fichier adressé par son contenu s'il n'existe pas déjà"
+    name = f"{_digest(content)}.{suffix}"
+    path = os.path.join(shards_dir, name)
+    if os.path.exists(path):
+        return name, False
+    with open(path + ".tmp", "wb") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+    return name, True
+
+
+def export_bundle(
+    gdf,
+    output_dir: str = OUTPUT,
+    var: str = "tasmaxAdjust",
+    export_dir: str = EXPORT_DIR,
+    columns: list[str] = None,
+    zoom: int = ZOOM,
+    prune: bool = True,
+) -> dict:
+    """
+    Exporte (ou met à jour) le paquet des résultats aux sites.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Sites (colonne code_aiot et attributs), par exemple le dataset ICPE.
+    output_dir : str, optional
+        Répertoire des fichiers d'ensemble. OUTPUT par défaut.
+    var : str, optional
+        Variable. "tasmaxAdjust" par défaut.
+    export_dir : str, optional
+        Répertoire du paquet. EXPORT_DIR par défaut.
+    columns : list[str], optional
+        Attributs exportés. Par défaut, COLUMNS.
+    zoom : int, optional
+        Niveau des tuiles Web Mercator. ZOOM par défaut.
+    prune : bool, optional
+        Si True, supprime les fichiers qui ne sont plus référencés par le
+        manifeste. True par défaut.
+
+    Raises
+    ------
+    FileNotFoundError
+        Si aucun fichier d'ensemble n'est présent dans `output_dir`.
+
+    Returns
+    -------
+    dict
+        Manifeste du paquet.
+
+    """
+    paths = list_outputs(output_dir, var)
+    if not paths:
+        raise FileNotFoundError(f"aucun fichier d'ensemble : {output_dir}")
+    columns = [c for c in (columns or COLUMNS) if c in gdf.columns]
+
+    with stage("export", sites=len(gdf), outputs=len(paths)) as rec:
+        index = SiteIndex(gdf, paths)
+        xy = gdf.geometry.to_crs(3857)
+        x = np.rint(xy.x.to_numpy()).astype("int64")
+        y = np.rint(xy.y.to_numpy()).astype("int64")
+        codes = quantize(index.site_values)
+        tiles = tile_keys(x, y, zoom)
+
+        shards_dir = os.path.join(export_dir, "shards")
+        os.makedirs(shards_dir, exist_ok=True)
+        entries, written = [], 0
+        attrs = gdf[columns].reset_index(drop=True)
+        for tile in np.unique(tiles):
+            sel = np.flatnonzero(tiles == tile)
+            # ordre stable des sites dans la tuile : même contenu, même nom
+            sel = sel[np.argsort(index.codes[sel], kind="stable")]
+            table = {
+                "code_aiot": index.codes[sel].tolist(),
+                "x": x[sel].tolist(),
+                "y": y[sel].tolist(),
+            }
+            for col in columns:
+                table[col] = encode_column(attrs[col].to_numpy()[sel])
+            sites = json.dumps(
+                table, ensure_ascii=False, separators=(",", ":")
+            ).encode("utf8")
+            values = np.ascontiguousarray(codes[:, sel, :].transpose(1, 0, 2))
+
+            sites_name, new_sites = _write_shard(shards_dir, sites, "json")
+            values_name, new_values = _write_shard(
+                shards_dir, values.tobytes(), "bin"
+            )
+            written += new_sites + new_values
+            entries.append(
+                {
+                    "tile": tile,
+                    "sites": len(sel),
+                    "bbox": [
+                        int(x[sel].min()),
+                        int(y[sel].min()),
+                        int(x[sel].max()),
+                        int(y[sel].max()),
+                    ],
+                    "table": f"shards/{sites_name}",
+                    "values": f"shards/{values_name}",
+                }
+            )
+        rec["shards_written"] = written
+
+    referenced = {e[k] for e in entries for k in ["table", "values"]}
+    manifest = {
+        "version": FORMAT_VERSION,
+        "revision": _digest("".join(sorted(referenced)).encode("utf8")),
+        "generated": datetime.now(timezone.utc).isoformat(),
+        "variable": var,
+        "crs": "EPSG:3857",
+        "zoom": zoom,
+        "scale": SCALE,
+        "nodata": NODATA,
+        "dtype": "int16-le",
+        "layout": ["site", "output", "period"],
+        "outputs": [
+            {"scenario": str(s), "statistic": str(t)}
+            for s, t in zip(index.scenarios, index.statistics)
+        ],
+        "periods": [int(p) for p in index.periods],
+        "columns": columns,
+        "tiles": entries,
+    }
+    path = os.path.join(export_dir, "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+    logger.info(
+        "Export : %s tuiles, %s fichiers écrits sur %s",
+        len(entries),
+        written,
+        2 * len(entries),
+    )
+
+    if prune:
+        for name in os.listdir(shards_dir):
+            if f"shards/{name}" not in referenced:
+                os.remove(os.path.join(shards_dir, name))
+    return manifest
+
+
+def bundle_files(export_dir: str = EXPORT_DIR) -> list[str]:
+    "Fichiers du paquet (manifeste en tête)"
+    path = os.path.join(export_dir, "manifest.json")
+    with open(path, encoding="utf8") as f:
+        manifest = json.load(f)
+    return [path] + [
+        os.path.join(export_dir, entry[k])
+        for entry in manifest["tiles"]
+        for k in ["table", "values"]
+    ]
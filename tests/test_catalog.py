@@ -0,0 +1,52 @@
+import pandas as pd
+
+from hackathon_climat_donnees import INPUT
+from hackathon_climat_donnees.catalog import (
+    build_catalog,
+    match_pivots,
+    member_key,
+    parse_path,
+)
+
+HIST = (
+    "mfdata/SocleM-Climat-2025/RCM/EURO-CORDEX/EUR-12/CNRM-ESM2-1/r14i1p1f2/"
+    "CNRM-ALADIN64E1/historical/day/tasmaxAdjust/version-hackathon-102025/"
+    "tasmaxAdjust_FR-Metro_CNRM-ESM2-1_historical_r14i1p1f2_CNRM-MF_"
+    "CNRM-ALADIN64E1_v1-r1_MF-CDFt-ANASTASIA-SAFRAN-1985-2014_day_"
+    "19500101-20141231.nc"
+)
+
+
+def test_parse_path():
+    meta = parse_path(HIST)
+    assert meta["gcm"] == "CNRM-ESM2-1"
+    assert meta["member"] == "r14i1p1f2"
+    assert meta["rcm"] == "CNRM-ALADIN64E1"
+    assert meta["experiment"] == "historical"
+    assert meta["start"] == pd.Timestamp("1950-01-01")
+    assert meta["end"] == pd.Timestamp("2014-12-31")
+    assert meta["version"] == "version-hackathon-102025"
+
+
+def test_match_pivots():
+    catalog = build_catalog(root=INPUT)
+    pivots = pd.read_csv(f"{INPUT}/TRACC_pivot.csv")
+    df = match_pivots(catalog, pivots, experiment="ssp370")
+
+    assert len(df) == (pivots["scenario"] == "ssp370").sum()
+    matched = df.dropna(subset=["hist_path", "ssp_path"])
+    assert len(matched)
+    for _, row in matched.iterrows():
+        hist, ssp = parse_path(row["hist_path"]), parse_path(row["ssp_path"])
+        assert hist["experiment"] == "historical"
+        assert ssp["experiment"] == "ssp370"
+        for meta in (hist, ssp):
+            assert (meta["gcm"], meta["member"], meta["rcm"]) == (
+                row["GCM"],
+                row["member"],
+                row["RCM"],
+            )
+        assert row["member"] in row["modele"].split("_")
+
+    keys = matched.apply(member_key, axis=1)
+    assert keys.is_unique
@@ -0,0 +1,38 @@
+import numpy as np
+from scipy.stats import genextreme as gev
+from scipy.stats import kstest
+
+from hackathon_climat_donnees.diagnostics import (
+    DIAGNOSTICS,
+    gev_diagnostics_array,
+)
+
+
+def test_gev_diagnostics_array():
+    rng = np.random.default_rng(1)
+    extremes = gev.rvs(-0.1, 30, 2, size=(4, 50), random_state=rng)
+    extremes[1, 30:] = np.nan
+    params = np.array([gev.fit(e[np.isfinite(e)]) for e in extremes])
+    params[3] = [-0.1, 0, 1]  # loi sans rapport avec les données
+
+    result = gev_diagnostics_array(extremes, params)
+    assert result.shape == (4, len(DIAGNOSTICS))
+    diag = dict(zip(DIAGNOSTICS, result.T))
+
+    np.testing.assert_array_equal(diag["n_years"], [50, 30, 50, 50])
+    for k in range(3):
+        x = extremes[k][np.isfinite(extremes[k])]
+        ks = kstest(x, gev.cdf, args=tuple(params[k])).statistic
+        np.testing.assert_allclose(diag["ks_stat"][k], ks)
+        assert diag["fit_ok"][k] == 1
+    assert diag["fit_ok"][3] == 0
+
+
+def test_gev_diagnostics_array_invalid():
+    extremes = np.arange(10.0)[None, :].repeat(2, axis=0)
+    params = np.array([[0.0, 5.0, np.nan], [0.0, 5.0, 2.0]])
+    extremes[1, 3:] = np.nan
+
+    diag = dict(zip(DIAGNOSTICS, gev_diagnostics_array(extremes, params).T))
+    np.testing.assert_array_equal(diag["valid_fit"], [0, 0])
+    assert np.isnan(diag["ks_stat"]).all()
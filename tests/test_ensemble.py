@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from hackathon_climat_donnees.ensemble import (
+    nan_quantiles,
+    weighted_quantiles,
+)
+
+QS = [0.0, 0.05, 0.1, 0.5, 0.9, 0.95, 1.0]
+
+
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(2)
+    values = rng.normal(size=(12, 4, 5))
+    values[:3, 0, 0] = np.nan
+    values[:, 1, 1] = np.nan
+    values[1:, 2, 2] = np.nan
+    return values
+
+
+def test_nan_quantiles(values):
+    with np.errstate(all="ignore"), pytest.warns(RuntimeWarning):
+        expected = np.nanquantile(values, QS, axis=0)
+    np.testing.assert_allclose(nan_quantiles(values, QS), expected)
+    np.testing.assert_allclose(
+        nan_quantiles(np.moveaxis(values, 0, -1), QS, axis=-1), expected
+    )
+
+
+def test_weighted_quantiles_equal_weights(values):
+    np.testing.assert_allclose(
+        weighted_quantiles(values, np.full(12, 3.0), QS),
+        nan_quantiles(values, QS),
+    )
+
+
+def test_weighted_quantiles_positions():
+    # positions (poids cumulé - poids) / (poids total - dernier poids) :
+    # 0, 1/4, 3/4, 1
+    v = np.array([1.0, 2.0, 4.0, 8.0])
+    w = np.array([1.0, 2.0, 1.0, 1.0])
+    result = weighted_quantiles(v, w, [0.0, 0.25, 0.5, 0.875, 1.0])
+    np.testing.assert_allclose(result, [1.0, 2.0, 3.0, 6.0, 8.0])
+
+    # poids nul : valeur ignorée
+    result = weighted_quantiles(v, [1.0, 0.0, 1.0, 1.0], QS)
+    np.testing.assert_allclose(result, nan_quantiles(v[[0, 2, 3]], QS))
@@ -0,0 +1,80 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import xarray as xr
+
+from hackathon_climat_donnees.join_netcdf import join_outputs, scenarii_table
+
+PERIODS = np.array([2, 5, 10])
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    "Deux fichiers d'ensemble sur une grille Lambert II étendu (27572)"
+    rng = np.random.default_rng(4)
+    x = 9.0e5 + 8e3 * np.arange(6)
+    y = 2.05e6 + 8e3 * np.arange(5)
+    paths = []
+    for name in ["hist_ref", "ssp3_+2C"]:
+        values = rng.normal(30, 2, size=(len(y), len(x), len(PERIODS)))
+        values[0, :2] = np.nan  # mailles hors du domaine
+        path = str(tmp_path / f"tasmaxAdjust_RP_{name}_median.nc")
+        xr.Dataset(
+            {"return_levels": (("y", "x", "periods"), values)},
+            coords={"y": y, "x": x, "periods": PERIODS},
+        ).to_netcdf(path)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def sites():
+    rng = np.random.default_rng(5)
+    points = gpd.GeoSeries(
+        gpd.points_from_xy(
+            rng.uniform(9.0e5, 9.4e5, 30), rng.uniform(2.05e6, 2.082e6, 30)
+        ),
+        crs=27572,
+    ).to_crs(2154)
+    return gpd.GeoDataFrame(
+        {"code_aiot": [f"{i:010d}" for i in range(30)]}, geometry=points
+    )
+
+
+def sjoin_reference(gdf, path):
+    "Jointure historique : maille valide la plus proche par sjoin_nearest"
+    with xr.open_dataset(path) as ds:
+        df = ds["return_levels"].to_dataframe().dropna().reset_index()
+    cells = df.pivot(
+        index=["x", "y"], columns="periods", values="return_levels"
+    )
+    cells = cells.reset_index()
+    cells = gpd.GeoDataFrame(
+        cells,
+        geometry=gpd.points_from_xy(cells["x"], cells["y"]),
+        crs=27572,
+    ).to_crs(2154)
+    joined = gpd.sjoin_nearest(gdf, cells, how="left")
+    return joined[list(PERIODS)].to_numpy()
+
+
+def test_join_outputs_matches_sjoin(outputs, sites):
+    joined = join_outputs(sites, outputs)
+    assert joined["scenarios"] == ["hist_ref", "ssp3_+2C"]
+    assert joined["statistics"] == ["median", "median"]
+    np.testing.assert_array_equal(joined["periods"], PERIODS)
+    assert joined["values"].shape == (len(sites), 2, len(PERIODS))
+    for k, path in enumerate(outputs):
+        np.testing.assert_array_equal(
+            joined["values"][:, k], sjoin_reference(sites, path)
+        )
+
+
+def test_scenarii_table(outputs, sites):
+    df = scenarii_table(sites, outputs)
+    assert len(df) == len(sites) * len(outputs)
+    joined = join_outputs(sites, outputs)
+    row = df[(df.code_aiot == "0000000003") & (df.scenario == "ssp3_+2C")]
+    np.testing.assert_array_equal(
+        row[[str(p) for p in PERIODS]].to_numpy()[0], joined["values"][3, 1]
+    )
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from scipy.stats import genextreme as gev
+
+from hackathon_climat_donnees.maxima_store import (
+    fit_from_store,
+    open_maxima,
+    write_maxima,
+)
+from hackathon_climat_donnees.netcdf_processing import RP_calcul_vectorized
+
+PERIODS = np.array([2, 10, 50])
+
+
+@pytest.fixture
+def maximums():
+    rng = np.random.default_rng(0)
+    values = gev.rvs(-0.1, 30, 2, size=(40, 3, 5), random_state=rng)
+    values[:, 0, 0] = np.nan
+    values[:10, 1, 1] = np.nan
+    return xr.DataArray(
+        values.astype("float32"),
+        dims=("time", "y", "x"),
+        coords={
+            "time": pd.date_range("1981", periods=40, freq="YS"),
+            "y": np.arange(3) * 8e3,
+            "x": np.arange(5) * 8e3,
+            "lat": (("y", "x"), np.full((3, 5), 45.0)),
+        },
+        name="tasmax",
+    )
+
+
+def test_write_maxima(maximums, tmp_path):
+    write_maxima(maximums, "k", str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ["k.f32", "k.json", "k.npz"]
+
+    values, header = open_maxima("k", str(tmp_path))
+    np.testing.assert_array_equal(values, maximums.values)
+    assert header["years"] == list(range(1981, 2021))
+    assert header["coords_2d"] == ["lat"]
+
+
+def test_fit_from_store(maximums, tmp_path):
+    write_maxima(maximums, "k", str(tmp_path))
+    ds = fit_from_store(
+        "k", 1991, 2010, PERIODS, n_workers=1, tile=2, store_dir=str(tmp_path)
+    )
+
+    window = maximums.sel(time=slice("1991", "2010")).values
+    for j in range(3):
+        for i in range(5):
+            rv, params = RP_calcul_vectorized(window[:, j, i], PERIODS)
+            np.testing.assert_allclose(ds.return_levels[j, i], rv)
+            np.testing.assert_allclose(ds.gev_params[j, i], params)
+    assert ds.return_levels[0, 0].isnull().all()
+    np.testing.assert_array_equal(ds["lat"], maximums["lat"])
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from scipy.stats import genextreme as gev
+
+from hackathon_climat_donnees.nonstationary import (
+    fit_gev_nonstationary,
+    return_levels_nonstationary,
+)
+
+# mu0, mu1, phi0, phi1, xi
+TRUE_PARAMS = np.array([30.0, 1.5, 0.4, 0.1, -0.1])
+
+
+@pytest.fixture
+def sample():
+    rng = np.random.default_rng(6)
+    gwl = np.linspace(0, 4, 151)
+    mu0, mu1, phi0, phi1, xi = TRUE_PARAMS
+    mu = mu0 + mu1 * gwl
+    sigma = np.exp(phi0 + phi1 * gwl)
+    maxima = gev.rvs(
+        -xi, mu[:, None], sigma[:, None], size=(151, 40), random_state=rng
+    )
+    maxima[:140, 0] = np.nan  # trop peu d'années
+    maxima[::3, 1] = np.nan
+    return maxima, gwl
+
+
+def test_return_levels_nonstationary():
+    periods = np.array([2, 10, 100])
+    rl = return_levels_nonstationary(
+        TRUE_PARAMS[:, None], np.array([0.0, 2.0]), periods
+    )
+    mu0, mu1, phi0, phi1, xi = TRUE_PARAMS
+    for k, T in enumerate([0.0, 2.0]):
+        expected = gev.ppf(
+            1 - 1 / periods, -xi, mu0 + mu1 * T, np.exp(phi0 + phi1 * T)
+        )
+        np.testing.assert_allclose(rl[k, :, 0], expected)
+
+
+def test_fit_gev_nonstationary(sample):
+    maxima, gwl = sample
+    params, converged = fit_gev_nonstationary(maxima, gwl)
+
+    assert params.shape == (5, 40)
+    assert np.isnan(params[:, 0]).all() and not converged[0]
+    assert converged[1:].all()
+    np.testing.assert_allclose(
+        np.median(params[:, 1:], axis=1), TRUE_PARAMS, atol=0.1
+    )
+
+
+def test_fit_gev_nonstationary_batches(sample):
+    maxima, gwl = sample
+    periods = np.array([10, 100])
+    levels = np.array([1.0, 3.0])
+    results = [
+        fit_gev_nonstationary(maxima, gwl, batch_size=batch_size)
+        for batch_size in (1, 16)
+    ]
+    (p1, c1), (p16, c16) = results
+    np.testing.assert_array_equal(c1, c16)
+    np.testing.assert_allclose(
+        return_levels_nonstationary(p16, levels, periods),
+        return_levels_nonstationary(p1, levels, periods),
+        rtol=1e-4,
+    )
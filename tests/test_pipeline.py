@@ -0,0 +1,97 @@
+import json
+
+from hackathon_climat_donnees.pipeline import Stage, is_fresh, run
+
+
+def make_stages(tmp_path, calls):
+    source = tmp_path / "source.txt"
+    first = tmp_path / "first.txt"
+    second = tmp_path / "second.txt"
+
+    def run_first(params):
+        calls.append("first")
+        first.write_text(source.read_text().upper())
+        return [str(first)]
+
+    def run_second(params):
+        calls.append("second")
+        second.write_text(first.read_text() * params["repeat"])
+        return [str(second)]
+
+    return {
+        "first": Stage(
+            "first", run_first, "text", inputs=lambda: [str(source)]
+        ),
+        "second": Stage(
+            "second",
+            run_second,
+            "text",
+            deps=["first"],
+            params={"repeat": 2},
+        ),
+    }
+
+
+def test_run_reuses_fresh_stages(tmp_path):
+    (tmp_path / "source.txt").write_text("a")
+    calls = []
+    stages = make_stages(tmp_path, calls)
+    manifests = str(tmp_path / "manifests")
+
+    assert run(stages=stages, manifest_dir=manifests) == {
+        "first": True,
+        "second": True,
+    }
+    assert run(stages=stages, manifest_dir=manifests) == {
+        "first": False,
+        "second": False,
+    }
+    assert calls == ["first", "second"]
+    assert (tmp_path / "second.txt").read_text() == "AA"
+
+
+def test_run_invalidates_downstream(tmp_path):
+    (tmp_path / "source.txt").write_text("a")
+    calls = []
+    stages = make_stages(tmp_path, calls)
+    manifests = str(tmp_path / "manifests")
+    run(stages=stages, manifest_dir=manifests)
+
+    # entrée modifiée : les deux étapes sont relancées
+    (tmp_path / "source.txt").write_text("b")
+    assert run(stages=stages, manifest_dir=manifests) == {
+        "first": True,
+        "second": True,
+    }
+    assert (tmp_path / "second.txt").read_text() == "BB"
+
+    # paramètres modifiés : seule l'étape concernée est relancée
+    stages["second"].params = {"repeat": 3}
+    assert run(stages=stages, manifest_dir=manifests) == {
+        "first": False,
+        "second": True,
+    }
+
+    # sortie modifiée hors de la chaîne : l'étape est relancée
+    (tmp_path / "second.txt").write_text("?")
+    assert run(["second"], stages=stages, manifest_dir=manifests) == {
+        "first": False,
+        "second": True,
+    }
+    assert (tmp_path / "second.txt").read_text() == "BBB"
+
+
+def test_is_fresh_max_age(tmp_path):
+    (tmp_path / "source.txt").write_text("a")
+    stages = make_stages(tmp_path, [])
+    manifests = tmp_path / "manifests"
+    run(["first"], stages=stages, manifest_dir=str(manifests))
+
+    manifest = json.loads((manifests / "first.json").read_text())
+    assert is_fresh(manifest, manifest["key"])
+    assert is_fresh(manifest, manifest["key"], max_age=3600)
+    assert not is_fresh(manifest, "other")
+
+    manifest["completed"] -= 7200
+    assert not is_fresh(manifest, manifest["key"], max_age=3600)
+    assert is_fresh(manifest, manifest["key"])
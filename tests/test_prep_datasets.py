@@ -0,0 +1,194 @@
+import json
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+from hackathon_climat_donnees import prep_datasets
+from hackathon_climat_donnees.prep_datasets import (
+    GEOLOCATED_FLAG,
+    diff_sites,
+    prep_dataset_icpe,
+    where_clause,
+)
+
+N_SITES = 12
+
+
+def codes(*ids):
+    return [f"{i:010d}" for i in ids]
+
+
+def inventory(dates=None, drop=()):
+    "Inventaire ICPE fictif ; le site 11 n'a pas de géométrie"
+    ids = [i for i in range(N_SITES) if i not in drop]
+    dates = dates or {}
+    gdf = gpd.GeoDataFrame(
+        {
+            "code_aiot": codes(*ids),
+            "nom_ets": "ets",
+            "adresse": "adresse",
+            "num_dep": "73",
+            "cd_insee": "73065",
+            "date_modif": [dates.get(i, "2025/01/01") for i in ids],
+            "derniere_i": "2025/01/01",
+        },
+        geometry=gpd.points_from_xy(
+            [9.5e5 + 1e3 * i for i in ids], [6.5e6] * len(ids)
+        ),
+        crs=2154,
+    )
+    gdf.loc[gdf["code_aiot"] == codes(11)[0], "geometry"] = None
+    return gdf
+
+
+def irep():
+    "Profils IREP fictifs ; pas de profil pour le site 11"
+    ids = range(N_SITES - 1)
+    return gpd.GeoDataFrame(
+        {
+            "identifiant": codes(*ids),
+            "nom_etablissement": "nom",
+            "numero_siret": "000",
+            "adresse": "adresse irep",
+            "code_insee": "73065",
+            "code_departement": "73",
+            "code_region": "84",
+            "AIR_Q75": False,
+        },
+        geometry=gpd.points_from_xy(
+            [9.5e5 + 1e3 * i + 10 for i in ids], [6.5e6] * len(ids)
+        ),
+        crs=2154,
+    )
+
+
+def test_diff_sites():
+    previous = pd.DataFrame(
+        {
+            "code_aiot": ["a", "b", "c", "d"],
+            "date_modif": ["1", "1", "1", "1"],
+            "derniere_i": ["1", "1", "1", None],
+        }
+    )
+    current = pd.DataFrame(
+        {
+            "code_aiot": ["e", "d", "c", "a"],
+            "date_modif": ["1", "1", "1", "2"],
+            "derniere_i": ["1", None, "2", "1"],
+        }
+    )
+    changes = diff_sites(current, previous)
+    assert {k: sorted(v) for k, v in changes.items()} == {
+        "new": ["e"],
+        "removed": ["b"],
+        "modified": ["a", "c"],
+        "unchanged": ["d"],
+    }
+
+
+def test_where_clause():
+    assert where_clause({}, metropole=False) is None
+    assert where_clause({"lib_seveso": ["Seveso seuil bas", "l'autre"]}) == (
+        "lib_seveso IN ('Seveso seuil bas', 'l''autre') "
+        "AND (cd_insee IS NULL OR cd_insee NOT LIKE '97%')"
+    )
+    assert where_clause({"ied": 1}, metropole=False) == "ied = 1"
+
+
+def test_where_clause_read(tmp_path):
+    path = str(tmp_path / "icpe.gpkg")
+    gpd.GeoDataFrame(
+        {"ied": [1, 1, 1, 0], "cd_insee": ["73065", None, "97101", "73065"]},
+        geometry=gpd.points_from_xy(range(4), range(4)),
+        crs=2154,
+    ).to_file(path)
+
+    gdf = gpd.read_file(path, where=where_clause({"ied": 1}))
+    assert gdf["cd_insee"].iloc[0] == "73065"
+    assert gdf["cd_insee"].iloc[1:].isna().all() and len(gdf) == 2
+
+
+@pytest.fixture
+def sources(monkeypatch, tmp_path):
+    "Sources de données et risques naturels simulés"
+    state = {"inventory": inventory(), "irep": irep(), "queried": []}
+
+    def hazards(gdf):
+        state["queried"].append(sorted(gdf["code_aiot"]))
+        return pd.DataFrame(
+            {"Inondation": gdf["code_aiot"].astype(int).to_numpy() % 3},
+            index=pd.Index(gdf["code_aiot"], name="code_aiot"),
+        )
+
+    monkeypatch.setattr(
+        prep_datasets,
+        "prepare_dataset",
+        lambda *args, **kwargs: state["inventory"].copy(),
+    )
+    monkeypatch.setattr(
+        prep_datasets, "profile_irep", lambda: state["irep"].copy()
+    )
+    monkeypatch.setattr(prep_datasets, "hazards", hazards)
+    monkeypatch.setattr(prep_datasets, "to_disk", lambda gdf: None)
+    monkeypatch.setattr(
+        prep_datasets, "CHANGES_PATH", str(tmp_path / "changes.json")
+    )
+    state["snapshot"] = str(tmp_path / "snapshot.parquet")
+    state["changes"] = lambda: json.loads(
+        (tmp_path / "changes.json").read_text()
+    )
+    return state
+
+
+def test_incremental_refresh(sources):
+    snapshot = sources["snapshot"]
+    prep_dataset_icpe(incremental=True, snapshot=snapshot)
+    assert sources["queried"] == [codes(*range(N_SITES - 1))]
+
+    # le site sans géométrie est conservé dans le snapshot
+    snap = gpd.read_parquet(snapshot)
+    assert len(snap) == N_SITES
+    assert snap.set_index("code_aiot")[GEOLOCATED_FLAG].to_dict() == {
+        code: code != codes(11)[0] for code in codes(*range(N_SITES))
+    }
+
+    # site 3 modifié, site 5 supprimé, géométrie IREP du site 7 déplacée,
+    # profil IREP du site 8 modifié
+    sources["inventory"] = inventory(dates={3: "2025/06/01"}, drop=[5])
+    sources["irep"].loc[7, "geometry"] = Point(9.6e5, 6.51e6)
+    sources["irep"].loc[8, "AIR_Q75"] = True
+    gdf = prep_dataset_icpe(incremental=True, snapshot=snapshot)
+
+    changes = sources["changes"]()
+    assert changes["new"] == []
+    assert changes["removed"] == codes(5)
+    assert sorted(changes["modified"]) == codes(3, 7)
+    assert codes(11)[0] in changes["unchanged"]
+    assert changes["from"] != changes["to"]
+
+    # risques interrogés pour le seul site déplacé
+    assert sources["queried"][1:] == [codes(7)]
+    # profils IREP recalculés pour tous les sites
+    assert gdf.set_index("code_aiot").loc[codes(8)[0], "AIR_Q75"]
+    assert codes(11)[0] not in set(gdf["code_aiot"])
+
+    # même résultat qu'un calcul complet
+    full = prep_dataset_icpe(save=False)
+    pd.testing.assert_frame_equal(
+        gdf.drop(columns="geometry").reset_index(drop=True),
+        full.drop(columns="geometry").reset_index(drop=True),
+        check_dtype=False,
+    )
+    assert (
+        gdf.geometry.reset_index(drop=True)
+        .geom_equals(full.geometry.reset_index(drop=True))
+        .all()
+    )
+
+    # exécution suivante sans changement : rien à refaire
+    prep_dataset_icpe(incremental=True, snapshot=snapshot)
+    changes = sources["changes"]()
+    assert changes["new"] == changes["modified"] == changes["removed"] == []
+    assert changes["from"] == changes["to"]
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from scipy.special import gamma
+from scipy.stats import genextreme as gev
+
+from hackathon_climat_donnees.regional import (
+    MIN_YEARS,
+    gev_from_lmoments,
+    lmoments,
+    pool_t3,
+)
+
+
+@pytest.mark.parametrize("c", [-0.2, -0.05, 0.0, 0.15])
+def test_lmoments_round_trip(c):
+    sample = gev.rvs(c, 30, 2, size=(20_000, 1), random_state=3)
+    l1, l2, t3, n = lmoments(sample)
+    assert n[0] == 20_000
+
+    fc, loc, scale = gev_from_lmoments(l1, l2, t3)
+    np.testing.assert_allclose(fc, c, atol=0.03)
+    np.testing.assert_allclose(loc, 30, rtol=0.01)
+    np.testing.assert_allclose(scale, 2, rtol=0.03)
+
+
+def test_gev_from_lmoments_exact():
+    # L-moments théoriques d'une GEV (Hosking, 1990)
+    c, loc, scale = 0.1, 10.0, 3.0
+    l1 = loc + scale * (1 - gamma(1 + c)) / c
+    l2 = scale * (1 - 2.0**-c) * gamma(1 + c) / c
+    t3 = 2 * (1 - 3.0**-c) / (1 - 2.0**-c) - 3
+    fc, floc, fscale = gev_from_lmoments(l1, l2, t3)
+    np.testing.assert_allclose(fc, c, atol=1e-3)
+    np.testing.assert_allclose(floc, loc, rtol=1e-3)
+    np.testing.assert_allclose(fscale, scale, rtol=1e-3)
+
+
+def test_lmoments_short_series():
+    x = np.full((10, 2), np.nan)
+    x[:, 0] = np.arange(10)
+    x[: MIN_YEARS - 1, 1] = np.arange(MIN_YEARS - 1)
+    l1, l2, t3, n = lmoments(x)
+    np.testing.assert_array_equal(n, [10, MIN_YEARS - 1])
+    np.testing.assert_allclose(l1[0], 4.5)
+    assert np.isnan([l1[1], l2[1], t3[1]]).all()
+
+
+def test_pool_t3_regions():
+    t3 = np.array([[0.1, 0.3], [0.2, np.nan]])
+    n = np.array([[10, 30], [20, 20]])
+    regions = np.array([[0, 0], [1, 1]])
+    pooled = pool_t3(t3, n, regions=regions)
+    np.testing.assert_allclose(pooled[0], 0.25)
+    np.testing.assert_allclose(pooled[1, 0], 0.2)
+    assert np.isnan(pooled[1, 1])